@@ -0,0 +1,240 @@
+"""Admission control by route cost class. Each route belongs to a class
+(e.g. 'light' lookups, 'heavy' substructure searches and spectra downloads)
+with a limit on concurrent requests and a bounded queue of waiting ones, so
+that expensive routes cannot take all the workers. Requests that find their
+class's queue full, or wait in it too long, get a 503 response with a
+Retry-After header straight away.
+
+The limits are enforced with semaphores in shared memory. When the app is
+created before forking workers (see gunicorn.conf.py), they are shared by all
+workers on the host; otherwise each worker has its own. Slots and queue
+places are recorded with the pid of the worker holding them, so that those of
+a worker that dies while handling requests can be given back (see
+AdmissionControl.reclaim)."""
+
+import multiprocessing
+import os
+import time
+
+from flask import g, jsonify, request
+
+from api.telemetry import metrics
+
+
+class AdmissionClass(object):
+    """Concurrency limit and bounded queue of a route cost class.
+
+    Parameters
+    ----------
+    name : str
+        Name of the class (used as the label of its metrics).
+    max_concurrent : int
+        Maximum number of requests running at once.
+    max_queue : int
+        Maximum number of requests waiting for a slot. Further requests are
+        rejected without waiting.
+    queue_timeout : float
+        Seconds a request waits for a slot before it is rejected.
+    retry_after : int
+        Seconds that rejected clients are told to wait before retrying.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout=10,
+                 retry_after=5):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = multiprocessing.BoundedSemaphore(max_concurrent)
+        # Pid of the worker holding each slot and queue place (0 if free)
+        self._running = multiprocessing.Array('i', max_concurrent)
+        self._queued = multiprocessing.Array('i', max_queue)
+
+    @property
+    def running(self):
+        """Number of requests running in this class."""
+        return sum(1 for pid in self._running[:] if pid)
+
+    @property
+    def queued(self):
+        """Number of requests waiting for a slot in this class."""
+        return sum(1 for pid in self._queued[:] if pid)
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed.
+
+        Returns
+        -------
+        admitted : bool
+            False if the queue was full or no slot freed up in time, in which
+            case no slot was taken.
+        """
+        pid = os.getpid()
+        with self._running.get_lock():
+            if self._slots.acquire(block=False):
+                self._set_owner(self._running, 0, pid, 'running')
+                return True
+
+        with self._queued.get_lock():
+            if not self._set_owner(self._queued, 0, pid, 'queued'):
+                return False  # the queue is full
+        start = time.perf_counter()
+        try:
+            admitted = self._slots.acquire(timeout=self.queue_timeout)
+            if admitted:
+                with self._running.get_lock():
+                    self._set_owner(self._running, 0, pid, 'running')
+        finally:
+            with self._queued.get_lock():
+                self._set_owner(self._queued, pid, 0, 'queued')
+            metrics.observe('admission.wait', time.perf_counter() - start,
+                            label=self.name)
+        return admitted
+
+    def release(self):
+        """Give back a slot taken by acquire."""
+        with self._running.get_lock():
+            self._set_owner(self._running, os.getpid(), 0, 'running')
+            self._slots.release()
+
+    def reclaim(self, pid):
+        """Give back the slots and queue places held by a worker process that
+        has died.
+
+        Returns
+        -------
+        reclaimed : int
+            Number of slots given back.
+        """
+        with self._queued.get_lock():
+            while self._set_owner(self._queued, pid, 0, 'queued'):
+                pass
+        reclaimed = 0
+        with self._running.get_lock():
+            while self._set_owner(self._running, pid, 0, 'running'):
+                self._slots.release()
+                reclaimed += 1
+        return reclaimed
+
+    def _set_owner(self, owners, old, new, gauge):
+        """Replace the first old pid of a shared owner array (holding its
+        lock) with new, and update its gauge.
+
+        Returns
+        -------
+        replaced : bool
+            False if the array has no old pid.
+        """
+        try:
+            index = owners[:].index(old)
+        except ValueError:
+            return False
+        owners[index] = new
+        metrics.set_gauge('admission.' + gauge,
+                          sum(1 for pid in owners[:] if pid), label=self.name)
+        return True
+
+
+class AdmissionControl(object):
+    """Admits or rejects the requests of an app by the cost class of their
+    route.
+
+    Configured by ADMISSION_CONTROL, ADMISSION_CLASSES,
+    ADMISSION_ROUTE_CLASSES and ADMISSION_DEFAULT_CLASS. Metrics (labelled
+    with the class name):
+        admission.running: gauge of requests running
+        admission.queued: gauge of requests waiting for a slot
+        admission.wait: timer of time spent waiting for a slot
+        admission.rejected: counter of requests rejected with a 503
+        admission.reclaimed: counter of slots reclaimed from dead workers
+    """
+
+    def __init__(self, app=None):
+        self.classes = {}
+        self.route_classes = {}
+        self.default_class = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Create the cost classes from an app's config and check requests
+        before they are handled."""
+        config = app.config
+        app.extensions['admission'] = self
+        if not config['ADMISSION_CONTROL']:
+            return
+        self.classes = {name: AdmissionClass(name, **settings)
+                        for name, settings in
+                        config['ADMISSION_CLASSES'].items()}
+        self.route_classes = dict(config['ADMISSION_ROUTE_CLASSES'])
+        self.default_class = config['ADMISSION_DEFAULT_CLASS']
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    def class_for(self, endpoint):
+        """Get the cost class of an endpoint, or None if it is exempt."""
+        if endpoint is None:
+            return None
+        name = endpoint.rsplit('.', 1)[-1]
+        class_name = self.route_classes.get(name, self.default_class)
+        return self.classes.get(class_name)
+
+    def reclaim(self, pid):
+        """Give back the slots and queue places of a dead worker process
+        (e.g. one killed by its timeout, see gunicorn.conf.py), in all cost
+        classes."""
+        for cost_class in self.classes.values():
+            reclaimed = cost_class.reclaim(pid)
+            if reclaimed:
+                metrics.increment('admission.reclaimed', reclaimed,
+                                  label=cost_class.name)
+
+    def _admit(self):
+        """Take a slot for the request, or reject it with a 503."""
+        cost_class = self.class_for(request.endpoint)
+        if cost_class is None:
+            return None
+        if not cost_class.acquire():
+            metrics.increment('admission.rejected', label=cost_class.name)
+            response = jsonify({'message': f'Too many {cost_class.name} '
+                                           'requests. Try again later.'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(cost_class.retry_after)
+            return response
+        g.admission_class = cost_class
+        return None
+
+    def _release(self, error=None):  # pylint: disable=unused-argument
+        """Give back the request's slot (after streamed responses end)."""
+        cost_class = g.pop('admission_class', None)
+        if cost_class is not None:
+            cost_class.release()
+
+
+def worker_threads(classes, default_class, workers=1):
+    """Get the number of threads each worker process needs, so that the
+    requests admitted to the limited cost classes (running or queued) can
+    take at most half of the threads of all workers, leaving the rest for the
+    routes of the default (light) class.
+
+    Parameters
+    ----------
+    classes : dict
+        Settings of each cost class, as in ADMISSION_CLASSES.
+    default_class : str
+        Name of the class of most routes (ADMISSION_DEFAULT_CLASS).
+    workers : int, optional (default: 1)
+        Number of worker processes sharing the limits.
+
+    Returns
+    -------
+    threads : int
+    """
+    limited = sum(settings['max_concurrent'] + settings['max_queue']
+                  for name, settings in classes.items()
+                  if name != default_class)
+    return max(4, -(-2 * limited // workers))
+
+
+admission_control = AdmissionControl()  # pylint: disable=invalid-name
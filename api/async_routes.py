@@ -0,0 +1,168 @@
+"""Asyncio versions of the I/O-bound routes in api.routes, for the async
+serving mode (see api.async_run). Each route runs the same queries as its
+api.routes counterpart (built by api.queries and api.quick_search), but
+awaits PyMongo's asyncio client instead of blocking a worker while Mongo
+responds. Requires the optional quart package and PyMongo 4.9 or later (pip
+install mine-server[async])."""
+
+import asyncio
+from ast import literal_eval
+
+from quart import Blueprint
+from quart import current_app as app
+from quart import jsonify, request
+
+from api import queries
+from api.database import databases
+from api.exceptions import InvalidUsage
+from api.quick_search import classify_query, index_ids, quick_search_cache
+
+
+# pylint: disable=invalid-name
+async_mineserver_api = Blueprint('async_mineserver_api', __name__)
+# pylint: enable=invalid-name
+
+
+def get_db(db_name):
+    """Get an async database by name from the client for its cluster."""
+    return app.extensions['async_mongo'].get_db(db_name)
+
+
+@async_mineserver_api.errorhandler(InvalidUsage)
+async def handle_invalid_usage(error):
+    """Makes it so user can receive an informative error message rather than
+    a default internal server error."""
+    response = jsonify(error.to_dict())
+    response.status_code = error.status_code
+    return response
+
+
+@async_mineserver_api.route('/quick-search/<db_name>/q=<query>')
+async def quick_search_api(db_name, query):
+    """Perform a quick search and return results. See
+    api.routes.quick_search_api and api.quick_search.QuickSearchCache.search,
+    whose queries it runs."""
+    db = get_db(db_name)
+    field, key = classify_query(query)
+    projection = queries.default_projection()
+
+    index = None
+    if field != '_id' and app.config['QUICK_SEARCH_INDEX']:
+        # Only looks the index up (or starts building it in the background)
+        index = quick_search_cache.find_index(databases.get_db(db_name))
+    if index is not None:
+        ids = index_ids(index, field, key)
+        docs = {}
+        if ids:
+            async for comp in db.compounds.find({'_id': {'$in': ids}},
+                                                projection):
+                docs[comp['_id']] = comp
+        results = [docs[_id] for _id in ids if _id in docs]
+    else:
+        cursor = db.compounds.find(queries.compound_query(field, key),
+                                   projection)
+        if field != 'Names':
+            cursor = cursor.limit(queries.MAX_RESULTS)
+        results = [x async for x in cursor if x['_id'][0] == 'C']
+
+    if field == 'Names' and not results:
+        cursor = db.compounds.find(queries.text_query(query),
+                                   queries.TEXT_SEARCH_PROJECTION)
+        cursor = cursor.sort(queries.TEXT_SCORE_SORT)
+        results = [x async for x in cursor.limit(queries.MAX_RESULTS)
+                   if x['_id'][0] == 'C']
+
+    return jsonify(results)
+
+
+@async_mineserver_api.route('/model-search/q=<query>')
+async def model_search_api(query):
+    """Perform a model search and return results. See
+    api.routes.model_search_api."""
+    db = get_db(app.config['KEGG_DB_NAME'])
+    cursor = db.models.find(queries.text_query(query),
+                            {'score': {'$meta': 'textScore'}})
+    cursor = cursor.sort(queries.TEXT_SCORE_SORT)
+    return jsonify([x['_id'] async for x in cursor])
+
+
+@async_mineserver_api.route('/get-ids/<db_name>/<collection_name>')
+@async_mineserver_api.route('/get-ids/<db_name>/<collection_name>/q=<query>')
+async def get_ids_api(db_name, collection_name, query=None):
+    """Get Mongo IDs for a subset of a given database collection. See
+    api.routes.get_ids_api."""
+    db = get_db(db_name)
+    query = literal_eval(query) if query else {}
+    return jsonify(await _get_ids(db[collection_name], query))
+
+
+@async_mineserver_api.route('/get-comps/<db_name>', methods=['GET', 'POST'])
+async def get_comps_api(db_name):
+    """Get compounds for specified ids in database. See
+    api.routes.get_comps_api."""
+    id_list = (await request.get_json())['id_list']
+
+    if not id_list:
+        raise InvalidUsage('id_list must be specified in form data.')
+
+    db = get_db(db_name)
+    results = await asyncio.gather(*[_get_comp(db, x) for x in id_list])
+    return jsonify(results)
+
+
+@async_mineserver_api.route('/get-rxns/<db_name>', methods=['POST'])
+async def get_rxns_api(db_name):
+    """Get reactions for specified ids in database. See
+    api.routes.get_rxns_api."""
+    id_list = (await request.get_json())['id_list']
+
+    db = get_db(db_name)
+    results = await asyncio.gather(*[db.reactions.find_one({'_id': x})
+                                     for x in id_list])
+    return jsonify(results)
+
+
+@async_mineserver_api.route('/get-ops/<db_name>', methods=['POST'])
+async def get_ops_api(db_name):
+    """Get operators for specified ids in database. See
+    api.routes.get_ops_api."""
+    json_data = await request.get_json()
+    id_list = json_data['id_list'] if json_data else None
+
+    db = get_db(db_name)
+    if id_list:
+        results = await asyncio.gather(*[
+            db.operators.find_one(queries.op_query(x)) for x in id_list])
+    else:
+        results = [x async for x in db.operators.find()]
+    return jsonify(results)
+
+
+@async_mineserver_api.route('/get-op-w-rxns/<db_name>/<op_id>')
+async def get_op_w_rxns_api(db_name, op_id):
+    """Get operator with all its associated reactions in selected database.
+    See api.routes.get_op_w_rxns_api."""
+    db = get_db(db_name)
+    operator = await db.operators.find_one(queries.op_query(op_id))
+    if not operator:
+        raise InvalidUsage('Operator with ID \"{}\" not found.'.format(op_id))
+    operator['Reaction_ids'] = await db.reactions.distinct(
+        '_id', {'Operators': op_id})
+    return jsonify(operator)
+
+
+async def _get_comp(db, cpd_id):
+    """Get one compound, as in api.queries.get_comps."""
+    cpd = await db.compounds.find_one(queries.comp_query(cpd_id),
+                                      queries.COMP_EXCLUDED_FIELDS)
+    if queries.needs_reactions(cpd):
+        as_reactant, as_product = queries.reaction_queries(cpd['_id'])
+        cpd['Reactant_in'], cpd['Product_of'] = await asyncio.gather(
+            _get_ids(db.reactions, as_reactant),
+            _get_ids(db.reactions, as_product))
+    return cpd
+
+
+async def _get_ids(collection, query):
+    """Get the _ids of documents matching a query, as api.queries.get_ids."""
+    return [x['_id'] async for x in collection.find(query, {'_id': 1})]
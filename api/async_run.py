@@ -0,0 +1,219 @@
+"""Asyncio serving mode. create_async_app builds an ASGI app that serves the
+I/O-bound routes (quick search, get-ids, get-comps, get-rxns, get-ops,
+get-op-w-rxns and model search) with PyMongo's asyncio client, so thousands
+of concurrent requests can wait on Mongo in a few processes. Every other route is passed to
+the regular Flask app (create_app) in a thread pool, which keeps CPU-heavy
+searches off the event loop. Request and response bodies of these routes are
+streamed between the event loop and the thread, so uploads and streamed
+responses (e.g. NDJSON batch searches) are not held in memory.
+
+Admission control (see api.admission) applies to the routes passed to the
+Flask app, in each process. The async routes are excluded: they are all in
+the light class and only wait on Mongo, bounded by the connection pool.
+
+With SNAPSHOT_DIR set, every route is passed to the Flask app, which serves
+the read-only routes from the snapshot.
+
+Requires the optional quart package and PyMongo 4.9 or later (pip install
+mine-server[async]). Run with an ASGI server, e.g.
+"hypercorn 'api.async_run:create_async_app()'"."""
+
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import AsyncMongoClient
+from quart import Quart, Response, request
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from api.admission import worker_threads
+from api.async_routes import async_mineserver_api
+from api.config import Config
+from api.database import READ_PREFERENCES, client_options
+from api.run import create_app
+
+#: Response chunks of a Flask route buffered ahead of the client
+STREAM_BUFFER_CHUNKS = 16
+
+
+class AsyncDatabaseRouter(object):
+    """Asyncio counterpart of api.database.DatabaseRouter."""
+
+    def __init__(self, config):
+        options = client_options(config)
+        self._default = AsyncMongoClient(config['MONGO_URI'], **options)
+        self._clients = {name: AsyncMongoClient(uri, **options)
+                         for name, uri in config['MONGO_CLUSTERS'].items()}
+        self._db_clusters = dict(config['MONGO_DB_CLUSTERS'])
+        self.read_preference = \
+            READ_PREFERENCES[config['MONGO_READ_PREFERENCE']]
+
+    def get_db(self, db_name):
+        """Get an async database (with the read-only read preference)."""
+        cluster = self._db_clusters.get(db_name)
+        client = self._default if cluster is None else self._clients[cluster]
+        return client.get_database(db_name,
+                                   read_preference=self.read_preference)
+
+
+def create_async_app(instance_config=Config):
+    """Create an asyncio (Quart) instance of MINE-Server.
+
+    Parameters
+    ----------
+    instance_config : Config (default: app.config.Config)
+        Specifies configuration for this instance.
+
+    Returns
+    -------
+    app : quart.Quart
+        ASGI app serving all routes under /mineserver.
+    """
+    app = Quart(__name__)
+    app.config.from_object(instance_config)
+    # Snapshots (see api.snapshot) are only read by the Flask app, so with
+    # one, all routes are passed to it and Mongo is not needed
+    use_mongo = not app.config['SNAPSHOT_DIR']
+    if use_mongo:
+        app.register_blueprint(async_mineserver_api, url_prefix='/mineserver')
+
+    # Routes without an async version are served by the Flask app
+    wsgi_app = create_app(instance_config)
+    # Admission control applies to these routes (in the Flask app), so the
+    # pool has room for the requests it admits to the limited cost classes
+    executor = ThreadPoolExecutor(
+        app.config['ASYNC_EXECUTOR_WORKERS'] or worker_threads(
+            app.config['ADMISSION_CLASSES'],
+            app.config['ADMISSION_DEFAULT_CLASS']),
+        thread_name_prefix='wsgi')
+
+    @app.before_serving
+    async def connect():
+        # Async clients must be created inside the serving event loop
+        if use_mongo:
+            app.extensions['async_mongo'] = AsyncDatabaseRouter(app.config)
+
+    @app.after_serving
+    async def shutdown():
+        executor.shutdown(wait=False)
+
+    @app.route('/<path:path>', methods=['GET', 'POST'])
+    async def wsgi_fallback(path):  # pylint: disable=unused-variable
+        """Run a request through the Flask app in the thread pool."""
+        loop = asyncio.get_running_loop()
+        environ = EnvironBuilder(path='/' + path, method=request.method,
+                                 headers=list(request.headers.items()),
+                                 query_string=request.query_string
+                                 ).get_environ()
+        # Stream the body instead of reading it first
+        environ['wsgi.input'] = _BodyReader(request.body, loop)
+        environ['CONTENT_TYPE'] = request.headers.get('Content-Type', '')
+        environ['CONTENT_LENGTH'] = request.headers.get('Content-Length', '')
+        if not environ['CONTENT_LENGTH']:
+            environ['wsgi.input_terminated'] = True
+        stream = _ResponseStream(loop)
+        loop.run_in_executor(executor, stream.run, wsgi_app.wsgi_app, environ)
+        status, headers = await stream.start()
+        return Response(stream.body(), status=int(status.split()[0]),
+                        headers=list(headers.items()))
+
+    return app
+
+
+class _BodyReader(io.RawIOBase):
+    """File-like wsgi.input that reads a Quart request body from the event
+    loop, as the Flask app consumes it."""
+
+    def __init__(self, body, loop):
+        super().__init__()
+        self._chunks = body.__aiter__()
+        self._loop = loop
+        self._buffer = b''
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._done:
+            future = asyncio.run_coroutine_threadsafe(self._next(), self._loop)
+            chunk = future.result()
+            if chunk is None:
+                self._done = True
+            else:
+                self._buffer = chunk
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    async def _next(self):
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+
+class _ResponseStream(object):
+    """Passes the status, headers and body chunks of a WSGI response from
+    the thread running it to the event loop, with a bounded buffer.
+
+    The whole response is read in one thread (run), since Flask streams
+    responses with generators that must stay in the request's thread."""
+
+    _END = object()
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue(STREAM_BUFFER_CHUNKS)
+        self._closed = False
+
+    def run(self, wsgi_app, environ):
+        """Call a WSGI app and pass on its response (in a worker thread)."""
+        try:
+            app_iter, status, headers = run_wsgi_app(wsgi_app, environ)
+        except BaseException as error:  # pylint: disable=broad-except
+            self._put(error)
+            return
+        try:
+            self._put((status, headers))
+            for chunk in app_iter:
+                if self._closed:
+                    break
+                if chunk:
+                    self._put(chunk)
+            self._put(self._END)
+        except BaseException as error:  # pylint: disable=broad-except
+            self._put(error)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    async def start(self):
+        """Wait for the status and headers of the response."""
+        item = await self._queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    async def body(self):
+        """Yield the chunks of the response body as the thread reads them."""
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is self._END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Stop the thread if the client went away, unblocking its put
+            self._closed = True
+            while not self._queue.empty():
+                self._queue.get_nowait()
+
+    def _put(self, item):
+        """Add an item to the queue from the thread, waiting for room."""
+        if not self._closed:
+            asyncio.run_coroutine_threadsafe(self._queue.put(item),
+                                             self._loop).result()
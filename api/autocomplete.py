@@ -0,0 +1,304 @@
+"""In-memory index of compound names for type-ahead autocompletion. Names
+starting with the query are found by binary search in sorted name lists,
+and names with typos by the trigrams (three-character substrings) they share
+with the query. Names of compounds from earlier generations (known
+compounds first) are ranked first."""
+
+import bisect
+import heapq
+import re
+from array import array
+from collections import Counter
+
+from api.index_refresh import IndexCache
+
+#: Minimum trigram similarity (shared / all trigrams) of fuzzy matches
+MIN_SIMILARITY = 0.3
+
+#: Trigrams in more names than this are too common to help find fuzzy
+#: matches, and are skipped to keep lookups fast
+MAX_POSTINGS = 5000
+
+#: Query and projection of the compounds whose names are indexed
+NAMED_COMPOUNDS = ({'Names.0': {'$exists': True}},
+                   {'Names': 1, 'Generation': 1, 'MINE_id': 1})
+
+#: Number of new names up to which an update inserts them into the sorted
+#: name lists one by one, rather than sorting the lists again
+MAX_INSERTS = 1000
+
+
+class NameIndex(object):
+    """Names of the compounds in a MINE database, for autocompletion.
+
+    Each distinct name (ignoring case) has a name id. Name ids are kept in
+    one list per generation (the lowest generation of the compounds with the
+    name), sorted by lowercase name. Indexes are not modified once built:
+    updated returns a new index with more names, which shares the parts
+    that did not change with this one.
+
+    Attributes
+    ----------
+    names : list
+        Name of each name id, as first seen.
+    generations : list
+        Lowest generation of the compounds with each name id.
+    trigrams : dict
+        Name ids of the names containing each trigram.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.generations = []
+        self.trigrams = {}
+        self._ids = {}
+        self._n_trigrams = []
+        self._sorted_keys = {}
+        self._sorted_ids = {}
+        # Trigram postings and generations whose lists this index created,
+        # and can modify (others may be shared with earlier versions)
+        self._own_trigrams = set()
+        self._own_generations = set()
+
+    @classmethod
+    def from_db(cls, db):
+        """Index the names of all compounds in a MINE database."""
+        query, projection = NAMED_COMPOUNDS
+        comps = db.compounds.find(query, projection).sort('MINE_id', 1)
+        return cls().updated(comps)
+
+    def __len__(self):
+        return len(self.names)
+
+    def updated(self, comps, removed=()):  # pylint: disable=unused-argument
+        """Get a new index with the names of added or changed compounds.
+
+        Names that compounds no longer have (or only have at a higher
+        generation) are kept until the index is rebuilt.
+
+        Parameters
+        ----------
+        comps : iterable
+            Compound documents (with Names and Generation).
+        removed : set, optional (default: ())
+            _ids of removed compounds.
+
+        Returns
+        -------
+        index : NameIndex
+        """
+        index = NameIndex()
+        index.names = list(self.names)
+        index.generations = list(self.generations)
+        index.trigrams = dict(self.trigrams)
+        index._ids = dict(self._ids)
+        index._n_trigrams = list(self._n_trigrams)
+        index._sorted_keys = dict(self._sorted_keys)
+        index._sorted_ids = dict(self._sorted_ids)
+
+        changed = set()
+        for comp in comps:
+            if comp['_id'][0] != 'C':
+                continue
+            for name in comp.get('Names', []):
+                name_id = index._add(name, comp.get('Generation', 0))
+                if name_id is not None:
+                    changed.add(name_id)
+
+        if len(changed) > MAX_INSERTS:
+            index._sort()
+        else:
+            for name_id in sorted(changed):
+                index._insert(name_id)
+        return index
+
+    def prefix_matches(self, query, limit):
+        """Get the name ids of up to limit names starting with query (ignoring
+        case), from the lowest generation and then alphabetically."""
+        key = query.lower()
+        matches = []
+        for generation in sorted(self._sorted_keys):
+            keys = self._sorted_keys[generation]
+            ids = self._sorted_ids[generation]
+            i = bisect.bisect_left(keys, key)
+            while i < len(keys) and len(matches) < limit and \
+                    keys[i].startswith(key):
+                matches.append(ids[i])
+                i += 1
+            if len(matches) >= limit:
+                break
+        return matches
+
+    def fuzzy_matches(self, query, limit, exclude=()):
+        """Get the name ids of up to limit names with trigrams similar to
+        query, most similar first (then from the lowest generation)."""
+        query_trigrams = _trigrams(query.lower())
+        shared = Counter()
+        for trigram in query_trigrams:
+            postings = self.trigrams.get(trigram)
+            if postings is not None and len(postings) <= MAX_POSTINGS:
+                shared.update(postings)
+
+        candidates = []
+        for name_id, n_shared in shared.items():
+            if name_id in exclude:
+                continue
+            similarity = n_shared / (len(query_trigrams) +
+                                     self._n_trigrams[name_id] - n_shared)
+            if similarity >= MIN_SIMILARITY:
+                candidates.append((-similarity, self.generations[name_id],
+                                   self.names[name_id].lower(), name_id))
+        return [name_id for *_, name_id in heapq.nsmallest(limit, candidates)]
+
+    def _add(self, name, generation):
+        """Add a name, or lower the generation of a known name. Returns its
+        name id if it must be (re)inserted in the sorted lists."""
+        key = name.lower()
+        name_id = self._ids.get(key)
+        if name_id is None:
+            name_id = self._ids[key] = len(self.names)
+            self.names.append(name)
+            self.generations.append(generation)
+            trigrams = _trigrams(key)
+            self._n_trigrams.append(len(trigrams))
+            for trigram in trigrams:
+                if trigram not in self._own_trigrams:
+                    self.trigrams[trigram] = array(
+                        'i', self.trigrams.get(trigram, ()))
+                    self._own_trigrams.add(trigram)
+                self.trigrams[trigram].append(name_id)
+            return name_id
+        if generation < self.generations[name_id]:
+            self._remove(name_id)
+            self.generations[name_id] = generation
+            return name_id
+        return None
+
+    def _sort(self):
+        """Sort all name ids into the per-generation lists."""
+        by_generation = {}
+        for name_id, generation in enumerate(self.generations):
+            by_generation.setdefault(generation, []).append(
+                (self.names[name_id].lower(), name_id))
+        self._sorted_keys, self._sorted_ids = {}, {}
+        for generation, entries in by_generation.items():
+            entries.sort()
+            self._sorted_keys[generation] = [key for key, _ in entries]
+            self._sorted_ids[generation] = [name_id for _, name_id in entries]
+        self._own_generations = set(self._sorted_keys)
+
+    def _own_lists(self, generation):
+        """Get the sorted lists of a generation, copying them first if they
+        are shared with an earlier version of the index."""
+        if generation not in self._own_generations:
+            self._sorted_keys[generation] = \
+                list(self._sorted_keys.get(generation, []))
+            self._sorted_ids[generation] = \
+                list(self._sorted_ids.get(generation, []))
+            self._own_generations.add(generation)
+        return self._sorted_keys[generation], self._sorted_ids[generation]
+
+    def _insert(self, name_id):
+        """Insert a name id into the list of its generation."""
+        keys, ids = self._own_lists(self.generations[name_id])
+        key = self.names[name_id].lower()
+        i = bisect.bisect_right(keys, key)
+        keys.insert(i, key)
+        ids.insert(i, name_id)
+
+    def _remove(self, name_id):
+        """Remove a name id from the list of its generation, if it is in it."""
+        generation = self.generations[name_id]
+        key = self.names[name_id].lower()
+        keys = self._sorted_keys.get(generation, [])
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            keys, ids = self._own_lists(generation)
+            del keys[i]
+            del ids[i]
+
+
+class AutocompleteCache(IndexCache):
+    """Keeps a NameIndex of each MINE database (see
+    api.index_refresh.IndexCache)."""
+
+    index_class = NameIndex
+    name = 'autocomplete'
+
+    def compounds(self, *args):
+        return NAMED_COMPOUNDS
+
+    def complete(self, db, query, limit=10):
+        """Suggest compound names for a partly typed query.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            MINE database whose compound names are suggested.
+        query : str
+            Start of a compound name, possibly with typos.
+        limit : int, optional (default: 10)
+            Maximum number of suggestions.
+
+        Returns
+        -------
+        suggestions : list
+            Dicts with the 'name', its lowest compound 'generation' and
+            'match' ('prefix' for names starting with the query, 'fuzzy' for
+            names similar to it). Prefix matches come first. Databases
+            without an index in memory (see find_index) only get prefix
+            matches, found with a Mongo query.
+        """
+        query = query.strip()
+        if not query:
+            return []
+        index = self.find_index(db)
+        if index is None:
+            return _mongo_prefix_matches(db, query, limit)
+        name_ids = index.prefix_matches(query, limit)
+        suggestions = [_suggestion(index, name_id, 'prefix')
+                       for name_id in name_ids]
+        if len(suggestions) < limit and len(query) >= 3:
+            fuzzy_ids = index.fuzzy_matches(query, limit - len(suggestions),
+                                            exclude=set(name_ids))
+            suggestions += [_suggestion(index, name_id, 'fuzzy')
+                            for name_id in fuzzy_ids]
+        return suggestions
+
+
+def _mongo_prefix_matches(db, query, limit):
+    """Suggest up to limit names starting with query (ignoring case) with a
+    Mongo query, from the lowest generation and then alphabetically."""
+    names = {}
+    prefix = re.compile('^' + re.escape(query), re.IGNORECASE)
+    filter_ = {'$and': [NAMED_COMPOUNDS[0], {'Names': prefix}]}
+    # Compounds by generation, so the first generation seen of a name is its
+    # lowest
+    for comp in db.compounds.find(filter_, NAMED_COMPOUNDS[1]).sort(
+            'Generation', 1):
+        if comp['_id'][0] != 'C':
+            continue
+        for name in comp['Names']:
+            if prefix.match(name) and name.lower() not in names:
+                names[name.lower()] = (comp.get('Generation', 0), name)
+        if len(names) >= limit:
+            break
+    return [{'name': name, 'generation': generation, 'match': 'prefix'}
+            for generation, name in sorted(
+                names.values(), key=lambda x: (x[0], x[1].lower()))[:limit]]
+
+
+def _trigrams(key):
+    """Set of the trigrams of a lowercase name, padded so that the start and
+    end of the name count more."""
+    padded = '  %s ' % key
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _suggestion(index, name_id, match):
+    """Autocomplete suggestion for a name id."""
+    return {'name': index.names[name_id],
+            'generation': index.generations[name_id], 'match': match}
+
+
+autocomplete_cache = AutocompleteCache()  # pylint: disable=invalid-name
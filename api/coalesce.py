@@ -0,0 +1,288 @@
+"""Single-flight request coalescing. When identical requests (same route,
+db_name and parameters) arrive while one of them is still being computed,
+only the first runs the route and the others wait for and share its
+response. Coalescing is always done across threads in a worker and can also
+be done across workers on the same host (COALESCE_ACROSS_WORKERS)."""
+
+import functools
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+
+from flask import current_app, make_response, request
+
+from api.telemetry import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows, where coalescing stays within each worker
+    fcntl = None  # pylint: disable=invalid-name
+
+
+class _Call(object):
+    """A computation that other threads may be waiting on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs at most one computation at a time for each key.
+
+    Attributes
+    ----------
+    lock_dir : str or None
+        Directory for the lock and result files used to coalesce across
+        worker processes. If None, only threads in this process coalesce.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._last_prune = 0.0
+
+    def do(self, key, func):
+        """Call func, or wait for an identical call already in progress.
+
+        Parameters
+        ----------
+        key : str
+            Identifies identical computations (e.g. a hash of the request).
+        func : callable
+            Takes no arguments. Its result must be bytes if coalescing across
+            processes.
+
+        Returns
+        -------
+        result : object
+            What func returned (possibly in another thread or process).
+        coalesced : bool
+            True if the result was computed by another request.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, coalesced = self._do_shared(key, func)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, coalesced
+
+    def _do_shared(self, key, func):
+        """Coalesce with other processes using a lock file per key."""
+        if self.lock_dir is None or fcntl is None:
+            return func(), False
+
+        os.makedirs(self.lock_dir, mode=0o700, exist_ok=True)
+        lock_path = os.path.join(self.lock_dir, key + '.lock')
+        wait_path = os.path.join(self.lock_dir, key + '.wait')
+        result_path = os.path.join(self.lock_dir, key + '.result')
+        start = time.time()
+
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is computing this: ask it to share its
+                # result, and wait for it
+                _touch(wait_path)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                result = _read_result(result_path, start)
+                if result is not None:
+                    return result[0], True
+            # Mark the lock file as in use, so that it is not pruned
+            os.utime(lock_path)
+            try:
+                result = func()
+                if _modified_since(wait_path, start):
+                    try:
+                        _write_result(result_path, result)
+                    except OSError:
+                        pass  # the waiting requests compute it themselves
+                return result, False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                self._prune()
+
+    def _prune(self, max_age=600):
+        """Remove lock, wait and result files that have not been used
+        recently. Lock files are only removed if no process holds them."""
+        now = time.time()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        cutoff = now - max_age
+        for entry in os.scandir(self.lock_dir):
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                if not entry.name.endswith('.lock'):
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, 'a') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # a request is still computing its result
+                    os.remove(entry.path)
+            except OSError:
+                pass  # removed by another process
+
+
+def coalesce(view):
+    """Decorator that coalesces identical concurrent requests to a route.
+
+    Requests are identical if they have the same endpoint, URL arguments
+    (including db_name), query string and JSON body (ignoring key order), or
+    form fields and uploaded file contents.
+    Controlled by the COALESCE_REQUESTS and COALESCE_ACROSS_WORKERS config
+    settings. Counts of coalesced requests are recorded in the metrics store
+    ('coalesce.leaders' and 'coalesce.coalesced', labelled by endpoint).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        if not config['COALESCE_REQUESTS']:
+            return view(*args, **kwargs)
+
+        def compute():
+            return dump_response(make_response(view(*args, **kwargs)))
+
+        flight = _get_single_flight(config)
+        data, coalesced = flight.do(request_key(), compute)
+        metrics.increment('coalesce.coalesced' if coalesced
+                          else 'coalesce.leaders', label=request.endpoint)
+        return load_response(data)
+
+    return wrapper
+
+
+def request_key():
+    """Hash that is the same for identical requests to the same route."""
+    json_data = request.get_json(silent=True)
+    parts = [request.endpoint, sorted(request.view_args.items()),
+             sorted(request.args.items(multi=True)), json_data]
+    if request.files:
+        parts += [sorted(request.form.items(multi=True)),
+                  sorted((name, _file_digest(upload.stream))
+                         for name, upload in request.files.items(multi=True))]
+    normalized = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def dump_response(response):
+    """Serialize a response's status, headers and body to bytes (a JSON
+    header line, then the body), to share it with other processes."""
+    header = json.dumps({'status': response.status_code,
+                         'headers': list(response.headers.items())})
+    return header.encode() + b'\n' + response.get_data()
+
+
+def load_response(data):
+    """Make a response from bytes written by dump_response."""
+    header, _, body = data.partition(b'\n')
+    header = json.loads(header)
+    return current_app.response_class(
+        body, status=header['status'],
+        headers=[tuple(item) for item in header['headers']])
+
+
+def private_temp_dir(name):
+    """Get a directory in the system temp dir that only this user can
+    access, creating it if needed.
+
+    Raises
+    ------
+    RuntimeError
+        If the directory exists but is not private to this user (e.g. it was
+        created by another user), since its files could then be replaced.
+    """
+    uid = os.getuid() if hasattr(os, 'getuid') else None
+    path = os.path.join(tempfile.gettempdir(),
+                        name if uid is None else f'{name}-{uid}')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if uid is not None and (not stat.S_ISDIR(info.st_mode)
+                            or info.st_uid != uid
+                            or info.st_mode & 0o077):
+        raise RuntimeError(f'{path} is not private to this user')
+    return path
+
+
+def _file_digest(stream, chunk_size=65536):
+    """Hash the contents of an uploaded file, leaving it to be read again."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+_single_flights = {}  # pylint: disable=invalid-name
+_single_flights_lock = threading.Lock()  # pylint: disable=invalid-name
+
+
+def _get_single_flight(config):
+    """Get the SingleFlight instance for an app's coalescing settings."""
+    lock_dir = None
+    if config['COALESCE_ACROSS_WORKERS']:
+        lock_dir = config['COALESCE_DIR'] or \
+            private_temp_dir('mine-server-coalesce')
+    with _single_flights_lock:
+        if lock_dir not in _single_flights:
+            _single_flights[lock_dir] = SingleFlight(lock_dir)
+        return _single_flights[lock_dir]
+
+
+def _touch(path):
+    """Create a file or update its modification time."""
+    with open(path, 'a'):
+        os.utime(path)
+
+
+def _modified_since(path, since):
+    """Check whether a file was modified after time since."""
+    try:
+        return os.path.getmtime(path) >= since
+    except OSError:
+        return False
+
+
+def _read_result(path, since):
+    """Read a result written by another process after time since."""
+    try:
+        if os.path.getmtime(path) < since:
+            return None
+        with open(path, 'rb') as infile:
+            return (infile.read(),)
+    except OSError:
+        return None
+
+
+def _write_result(path, result):
+    """Atomically write a result for other processes to read."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as outfile:
+        outfile.write(result)
+    os.replace(tmp_path, path)
@@ -1,7 +1,323 @@
 """Used just to create the mongo connection. See Stack Overflow question
-33166612 for details on why this needs to be its own file."""
+33166612 for details on why this needs to be its own file.
 
+Routes should get databases with get_db, which picks the client for the
+cluster holding each database and applies the read preference for read-only
+access. Connection pool activity is recorded in api.telemetry.metrics, and
+the commands run for each request are counted and timed, with slow ones
+written to the slow query log."""
+
+import contextvars
+import json
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
 from flask_pymongo import PyMongo
+from pymongo import MongoClient, ReadPreference
+from pymongo.monitoring import CommandListener, ConnectionPoolListener
+
+from api.telemetry import metrics
 
 
 mongo = PyMongo()
+
+#: Logger for commands slower than MONGO_SLOW_QUERY_MS (one JSON object per
+#: line)
+slow_query_logger = logging.getLogger('mineserver.slow_queries')
+
+#: Command fields holding the query filter (or pipeline), by command name
+FILTER_FIELDS = ('filter', 'query', 'pipeline', 'q')
+
+#: Read preferences that can be set with MONGO_READ_PREFERENCE
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+
+class PoolMetricsListener(ConnectionPoolListener):
+    """Records connection pool checkouts and wait times in the metrics store.
+
+    Metrics (labelled with the server address):
+        mongo.pool.checkouts: counter of connections checked out
+        mongo.pool.checkout_failures: counter of failed checkouts (e.g. wait
+            queue timeouts)
+        mongo.pool.checked_out: gauge of connections currently checked out
+        mongo.pool.wait: timer of time spent waiting for a connection
+    """
+
+    def __init__(self):
+        # Per thread, and per task with the asyncio client (api.async_run)
+        self._start = contextvars.ContextVar('pool_wait_start', default=None)
+
+    def connection_check_out_started(self, event):
+        self._start.set(time.perf_counter())
+
+    def connection_checked_out(self, event):
+        label = _address(event.address)
+        self._observe_wait(label)
+        metrics.increment('mongo.pool.checkouts', label=label)
+        metrics.add_gauge('mongo.pool.checked_out', 1, label=label)
+
+    def connection_check_out_failed(self, event):
+        label = _address(event.address)
+        self._observe_wait(label)
+        metrics.increment('mongo.pool.checkout_failures', label=label)
+
+    def connection_checked_in(self, event):
+        metrics.add_gauge('mongo.pool.checked_out', -1,
+                          label=_address(event.address))
+
+    def _observe_wait(self, label):
+        start = self._start.get()
+        if start is not None:
+            metrics.observe('mongo.pool.wait', time.perf_counter() - start,
+                            label=label)
+            self._start.set(None)
+
+    # Remaining pool events are not recorded
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+class CommandMetricsListener(CommandListener):
+    """Attributes Mongo commands to the Flask request that runs them, and logs
+    slow commands.
+
+    For each request, the number of commands, their total time and the
+    slowest command are kept in flask.g (see request_mongo_stats). Commands
+    run outside of a request context (e.g. warm-up, or worker threads of
+    batch searches) are not attributed.
+
+    Parameters
+    ----------
+    slow_ms : float or None
+        Commands that take at least this many milliseconds are written to
+        the slow query log, with the route, db_name and the command's filter
+        with its values redacted. None disables the log.
+    """
+
+    def __init__(self, slow_ms=None):
+        self.slow_ms = slow_ms
+        self._local = threading.local()
+
+    def started(self, event):
+        if not has_request_context():
+            return
+        commands = getattr(self._local, 'commands', None)
+        if commands is None:
+            commands = self._local.commands = {}
+        commands[(event.connection_id, event.request_id)] = \
+            (event.command_name, event.command)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        commands = getattr(self._local, 'commands', {})
+        started = commands.pop((event.connection_id, event.request_id), None)
+        if started is None or not has_request_context():
+            return
+        command_name, command = started
+        seconds = event.duration_micros / 1e6
+
+        stats = g.setdefault('mongo_stats', {'commands': 0, 'seconds': 0.0,
+                                             'slowest': None})
+        stats['commands'] += 1
+        stats['seconds'] += seconds
+        if stats['slowest'] is None or seconds > stats['slowest']['seconds']:
+            stats['slowest'] = {'command': command_name,
+                                'collection': _collection(command_name,
+                                                          command),
+                                'seconds': seconds}
+
+        if self.slow_ms is not None and seconds * 1000 >= self.slow_ms:
+            slow_query_logger.warning(json.dumps({
+                'event': 'slow_query',
+                'route': request.endpoint,
+                'db_name': (request.view_args or {}).get('db_name'),
+                'database': event.database_name,
+                'collection': _collection(command_name, command),
+                'command': command_name,
+                'duration_ms': round(seconds * 1000, 3),
+                'failed': not hasattr(event, 'reply'),
+                'filter': redact(_command_filter(command)),
+            }, default=str))
+
+
+class DatabaseRouter(object):
+    """Maps database names to Mongo clients, one client per cluster.
+
+    The default cluster is the flask_pymongo client (MONGO_URI). Additional
+    clusters are named in MONGO_CLUSTERS and databases are assigned to them
+    with MONGO_DB_CLUSTERS. All clients share the pool settings in Config.
+    With SNAPSHOT_DIR set, read-only access to the databases in the snapshot
+    is served from it instead (see api.snapshot).
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._db_clusters = {}
+        self.read_preference = ReadPreference.PRIMARY
+        self.snapshot = None
+
+    def init_app(self, app):
+        """Create the Mongo clients for an app from its config, and record
+        the Mongo commands of its requests."""
+        self.connect(app)
+        app.teardown_request(_record_request_commands)
+
+    def connect(self, app):
+        """(Re)create the Mongo clients for an app from its config, e.g. in a
+        newly forked worker."""
+        options = client_options(app.config)
+        mongo.init_app(app, **options)
+        self._clients = {name: MongoClient(uri, **options)
+                         for name, uri in app.config['MONGO_CLUSTERS'].items()}
+        self._db_clusters = dict(app.config['MONGO_DB_CLUSTERS'])
+        self.read_preference = \
+            READ_PREFERENCES[app.config['MONGO_READ_PREFERENCE']]
+        self.snapshot = None
+        if app.config['SNAPSHOT_DIR']:
+            from api.snapshot import SnapshotStore
+            self.snapshot = SnapshotStore(app.config['SNAPSHOT_DIR'])
+
+    def get_client(self, db_name):
+        """Get the Mongo client for the cluster holding a database."""
+        cluster = self._db_clusters.get(db_name)
+        if cluster is None:
+            return mongo.cx
+        return self._clients[cluster]
+
+    def get_db(self, db_name, read_only=True):
+        """Get a database by name.
+
+        Parameters
+        ----------
+        db_name : str
+            Name of Mongo database.
+        read_only : bool, optional (default: True)
+            If True, reads use the MONGO_READ_PREFERENCE (e.g. to send them to
+            secondaries), or the snapshot if it holds the database. Otherwise,
+            the client's default (primary) is used.
+
+        Returns
+        -------
+        db : Mongo DB (or api.snapshot.SnapshotDatabase)
+        """
+        if read_only and self.snapshot is not None and \
+                db_name in self.snapshot:
+            return self.snapshot.get_database(db_name)
+        client = self.get_client(db_name)
+        if read_only:
+            return client.get_database(db_name,
+                                       read_preference=self.read_preference)
+        return client[db_name]
+
+
+def client_options(config):
+    """Get keyword arguments for MongoClient from an app config."""
+    options = {
+        'maxPoolSize': config['MONGO_MAX_POOL_SIZE'],
+        'minPoolSize': config['MONGO_MIN_POOL_SIZE'],
+        'event_listeners': [PoolMetricsListener(), CommandMetricsListener(
+            config['MONGO_SLOW_QUERY_MS'])],
+        # Do not connect until first use, in case the app is loaded before
+        # forking (PyMongo is not fork-safe)
+        'connect': False,
+    }
+    if config['MONGO_WAIT_QUEUE_TIMEOUT_MS']:
+        options['waitQueueTimeoutMS'] = config['MONGO_WAIT_QUEUE_TIMEOUT_MS']
+    return options
+
+
+def request_mongo_stats():
+    """Get the Mongo commands run so far for the current request.
+
+    Returns
+    -------
+    stats : dict
+        'commands' (number of commands), 'seconds' (their total time) and
+        'slowest' (None, or a dict with the 'command' name, 'collection' and
+        'seconds' of the slowest command).
+    """
+    return g.get('mongo_stats') or {'commands': 0, 'seconds': 0.0,
+                                    'slowest': None}
+
+
+def redact(value):
+    """Replace the values in a query filter (or pipeline) with '?', keeping
+    its field names and operators."""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and \
+            any(isinstance(item, (dict, list, tuple)) for item in value):
+        return [redact(item) for item in value]
+    return None if value is None else '?'
+
+
+def _command_filter(command):
+    """Get the filter (or pipeline) of a command document, if it has one."""
+    for field in FILTER_FIELDS:
+        if field in command:
+            return command[field]
+    return None
+
+
+def _collection(command_name, command):
+    """Get the collection a command runs on, if any."""
+    collection = command.get(command_name)
+    return collection if isinstance(collection, str) else None
+
+
+def _record_request_commands(error=None):  # pylint: disable=unused-argument
+    """Record the Mongo commands of a finished request in the metrics store
+    ('mongo.request.commands' counter and 'mongo.request.time' timer,
+    labelled by endpoint)."""
+    stats = g.get('mongo_stats')
+    if stats is None:
+        return
+    metrics.increment('mongo.request.commands', stats['commands'],
+                      label=request.endpoint)
+    metrics.observe('mongo.request.time', stats['seconds'],
+                    label=request.endpoint)
+
+
+def _address(address):
+    """Format a (host, port) server address."""
+    return '%s:%s' % address
+
+
+databases = DatabaseRouter()  # pylint: disable=invalid-name
+
+
+def get_db(db_name, read_only=True):
+    """Get a database by name from the client for its cluster. See
+    DatabaseRouter.get_db."""
+    return databases.get_db(db_name, read_only=read_only)
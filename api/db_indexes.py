@@ -0,0 +1,204 @@
+"""Declared Mongo indexes that the routes rely on, with functions to check
+the MINE and KEGG databases against them and to build any that are missing.
+Run with "flask check-indexes" (add --build to build missing indexes)."""
+
+import logging
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo.errors import OperationFailure
+
+from api.database import get_db
+from api.query_guard import index_name
+
+#: Indexes expected in every MINE database, by collection
+MINE_INDEXES = {
+    'compounds': [
+        [('MINE_id', 1)],
+        [('Inchikey', 1)],
+        [('Names', 1)],
+        [('Names', 'text')],
+        [('Mass', 1)],
+        # Mass query of the metabolomics searches, with its filters
+        [('Charge', 1), ('Halogenated', 1), ('Mass', 1), ('logP', 1)],
+        [('Generation', 1)],
+        [('DB_links.KEGG', 1)],
+        [('DB_links.Model_SEED', 1)],
+        [('len_RDKit', 1)],
+        [('RDKit', 1)],
+    ],
+    'reactions': [
+        [('Reactants.c_id', 1)],
+        [('Products.c_id', 1)],
+        [('Operators', 1)],
+    ],
+    'operators': [
+        [('Name', 1)],
+    ],
+}
+
+#: Indexes expected in the KEGG database, by collection
+KEGG_INDEXES = {
+    'models': [
+        [('_id', 'text'), ('Name', 'text')],
+    ],
+}
+
+
+def check_indexes(db, spec):
+    """Compare the indexes of a database against a declared specification.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        Database to check.
+    spec : dict
+        Maps collection names to lists of index keys (lists of (field,
+        direction) tuples), as in MINE_INDEXES.
+
+    Returns
+    -------
+    report : dict
+        Maps each collection name to a dict with 'missing' (list of index
+        keys in spec but not in db) and 'unused' (list of names of indexes
+        in db that have not been used since the server started, or None if
+        index usage stats are not available).
+    """
+    report = {}
+    for collection, indexes in spec.items():
+        existing = db[collection].index_information()
+        report[collection] = {
+            'missing': [keys for keys in indexes
+                        if not _has_index(existing, keys)],
+            'unused': _unused_indexes(db[collection]),
+        }
+    return report
+
+
+def build_indexes(db, collection, indexes, logger=None):
+    """Build indexes on a collection, logging how long each one took.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        Database containing the collection.
+    collection : str
+        Name of the collection to index.
+    indexes : list
+        Index keys (lists of (field, direction) tuples) to build.
+    logger : logging.Logger, optional (default: None)
+        Logger for build times. Defaults to this module's logger.
+    """
+    logger = logger or logging.getLogger(__name__)
+    for keys in indexes:
+        start = time.perf_counter()
+        db[collection].create_index(keys, background=True)
+        logger.info('Built index %s on %s.%s in %.1f s', index_name(keys),
+                    db.name, collection, time.perf_counter() - start)
+
+
+def verify_all(app, build=False):
+    """Check every configured database against the declared indexes.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        App whose config lists the MINE databases (MINE_DB_NAMES) and the
+        KEGG database (KEGG_DB_NAME).
+    build : bool, optional (default: False)
+        If True, build any missing indexes.
+
+    Returns
+    -------
+    reports : dict
+        Maps database names to the reports from check_indexes.
+    """
+    specs = {name: MINE_INDEXES for name in app.config['MINE_DB_NAMES']}
+    specs[app.config['KEGG_DB_NAME']] = KEGG_INDEXES
+
+    reports = {}
+    for db_name, spec in specs.items():
+        db = get_db(db_name, read_only=False)
+        reports[db_name] = report = check_indexes(db, spec)
+        for collection, status in report.items():
+            for keys in status['missing']:
+                app.logger.warning('Missing index %s on %s.%s',
+                                   index_name(keys), db_name, collection)
+            for name in status['unused'] or []:
+                app.logger.info('Unused index %s on %s.%s', name, db_name,
+                                collection)
+            if build and status['missing']:
+                build_indexes(db, collection, status['missing'], app.logger)
+    return reports
+
+
+def start_startup_check(app):
+    """Check (and optionally build) indexes in a background thread.
+
+    Runs according to the INDEX_CHECK_ON_STARTUP config setting: False to
+    skip, 'report' to log missing and unused indexes or 'build' to also build
+    the missing ones. Errors are logged rather than raised, so an unreachable
+    database does not stop the app from starting. Skipped when serving from
+    a snapshot (SNAPSHOT_DIR), which has its own indexes.
+    """
+    mode = app.config['INDEX_CHECK_ON_STARTUP']
+    if not mode or app.config['SNAPSHOT_DIR']:
+        return None
+
+    def run():
+        with app.app_context():
+            try:
+                verify_all(app, build=(mode == 'build'))
+            except Exception:  # pylint: disable=broad-except
+                app.logger.exception('Startup index check failed')
+
+    thread = threading.Thread(target=run, name='index-check', daemon=True)
+    thread.start()
+    return thread
+
+
+@click.command('check-indexes')
+@click.option('--build', is_flag=True,
+              help='Build missing indexes (as background builds).')
+@with_appcontext
+def check_indexes_command(build):
+    """Report missing and unused indexes in all configured databases."""
+    reports = verify_all(current_app, build=build)
+    for db_name, report in reports.items():
+        for collection, status in report.items():
+            for keys in status['missing']:
+                click.echo(f'{db_name}.{collection}: missing '
+                           f'{index_name(keys)}')
+            for name in status['unused'] or []:
+                click.echo(f'{db_name}.{collection}: unused {name}')
+
+
+def _has_index(existing, keys):
+    """Check whether index keys are covered by one of the existing indexes."""
+    text_fields = {field for field, direction in keys if direction == 'text'}
+    for info in existing.values():
+        if text_fields:
+            if set(info.get('weights', {})) == text_fields:
+                return True
+        elif _normalize(info['key']) == _normalize(keys):
+            return True
+    return False
+
+
+def _normalize(keys):
+    """Make index keys comparable (Mongo may store directions as floats)."""
+    return [(field, float(direction)) if isinstance(direction, (int, float))
+            else (field, direction) for field, direction in keys]
+
+
+def _unused_indexes(collection):
+    """Get names of indexes with no recorded use, or None if unavailable."""
+    try:
+        stats = collection.aggregate([{'$indexStats': {}}])
+        return sorted(x['name'] for x in stats
+                      if x['accesses']['ops'] == 0 and x['name'] != '_id_')
+    except OperationFailure:
+        return None
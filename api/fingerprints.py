@@ -0,0 +1,368 @@
+"""In-memory index of the structural fingerprints of MINE databases, for
+batch similarity searches. Fingerprints are packed into bit arrays, so that
+the Tanimoto coefficients of many queries against many compounds are
+computed a block of compounds at a time with a matrix product, instead of
+one query and one compound at a time."""
+
+import numpy as np
+
+from api.index_refresh import IndexCache
+from api.queries import default_projection
+from api.timing import phase, timed
+
+#: Number of bits of each fingerprint type (as computed by RDKit)
+FP_BITS = {'RDKit': 2048, 'MACCS': 167}
+
+#: Bytes of the unpacked fingerprints of each block of the Tanimoto matrix
+BLOCK_BYTES = 32 * 2 ** 20
+
+#: Number of set bits in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class FingerprintIndex(object):
+    """Fingerprints of many compounds, packed into bits and sorted by their
+    number of set bits.
+
+    Parameters
+    ----------
+    ids : list
+        Compound _ids.
+    fingerprints : list
+        Fingerprint of each compound, as a list of the indices of its set
+        bits.
+    n_bits : int
+        Length of the fingerprints.
+
+    Attributes
+    ----------
+    packed : numpy.ndarray
+        Fingerprints (compounds x bytes, uint8), sorted by counts.
+    counts : numpy.ndarray
+        Number of set bits of each row, in increasing order.
+    ids : list
+        _id of the compound in each row.
+    """
+
+    def __init__(self, ids, fingerprints, n_bits):
+        counts = np.array([len(fp) for fp in fingerprints], dtype=np.int32)
+        order = np.argsort(counts, kind='stable')
+        self.n_bits = n_bits
+        self.ids = [ids[i] for i in order]
+        self.counts = counts[order]
+        self.packed = pack([fingerprints[i] for i in order], n_bits)
+
+    @classmethod
+    def from_db(cls, db, fp_type='RDKit'):
+        """Load the fingerprints of all compounds in a MINE database.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            Contains compound documents with fingerprints.
+        fp_type : str, optional (default: 'RDKit')
+            Fingerprint type, 'RDKit' or 'MACCS'.
+
+        Returns
+        -------
+        index : FingerprintIndex
+        """
+        query, projection = fingerprints_query(fp_type)
+        ids, fingerprints = _fingerprints(db.compounds.find(query, projection),
+                                          fp_type)
+        return cls(ids, fingerprints, FP_BITS[fp_type])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def updated(self, ids, fingerprints, removed=()):
+        """Get a new index with added or changed fingerprints, inserted in
+        the rows of their counts.
+
+        Parameters
+        ----------
+        ids : list
+            _ids of compounds with new fingerprints.
+        fingerprints : list
+            Fingerprint of each compound, as a list of the indices of its set
+            bits.
+        removed : set, optional (default: ())
+            _ids of compounds whose fingerprints were removed.
+
+        Returns
+        -------
+        index : FingerprintIndex
+        """
+        added = FingerprintIndex(ids, fingerprints, self.n_bits)
+        dropped = set(removed).union(ids)
+        keep = np.fromiter((_id not in dropped for _id in self.ids),
+                           dtype=bool, count=len(self.ids))
+        kept_ids = np.array(self.ids, dtype=object)[keep]
+        counts, packed = self.counts[keep], self.packed[keep]
+
+        # Insert after the rows with the same counts, as a stable sort would
+        rows = np.searchsorted(counts, added.counts, side='right')
+        index = FingerprintIndex([], [], self.n_bits)
+        index.ids = np.insert(kept_ids, rows,
+                              np.array(added.ids, dtype=object)).tolist()
+        index.counts = np.insert(counts, rows, added.counts)
+        index.packed = np.insert(packed, rows, added.packed, axis=0)
+        return index
+
+    def search(self, queries, min_tc=0.7, limit=-1):
+        """Find the rows similar to each of some query fingerprints.
+
+        Only rows whose number of set bits allows a Tanimoto coefficient of
+        min_tc are compared (as in minedatabase.queries.similarity_search),
+        in blocks of rows for all queries at once.
+
+        Parameters
+        ----------
+        queries : numpy.ndarray
+            Packed query fingerprints (see pack).
+        min_tc : float, optional (default: 0.7)
+            Minimum Tanimoto coefficient of hits.
+        limit : int, optional (default: -1)
+            Maximum number of hits of each query (all if -1).
+
+        Returns
+        -------
+        hits : list
+            For each query, a list of (row, Tanimoto coefficient) pairs, by
+            decreasing coefficient (then by row).
+        """
+        q_counts = popcount(queries)
+        if not len(q_counts):
+            return []
+        # Start with no hits, for queries without rows in their count window
+        rows = [[np.empty(0, dtype=np.intp)] for _ in q_counts]
+        scores = [[np.empty(0)] for _ in q_counts]
+        lo = np.searchsorted(self.counts, min_tc * q_counts.min())
+        hi = np.searchsorted(self.counts, q_counts.max() / min_tc
+                             if min_tc > 0 else np.inf, side='right')
+
+        for start, tanimoto in tanimoto_blocks(queries, self.packed[lo:hi],
+                                               q_counts, self.counts[lo:hi]):
+            counts = self.counts[lo + start:lo + start + tanimoto.shape[1]]
+            for i, q_count in enumerate(q_counts):
+                # Same size bounds as the Mongo query of similarity_search
+                valid = (counts >= min_tc * q_count) & \
+                    (counts <= q_count / min_tc if min_tc > 0 else True)
+                hit = np.flatnonzero(valid & (tanimoto[i] >= min_tc))
+                rows[i].append(hit + lo + start)
+                scores[i].append(tanimoto[i, hit])
+        return [_ranked(np.concatenate(q_rows), np.concatenate(q_scores),
+                        limit) for q_rows, q_scores in zip(rows, scores)]
+
+
+class FingerprintCache(IndexCache):
+    """Keeps a FingerprintIndex for each (MINE database, fingerprint type),
+    built on first use (see api.index_refresh.IndexCache)."""
+
+    index_class = FingerprintIndex
+    name = 'fingerprints'
+
+    def compounds(self, fp_type):
+        return fingerprints_query(fp_type)
+
+    def apply(self, index, changes, fp_type):
+        return index.updated(*_fingerprints(changes.docs, fp_type),
+                             removed=changes.removed)
+
+    def get_index(self, db, fp_type='RDKit'):
+        """Get the fingerprint index of a MINE database, building it if
+        needed."""
+        return super().get_index(db, fp_type)
+
+    def find_index(self, db, fp_type='RDKit'):
+        """Get the fingerprint index of a MINE database for a search, or None
+        (see api.index_refresh.IndexCache.find_index)."""
+        return super().find_index(db, fp_type)
+
+
+def batch_similarity_search(db, structures, min_tc=0.7, limit=-1,
+                            mode='database', fp_type='RDKit'):
+    """Find the compounds similar to each of many structures, or the
+    similarities among the structures themselves.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        MINE database to search (unused in 'queries' mode).
+    structures : list
+        Molecules in Molfile or SMILES format.
+    min_tc : float, optional (default: 0.7)
+        Minimum Tanimoto coefficient of hits.
+    limit : int, optional (default: -1)
+        Maximum number of hits of each structure (all if -1).
+    mode : str, optional (default: 'database')
+        'database' to compare the structures to the compounds of db,
+        'queries' to compare them to each other.
+    fp_type : str, optional (default: 'RDKit')
+        Fingerprint type, 'RDKit' or 'MACCS'.
+
+    Returns
+    -------
+    results : list
+        A dict for each structure, in order, with its 'index', 'structure'
+        and 'hits', or an 'error' message if it could not be parsed. Hits
+        are sorted by decreasing 'Tanimoto' coefficient: compound documents
+        (as in similarity search) in 'database' mode, and dicts with the
+        'index' of another structure in 'queries' mode.
+    """
+    results, fingerprints = [], []
+    for i, structure in enumerate(structures):
+        result = {'index': i, 'structure': structure}
+        try:
+            fingerprints.append(fingerprint(structure, fp_type))
+        except (ValueError, TypeError) as error:
+            result['error'] = str(error)
+        results.append(result)
+    parsed = [result for result in results if 'error' not in result]
+    queries = pack(fingerprints, FP_BITS[fp_type])
+
+    if mode == 'queries':
+        index = FingerprintIndex([result['index'] for result in parsed],
+                                 fingerprints, FP_BITS[fp_type])
+        for result, hits in zip(parsed, index.search(queries, min_tc, -1)):
+            hits = [{'index': index.ids[row], 'Tanimoto': score}
+                    for row, score in hits
+                    if index.ids[row] != result['index']]
+            result['hits'] = hits if limit < 0 else hits[:limit]
+        return results
+
+    index = fingerprint_cache.find_index(db, fp_type)
+    if index is None:
+        index = _window_index(db, fingerprints, min_tc, fp_type)
+    with phase('scoring'):
+        matches = index.search(queries, min_tc, limit)
+    ids = list({index.ids[row] for hits in matches for row, _ in hits})
+    docs = {}
+    for start in range(0, len(ids), 1000):
+        chunk = ids[start:start + 1000]
+        for comp in db.compounds.find({'_id': {'$in': chunk}},
+                                      default_projection()):
+            docs[comp['_id']] = comp
+    for result, hits in zip(parsed, matches):
+        result['hits'] = [dict(docs[index.ids[row]], Tanimoto=score)
+                          for row, score in hits if index.ids[row] in docs]
+    return results
+
+
+@timed('rdkit')
+def fingerprint(structure, fp_type='RDKit'):
+    """Get the fingerprint of a structure, as a list of its set bits (as
+    stored in MINE databases).
+
+    Parameters
+    ----------
+    structure : str
+        A molecule in Molfile (with newlines) or SMILES format.
+    fp_type : str, optional (default: 'RDKit')
+        Fingerprint type, 'RDKit' or 'MACCS'.
+
+    Returns
+    -------
+    bits : list
+    """
+    from rdkit.Chem import AllChem
+    if "\n" in structure:
+        mol = AllChem.MolFromMolBlock(str(structure))
+    else:
+        mol = AllChem.MolFromSmiles(str(structure))
+    if not mol:
+        raise ValueError("Unable to parse comp_structure")
+    if fp_type == 'MACCS':
+        return list(AllChem.GetMACCSKeysFingerprint(mol).GetOnBits())
+    return list(AllChem.RDKFingerprint(mol).GetOnBits())
+
+
+def pack(fingerprints, n_bits, chunk_size=10000):
+    """Pack fingerprints (lists of set bit indices) into a uint8 array of
+    fingerprints x bytes."""
+    packed = np.zeros((len(fingerprints), (n_bits + 7) // 8), dtype=np.uint8)
+    for start in range(0, len(fingerprints), chunk_size):
+        chunk = fingerprints[start:start + chunk_size]
+        lengths = [len(fp) for fp in chunk]
+        bits = np.zeros((len(chunk), n_bits), dtype=bool)
+        bits[np.repeat(np.arange(len(chunk)), lengths),
+             np.fromiter((bit for fp in chunk for bit in fp), dtype=np.intp,
+                         count=sum(lengths))] = True
+        packed[start:start + len(chunk)] = np.packbits(bits, axis=1)
+    return packed
+
+
+def popcount(packed):
+    """Number of set bits of each packed fingerprint."""
+    return _POPCOUNT[packed].sum(axis=1, dtype=np.int32)
+
+
+def tanimoto_blocks(queries, packed, q_counts=None, counts=None):
+    """Compute the Tanimoto matrix of queries x packed fingerprints in blocks
+    of packed rows.
+
+    The numbers of shared bits of a block are the product of the unpacked
+    query and block bits, computed by BLAS in float32 (exact for these
+    counts).
+
+    Yields
+    ------
+    start : int
+        First row of packed in the block.
+    tanimoto : numpy.ndarray
+        Tanimoto coefficients (queries x rows of the block).
+    """
+    if q_counts is None:
+        q_counts = popcount(queries)
+    if counts is None:
+        counts = popcount(packed)
+    q_bits = np.unpackbits(queries, axis=1).astype(np.float32)
+    block = max(1, BLOCK_BYTES // (4 * max(q_bits.shape[1], 1)))
+    for start in range(0, len(packed), block):
+        bits = np.unpackbits(packed[start:start + block], axis=1)
+        shared = q_bits.dot(bits.T.astype(np.float32))
+        union = q_counts[:, None] + counts[None, start:start + block] - shared
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tanimoto = shared / union
+        yield start, np.nan_to_num(tanimoto)
+
+
+def fingerprints_query(fp_type):
+    """Get the query and projection of the compounds with a fingerprint."""
+    return {fp_type: {'$exists': True}}, {fp_type: 1}
+
+
+def _fingerprints(comps, fp_type):
+    """Get the _ids and fingerprints of compound documents."""
+    ids, fingerprints = [], []
+    for comp in comps:
+        ids.append(comp['_id'])
+        fingerprints.append(comp[fp_type])
+    return ids, fingerprints
+
+
+def _window_index(db, fingerprints, min_tc, fp_type):
+    """Index the fingerprints of the compounds whose number of set bits
+    allows a Tanimoto coefficient of min_tc with any of some fingerprints,
+    for databases without an index in memory. Uses the same query as
+    minedatabase.queries.similarity_search."""
+    counts = [len(fp) for fp in fingerprints]
+    if not counts:
+        return FingerprintIndex([], [], FP_BITS[fp_type])
+    len_field = 'len_' + fp_type
+    query = {'$and': [{len_field: {'$gte': min_tc * min(counts)}},
+                      {len_field: {'$lte': max(counts) / min_tc}}]}
+    ids, window = _fingerprints(db.compounds.find(query, {fp_type: 1}),
+                                fp_type)
+    return FingerprintIndex(ids, window, FP_BITS[fp_type])
+
+
+def _ranked(rows, scores, limit):
+    """Sort hits by decreasing score (then row), keeping at most limit."""
+    order = np.lexsort((rows, -scores))
+    if limit is not None and limit >= 0:
+        order = order[:limit]
+    return list(zip(rows[order].tolist(), scores[order].tolist()))
+
+
+fingerprint_cache = FingerprintCache()  # pylint: disable=invalid-name
@@ -0,0 +1,444 @@
+"""Incremental refresh of the in-memory compound indexes (quick search,
+autocomplete, MS2 spectra and fingerprints) as MINE databases grow.
+
+Each index is kept with a watermark of what it holds: the highest MINE_id
+it has seen and, on servers that support change streams (replica sets), a
+change stream resume token. A refresh fetches only the compounds with
+higher MINE_ids and those changed since the token, and builds a new version
+of the index from the previous one and these changes. The new version is
+then swapped in, so indexes are never modified while they are searched and
+searches never wait for a refresh, which runs in a background thread.
+
+Metrics (labelled with the cache and database names):
+    index.refresh: timer of index refreshes
+    index.refresh.changes: counter of the compounds applied by refreshes
+    index.rebuilds: counter of full rebuilds
+"""
+
+import logging
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from api.telemetry import metrics
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+#: Number of changed compounds fetched per query
+FETCH_BATCH_SIZE = 1000
+
+#: Change stream events after which an index can no longer be refreshed
+#: incrementally, and is rebuilt
+INVALIDATING_EVENTS = ('drop', 'rename', 'dropDatabase', 'invalidate')
+
+
+class Watermark(object):
+    """What an index holds of a MINE database.
+
+    Attributes
+    ----------
+    mine_id : int
+        Highest MINE_id indexed. Compounds are added to MINE databases with
+        increasing MINE_ids, so the added compounds are those above it.
+    resume_token : dict or None
+        Change stream resume token from before the index was last updated,
+        to find the compounds changed since then. None if the server does
+        not support change streams.
+    """
+
+    def __init__(self, mine_id=-1, resume_token=None):
+        self.mine_id = mine_id
+        self.resume_token = resume_token
+
+
+class CompoundChanges(object):
+    """Compounds added, changed or removed since a watermark.
+
+    Attributes
+    ----------
+    docs : list
+        Added and changed compounds matching the index's query, with its
+        projection (added compounds by increasing MINE_id).
+    removed : set
+        _ids of compounds deleted, or changed so they no longer match the
+        index's query.
+    watermark : Watermark
+        Watermark of an index with these changes applied.
+    """
+
+    def __init__(self, docs, removed, watermark):
+        self.docs = docs
+        self.removed = removed
+        self.watermark = watermark
+
+    def __len__(self):
+        return len(self.docs) + len(self.removed)
+
+
+class RebuildRequired(Exception):
+    """Raised when the changes since a watermark cannot be known (e.g. its
+    change stream can no longer be resumed), so the index must be rebuilt."""
+
+
+class IndexCache(object):
+    """Builds an in-memory index of the compounds of each MINE database (and
+    of any other get_index arguments) on first use and keeps it, refreshing
+    it at most once every `refresh_interval` seconds.
+
+    Refreshes run in a background thread, which builds a new version of the
+    index from the previous one and the compounds changed since its
+    watermark (see compound_changes) and then swaps it in. Until then,
+    get_index returns the previous version.
+
+    Searches get indexes with find_index, which only keeps indexes of the
+    MINE databases in db_names and never waits for a build: it returns None
+    (and the search queries Mongo instead) while an index is built in the
+    background. get_index builds indexes in the calling thread (e.g. during
+    warm-up).
+
+    Subclasses set index_class, whose from_db(db, *args) class method builds
+    an index of all compounds, and can override compounds (which compounds
+    and fields are indexed) and apply (how changes are applied to an index).
+    By default, apply returns index.updated(changes.docs, changes.removed),
+    which must return a new index and leave the original unchanged.
+
+    Attributes
+    ----------
+    refresh_interval : float
+        Minimum number of seconds between refreshes of an index.
+    rebuild_interval : float or None
+        Seconds between full rebuilds of an index (in the background), to
+        pick up changed compounds when change streams are not available.
+        None never rebuilds.
+    change_streams : bool
+        Use change streams to find changed compounds, where supported.
+    db_names : frozenset or None
+        MINE databases whose indexes find_index keeps in memory (None for
+        all).
+    """
+
+    index_class = None
+
+    #: Name of the cache in metrics and logs
+    name = 'index'
+
+    # Settings shared by all index caches (see init_app)
+    refresh_interval = 60
+    rebuild_interval = None
+    change_streams = True
+    db_names = None
+
+    def __init__(self, refresh_interval=None):
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._entries = {}
+
+    @staticmethod
+    def init_app(app):
+        """Read the refresh settings of all index caches from a Flask app's
+        config."""
+        IndexCache.refresh_interval = app.config['INDEX_REFRESH_INTERVAL']
+        IndexCache.rebuild_interval = app.config['INDEX_REBUILD_INTERVAL']
+        IndexCache.change_streams = app.config['INDEX_CHANGE_STREAMS']
+        IndexCache.db_names = frozenset(app.config['MINE_DB_NAMES'])
+
+    def clear(self):
+        """Drop all indexes."""
+        with self._lock:
+            self._entries = {}
+
+    def compounds(self, *args):  # pylint: disable=unused-argument
+        """Get the query and projection of the compounds an index holds."""
+        return {}, None
+
+    def apply(self, index, changes, *args):  # pylint: disable=unused-argument
+        """Get a new version of an index with changes applied."""
+        return index.updated(changes.docs, changes.removed)
+
+    def get_index(self, db, *args):
+        """Get the index of a MINE database, building it if needed, and start
+        a background refresh if it is due.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            MINE database.
+        *args
+            Other arguments of index_class.from_db.
+
+        Returns
+        -------
+        index : index_class
+        """
+        key = (db.name,) + args
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._refresh_if_due(db, args, entry)
+            return entry['index']
+
+        # Build each index in one thread at a time, without blocking
+        # searches of other indexes
+        with self._build_lock(key):
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._build(db, args)
+        return entry['index']
+
+    def find_index(self, db, *args):
+        """Get the index of a MINE database for a search, and start a
+        background refresh if it is due.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            MINE database.
+        *args
+            Other arguments of index_class.from_db.
+
+        Returns
+        -------
+        index : index_class or None
+            None if the database is not in db_names, or if its index is being
+            built (in a background thread, started if needed), in which case
+            the search should query Mongo.
+        """
+        if self.db_names is not None and db.name not in self.db_names:
+            return None
+        key = (db.name,) + args
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._refresh_if_due(db, args, entry)
+            return entry['index']
+
+        build_lock = self._build_lock(key)
+        # Skip if another thread is building it
+        if build_lock.acquire(blocking=False):
+            threading.Thread(target=self._build_locked,
+                             args=(db, args, build_lock),
+                             name=f'{self.name}-build', daemon=True).start()
+        return None
+
+    def refresh(self, db, *args):
+        """Refresh the index of a MINE database now (building it if needed),
+        waiting for any refresh in progress.
+
+        Returns
+        -------
+        index : index_class
+            The new version of the index.
+        """
+        key = (db.name,) + args
+        with self._build_lock(key):
+            if key not in self._entries:
+                return self._build(db, args)['index']
+            return self._refresh(db, args)['index']
+
+    def _build_lock(self, key):
+        """Get the lock held while building or refreshing an index."""
+        with self._lock:
+            return self._build_locks.setdefault(key, threading.Lock())
+
+    def _refresh_if_due(self, db, args, entry):
+        """Start refreshing an index in a background thread, if it is due and
+        no other thread is building or refreshing it."""
+        if time.monotonic() - entry['updated'] < self.refresh_interval:
+            return
+        build_lock = self._build_lock((db.name,) + args)
+        if build_lock.acquire(blocking=False):
+            threading.Thread(target=self._refresh_locked,
+                             args=(db, args, build_lock),
+                             name=f'{self.name}-refresh', daemon=True).start()
+
+    def _build_locked(self, db, args, build_lock):
+        """Build an index in a background thread, then release its lock."""
+        try:
+            if (db.name,) + args not in self._entries:
+                self._build(db, args)
+        except Exception:  # pylint: disable=broad-except
+            # Searches keep querying Mongo, and the next one retries
+            logger.exception('Building the %s index of %s failed', self.name,
+                             db.name)
+        finally:
+            build_lock.release()
+
+    def _refresh_locked(self, db, args, build_lock):
+        """Refresh an index in a background thread, then release its lock."""
+        try:
+            self._refresh(db, args)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Refreshing the %s index of %s failed',
+                             self.name, db.name)
+            # Keep the previous version, and retry after refresh_interval
+            key = (db.name,) + args
+            with self._lock:
+                if key in self._entries:
+                    self._entries[key] = dict(self._entries[key],
+                                              updated=time.monotonic())
+        finally:
+            build_lock.release()
+
+    def _build(self, db, args):
+        """Index all compounds of a database. Call with its build lock."""
+        # Take the watermark before the scan, so compounds changed during it
+        # are fetched again by the next refresh
+        start = time.perf_counter()
+        watermark = Watermark(top_mine_id(db), change_stream_token(db)
+                              if self.change_streams else None)
+        entry = {'index': self.index_class.from_db(db, *args),
+                 'watermark': watermark, 'updated': time.monotonic(),
+                 'built': time.monotonic()}
+        with self._lock:
+            self._entries[(db.name,) + args] = entry
+        metrics.increment('index.rebuilds', label=self._label(db))
+        logger.info('Built the %s index of %s in %.1f s', self.name, db.name,
+                    time.perf_counter() - start)
+        return entry
+
+    def _refresh(self, db, args):
+        """Apply the compounds changed since an index's watermark to a new
+        version of the index, or rebuild it if due. Call with its build
+        lock."""
+        key = (db.name,) + args
+        entry = self._entries[key]
+        if self.rebuild_interval is not None and \
+                time.monotonic() - entry['built'] >= self.rebuild_interval:
+            return self._build(db, args)
+
+        start = time.perf_counter()
+        query, projection = self.compounds(*args)
+        try:
+            changes = compound_changes(db, entry['watermark'], query,
+                                       projection)
+        except RebuildRequired as error:
+            logger.warning('Rebuilding the %s index of %s: %s', self.name,
+                           db.name, error)
+            return self._build(db, args)
+
+        index = entry['index']
+        if changes:
+            index = self.apply(index, changes, *args)
+        entry = dict(entry, index=index, watermark=changes.watermark,
+                     updated=time.monotonic())
+        with self._lock:
+            self._entries[key] = entry
+        metrics.observe('index.refresh', time.perf_counter() - start,
+                        label=self._label(db))
+        metrics.increment('index.refresh.changes', len(changes),
+                          label=self._label(db))
+        return entry
+
+    def _label(self, db):
+        """Metrics label of an index."""
+        return f'{self.name}:{db.name}'
+
+
+def compound_changes(db, watermark, query=None, projection=None):
+    """Get the compounds of a MINE database added or changed since a
+    watermark.
+
+    Added compounds are found by MINE_id, and changed ones with the
+    watermark's change stream, if it has one. Without change streams,
+    changes to compounds that were already indexed are not seen.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        MINE database.
+    watermark : Watermark
+        What the index holds.
+    query : dict, optional (default: None)
+        Filter of the compounds the index holds.
+    projection : dict, optional (default: None)
+        Fields of the compounds the index needs.
+
+    Returns
+    -------
+    changes : CompoundChanges
+
+    Raises
+    ------
+    RebuildRequired
+        If the changes cannot be known (the change stream cannot be resumed,
+        or the collection was dropped).
+    """
+    query = query or {}
+    resume_token = watermark.resume_token
+    changed_ids = []
+    if resume_token is not None:
+        changed_ids, resume_token = _changed_ids(db, resume_token)
+
+    docs, removed = {}, set(changed_ids)
+    for start in range(0, len(changed_ids), FETCH_BATCH_SIZE):
+        batch = changed_ids[start:start + FETCH_BATCH_SIZE]
+        for comp in db.compounds.find(
+                {'$and': [query, {'_id': {'$in': batch}}]}, projection):
+            docs[comp['_id']] = comp
+            removed.discard(comp['_id'])
+
+    # Compounds added since the watermark, up to the highest MINE_id now
+    mine_id = top_mine_id(db, watermark.mine_id)
+    if mine_id > watermark.mine_id:
+        new_query = {'$and': [query, {'MINE_id': {'$gt': watermark.mine_id,
+                                                  '$lte': mine_id}}]}
+        for comp in db.compounds.find(new_query, projection).sort('MINE_id',
+                                                                  1):
+            docs.pop(comp['_id'], None)
+            docs[comp['_id']] = comp
+
+    return CompoundChanges(list(docs.values()), removed,
+                           Watermark(mine_id, resume_token))
+
+
+def top_mine_id(db, above=-1):
+    """Get the highest MINE_id in a database (or `above` if none is higher).
+    """
+    for comp in db.compounds.find({'MINE_id': {'$gt': above}},
+                                  {'MINE_id': 1}).sort('MINE_id', -1).limit(1):
+        return comp['MINE_id']
+    return above
+
+
+def change_stream_token(db):
+    """Get a resume token for the changes to a database's compounds from now
+    on, or None if the server does not support change streams (e.g. a
+    standalone server)."""
+    try:
+        with db.compounds.watch(max_await_time_ms=1) as stream:
+            stream.try_next()
+            return stream.resume_token
+    except OperationFailure:
+        return None
+
+
+def _changed_ids(db, resume_token):
+    """Get the _ids of the compounds inserted, changed or deleted after a
+    resume token, in order, and the token after the last change.
+
+    Raises
+    ------
+    RebuildRequired
+        If the change stream cannot be resumed.
+    """
+    ids, seen = [], set()
+    try:
+        with db.compounds.watch([{'$project': {'operationType': 1,
+                                               'documentKey': 1}}],
+                                resume_after=resume_token,
+                                max_await_time_ms=1) as stream:
+            while stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    break
+                event = change['operationType']
+                if event in INVALIDATING_EVENTS:
+                    raise RebuildRequired(f'{event} of the compounds')
+                _id = change['documentKey']['_id']
+                if _id not in seen:
+                    seen.add(_id)
+                    ids.append(_id)
+            return ids, stream.resume_token
+    except PyMongoError as error:
+        raise RebuildRequired(f'cannot resume change stream ({error})')
@@ -0,0 +1,206 @@
+"""Non-blocking logging pipeline. Request threads only put log records on a
+bounded queue (dropping them if it is full), and a background listener
+thread formats them as JSON lines and writes and rotates the log files.
+Records of noisy loggers (e.g. RDKit parse errors) are sampled before they
+are queued.
+
+Metrics:
+    logging.emit: timer of the time spent logging on the calling thread
+    logging.dropped: counter of records dropped because the queue was full
+    logging.sampled_out: counter of records dropped by sampling (labelled
+        with the sampled logger)
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from api.telemetry import metrics
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+                            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': f'{record.pathname}:{record.lineno}',
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of the records of some loggers.
+
+    Parameters
+    ----------
+    rates : dict
+        Fraction of records kept (e.g. 0.01 keeps 1 in 100), by logger name.
+        Applies to child loggers too.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._counters = {name: itertools.count() for name in rates}
+
+    def filter(self, record):
+        name = self._sampled_logger(record.name)
+        if name is None:
+            return True
+        rate = self.rates[name]
+        every = max(1, round(1 / rate)) if rate > 0 else None
+        if every is not None and next(self._counters[name]) % every == 0:
+            return True
+        metrics.increment('logging.sampled_out', label=name)
+        return False
+
+    def _sampled_logger(self, logger_name):
+        """Get the sampled logger that a logger is (or is a child of)."""
+        for name in self.rates:
+            if logger_name == name or logger_name.startswith(name + '.'):
+                return name
+        return None
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never waits for the queue, and times itself.
+
+    Records are formatted by the listener, so only their message arguments
+    are merged here (in case they change after the call).
+    """
+
+    def emit(self, record):
+        start = time.perf_counter()
+        super().emit(record)
+        metrics.observe('logging.emit', time.perf_counter() - start)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('logging.dropped')
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LoggerForwarder(logging.Handler):
+    """Passes records to the handlers of another logger (e.g. gunicorn's
+    error log), at that logger's level."""
+
+    def __init__(self, logger):
+        super().__init__()
+        self.logger = logger
+
+    def emit(self, record):
+        if record.levelno < self.logger.getEffectiveLevel():
+            return
+        for handler in self.logger.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class LogPipeline(object):
+    """Routes the app's logs (and all other logs reaching the root logger)
+    through a queue to a background listener thread.
+
+    The listener writes JSON lines to LOG_DIR/mine-server.log (rotated at
+    LOG_FILE_MAX_BYTES) and warnings to stderr, or to gunicorn's error log
+    when running under gunicorn.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handler = None
+        self.listener = None
+        self._targets = []
+        self._queue_size = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._restart)
+        atexit.register(self.stop)
+
+    def init_app(self, app):
+        """Replace the root and app logger handlers with the queue."""
+        config = app.config
+        os.makedirs(config['LOG_DIR'], exist_ok=True)
+        file_handler = RotatingFileHandler(
+            os.path.join(config['LOG_DIR'], 'mine-server.log'),
+            maxBytes=config['LOG_FILE_MAX_BYTES'],
+            backupCount=config['LOG_FILE_BACKUP_COUNT'])
+        file_handler.setFormatter(JsonFormatter())
+        file_handler.setLevel(logging.DEBUG)
+
+        gunicorn_logger = logging.getLogger('gunicorn.error')
+        if gunicorn_logger.handlers:
+            console_handler = LoggerForwarder(gunicorn_logger)
+        else:
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(logging.WARNING)
+
+        with self._lock:
+            self.stop()
+            self._targets = [file_handler, console_handler]
+            self._queue_size = config['LOG_QUEUE_SIZE']
+            self.handler = NonBlockingQueueHandler(
+                queue.Queue(self._queue_size))
+            self.handler.addFilter(SamplingFilter(config['LOG_SAMPLING']))
+            self._start()
+
+        root = logging.getLogger()
+        root.handlers = [self.handler]
+        app.logger.handlers = []
+        app.logger.propagate = True
+        app.logger.setLevel(logging.DEBUG)
+
+    def stop(self):
+        """Stop the listener after it has written the queued records."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _start(self):
+        """Start a listener thread for the handler's queue."""
+        self.listener = QueueListener(self.handler.queue, *self._targets,
+                                      respect_handler_level=True)
+        self.listener.start()
+
+    def _restart(self):
+        """Start a new queue and listener in a forked child, which does not
+        inherit the listener thread."""
+        if self.handler is None:
+            return
+        self._lock = threading.Lock()
+        self.handler.queue = queue.Queue(self._queue_size)
+        self._start()
+
+
+def capture_rdkit_logs():
+    """Send RDKit's messages to Python logging (the 'rdkit' logger), so that
+    they go through the pipeline and are sampled, rather than being written
+    to stderr directly."""
+    from rdkit import rdBase
+    rdBase.LogToPythonLogger()
+    rdkit_logger = logging.getLogger('rdkit')
+    rdkit_logger.handlers = []
+    rdkit_logger.propagate = True
+
+
+log_pipeline = LogPipeline()  # pylint: disable=invalid-name
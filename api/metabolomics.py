@@ -0,0 +1,666 @@
+"""Server-side versions of the minedatabase metabolomics searches. Peaks are
+parsed as the datafile is read (see iter_peaks) and searched one at a time,
+and mass matching is still done by minedatabase; KEGG model lookups
+are replaced with the cached sets in api.models and MS2 spectra are scored
+with the spectra index in api.spectra. minedatabase.metabolomics loads RDKit
+and pandas, and api.spectra loads NumPy, so they are imported on first use
+rather than with this module."""
+
+import functools
+import heapq
+import io
+import itertools
+import os
+import re
+import time
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                as_completed, wait)
+from xml.etree import ElementTree
+
+from api.models import model_cache
+from api.properties import HALOGEN_FIELD, is_halogenated
+
+#: Fields fetched to rank hits before fetching the full documents of the best
+RANK_PROJECTION = {'Mass': 1, 'Formula': 1, 'Generation': 1}
+
+#: Fields added to hits by the searches
+SEARCH_FIELDS = ('adduct', 'peak_name', 'native_hit', 'Spectral_score')
+
+
+@functools.lru_cache(maxsize=None)
+def read_adduct_names(filepath):
+    """Get the names of the adducts in an adduct file (cached, since the
+    adduct files do not change while the server runs).
+
+    Parameters
+    ----------
+    filepath : str
+        Path to adduct file.
+
+    Returns
+    -------
+    adducts : tuple
+        Names of adducts in file.
+    """
+    from minedatabase import metabolomics
+    return tuple(metabolomics.read_adduct_names(filepath))
+
+
+def read_peaks(text, text_type, charge, ms2=False):
+    """Parse all peaks in a metabolomics datafile (see iter_peaks).
+
+    Returns
+    -------
+    peaks : list
+        Peak objects, one for each peak in the datafile.
+    """
+    return list(iter_peaks(text, text_type, charge, ms2=ms2))
+
+
+def iter_peaks(source, text_type, charge, ms2=False):
+    """Parse the peaks in a metabolomics datafile as they are read.
+
+    Gives the same peaks as the minedatabase read_mgf, read_msp and
+    read_mzxml functions, but only one spectrum at a time is held in memory,
+    so files can be parsed while they are read from a request or disk. Blank
+    lines in 'form' texts are skipped.
+
+    Parameters
+    ----------
+    source : str or file
+        Text as in metabolomics datafile, or a file (opened in binary mode)
+        with the datafile.
+    text_type : str
+        Type of metabolomics datafile ('form', 'mgf', 'mzXML' or 'msp'). For
+        'form', m/z values are separated by newlines or, if ms2 is True, the
+        first line is the precursor m/z and each other line is "m/z intensity".
+    charge : bool
+        Positive or negative mode (True for positive, False for negative).
+    ms2 : bool, optional (default: False)
+        Whether a 'form' text contains a MS2 peak list.
+
+    Returns
+    -------
+    peaks : generator
+        Yields a Peak object for each peak in the datafile.
+    """
+    if text_type == 'form':
+        if ms2:
+            return _iter_form_ms2(_iter_lines(source), charge)
+        return _iter_form(_iter_lines(source), charge)
+    if text_type == 'mgf':
+        return _iter_mgf(_iter_lines(source), charge)
+    if text_type in ('mzXML', 'mzxml'):
+        return _iter_mzxml(source)
+    if text_type == 'msp':
+        return _iter_msp(_iter_lines(source), charge)
+    raise IOError('%s files not supported' % text_type)
+
+
+def ms_adduct_search(db, keggdb, text, text_type, ms_params, top_k=None):
+    """Search for compound-adducts matching precursor mass.
+
+    Same inputs and outputs as minedatabase.metabolomics.ms_adduct_search,
+    except that compounds are scored against the KEGG model (in keggdb) with
+    the cached model compound sets.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        Contains compound documents to search.
+    keggdb : Mongo DB
+        Contains models with associated compound documents.
+    text : str or file
+        Text as in metabolomics datafile for specific peak, or a binary file
+        with the datafile (parsed as it is read, see iter_peaks).
+    text_type : str
+        Type of metabolomics datafile (mgf, mzXML, and msp are supported). If
+        'form', assumes m/z values are separated by newlines.
+    ms_params : dict
+        Search settings, as in minedatabase.metabolomics.ms_adduct_search.
+    top_k : int, optional (default: None)
+        If given, only the top_k best hits of each peak are returned: native
+        compounds first, then by increasing mass error and generation. Hits
+        are ranked as they are found, keeping at most top_k of them, and only
+        their full documents are fetched.
+
+    Returns
+    -------
+    ms_adduct_output : list
+        Compound JSON documents matching ms adduct query.
+    """
+    from minedatabase.metabolomics import Struct
+    if isinstance(ms_params, dict):
+        ms_params = Struct(**ms_params)
+
+    ms_adduct_output = []
+    dataset = _new_dataset(db, keggdb, text_type, ms_params)
+    for peak in iter_peaks(text, text_type, ms_params.charge):
+        if top_k:
+            ranked = _top_ms1_hits(dataset, db, peak, top_k)
+            ms_adduct_output.extend(_fetch_hits(db, ranked,
+                                                dataset.hit_projection))
+            continue
+        _find_hits(dataset, db, peak)
+        for hit in peak.isomers:
+            if 'CFM_spectra' in hit:
+                del hit['CFM_spectra']
+            ms_adduct_output.append(hit)
+
+    return model_cache.score_compounds(keggdb, ms_adduct_output,
+                                       ms_params.models[0], parent_frac=.75,
+                                       reaction_frac=.25)
+
+
+def ms2_search(db, keggdb, text, text_type, ms_params, spectra_index=True,
+               top_k=None):
+    """Search for compounds matching MS2 spectra.
+
+    Same inputs and outputs as minedatabase.metabolomics.ms2_search, except
+    that compounds are scored against the KEGG model (in keggdb) with the
+    cached model compound sets.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        Contains compound documents to search.
+    keggdb : Mongo DB
+        Contains models with associated compound documents.
+    text : str or file
+        Text as in metabolomics datafile for specific peak, or a binary file
+        with the datafile (parsed as it is read, see iter_peaks).
+    text_type : str
+        Type of metabolomics datafile (mgf, mzXML, and msp are supported). If
+        'form', the first line is the precursor m/z and each following line
+        is "m/z intensity".
+    ms_params : dict
+        Search settings, as in minedatabase.metabolomics.ms2_search.
+    spectra_index : bool, optional (default: True)
+        If True, spectra are scored with the in-memory spectra index of db
+        (see api.spectra), which gives the same scores.
+    top_k : int, optional (default: None)
+        If given, only the top_k hits with the best spectral scores (over all
+        peaks) are returned, best first. With the spectra index, hits are
+        ranked as they are found, keeping at most top_k of them, and only
+        their full documents are fetched.
+
+    Returns
+    -------
+    ms_adduct_output : list
+        Compound JSON documents matching ms2 search query.
+    """
+    from minedatabase.metabolomics import Struct
+    if isinstance(ms_params, dict):
+        ms_params = Struct(**ms_params)
+
+    metric = _ms2_metric(ms_params)
+    dataset = _new_dataset(db, keggdb, text_type, ms_params,
+                           exclude=_ms2_exclude(ms_params, spectra_index))
+    peaks = iter_peaks(text, text_type, ms_params.charge, ms2=True)
+    if top_k and spectra_index:
+        ranked, _ = _top_ms2_hits(dataset, db, peaks, ms_params, top_k)
+        ms_adduct_output = _fetch_hits(db, ranked, dataset.hit_projection)
+    else:
+        ms_adduct_output = []
+        for peak in peaks:
+            _find_hits(dataset, db, peak)
+            _score_ms2_peak(db, peak, ms_params, metric, spectra_index)
+            ms_adduct_output.extend(peak.isomers)
+        if top_k:
+            from api.spectra import spectral_sort_key
+            ms_adduct_output = heapq.nlargest(top_k, ms_adduct_output,
+                                              key=spectral_sort_key)
+
+    return model_cache.score_compounds(keggdb, ms_adduct_output,
+                                       ms_params.models[0], parent_frac=.75,
+                                       reaction_frac=.25)
+
+
+def ms2_batch_search(db, keggdb, text, text_type, ms_params, top_k=10,
+                     workers=None, spectra_index=True):
+    """Search for compounds matching each MS2 spectrum in a datafile.
+
+    Spectra are searched in parallel in a pool of threads (mass lookups wait
+    on Mongo and spectra index scoring runs in NumPy, which both release the
+    GIL), and results are yielded as each spectrum finishes.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        Contains compound documents to search.
+    keggdb : Mongo DB
+        Contains models with associated compound documents.
+    text : str or file
+        Text as in metabolomics datafile, with any number of spectra, or a
+        binary file with the datafile. Spectra are parsed as they are needed,
+        so only a few of them are held in memory at a time.
+    text_type : str
+        Type of metabolomics datafile (mgf, mzXML, and msp are supported).
+    ms_params : dict
+        Search settings, as in minedatabase.metabolomics.ms2_search.
+    top_k : int, optional (default: 10)
+        Number of best-scoring compounds returned for each spectrum.
+    workers : int, optional (default: None)
+        Number of threads. If None, uses the ThreadPoolExecutor default
+        (the number of cores plus 4, at most 32).
+        At most twice as many spectra are parsed ahead of the searches.
+    spectra_index : bool, optional (default: True)
+        If True, spectra are scored with the in-memory spectra index of db.
+
+    Returns
+    -------
+    results : generator
+        Yields a dict for each spectrum, as soon as its search finishes,
+        with its position in the datafile ('index'), 'name' and precursor
+        'mz'. 'total_hits' is the number of compounds matching its precursor
+        mass and 'hits' the top_k compounds with the best spectral scores,
+        best first. If the search failed, 'error' has the error message
+        instead. If the datafile cannot be parsed, a last dict with only
+        'error' is yielded.
+    """
+    from minedatabase.metabolomics import Struct
+    if isinstance(ms_params, dict):
+        ms_params = Struct(**ms_params)
+
+    metric = _ms2_metric(ms_params)
+    dataset = _new_dataset(db, keggdb, text_type, ms_params,
+                           exclude=_ms2_exclude(ms_params, spectra_index))
+    peaks = iter_peaks(text, text_type, ms_params.charge, ms2=True)
+
+    def search(peak):
+        if spectra_index:
+            ranked, total_hits = _top_ms2_hits(dataset, db, [peak], ms_params,
+                                               top_k)
+            hits = _fetch_hits(db, ranked, dataset.hit_projection)
+        else:
+            _find_hits(dataset, db, peak)
+            _score_ms2_peak(db, peak, ms_params, metric, spectra_index)
+            hits, total_hits = peak.isomers[:top_k], len(peak.isomers)
+            peak.isomers = []  # free the other hits
+        hits = model_cache.score_compounds(keggdb, hits, ms_params.models[0],
+                                           parent_frac=.75, reaction_frac=.25)
+        return {'total_hits': total_hits, 'hits': hits}
+
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def results():
+        executor = ThreadPoolExecutor(workers, thread_name_prefix='ms2-batch')
+        max_pending = 2 * workers
+        futures = {}
+        try:
+            parse_error = None
+            try:
+                # Parse spectra only as fast as they are searched
+                for i, peak in enumerate(peaks):
+                    futures[executor.submit(search, peak)] = \
+                        {'index': i, 'name': peak.name, 'mz': peak.mz}
+                    if len(futures) >= max_pending:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        yield from _batch_results(futures, done)
+            except (ValueError, IOError, ElementTree.ParseError) as error:
+                parse_error = {'error': 'Invalid datafile: %s' % error}
+            yield from _batch_results(futures, as_completed(futures))
+            if parse_error is not None:
+                yield parse_error
+        finally:
+            # Stop searching if the client stops reading
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    return results()
+
+
+def _batch_results(futures, done):
+    """Yield the results of finished batch searches, removing their
+    futures."""
+    for future in list(done):
+        result = futures.pop(future)
+        try:
+            result.update(future.result())
+        except Exception as error:  # pylint: disable=broad-except
+            result['error'] = str(error)
+        yield result
+
+
+def _ms2_metric(ms_params):
+    """Get the minedatabase scoring function of an MS2 search."""
+    from minedatabase.metabolomics import dot_product, jaccard
+    if ms_params.scoring_function == 'jaccard':
+        return jaccard
+    if ms_params.scoring_function == 'dot product':
+        return dot_product
+    raise ValueError("ms_params['scoring_function'] must be either "
+                     "'jaccard' or 'dot product'.")
+
+
+def _ms2_exclude(ms_params, spectra_index):
+    """Get the hit fields that an MS2 search does not need to fetch."""
+    from api.spectra import SPECTRA_KEYS
+    # The spectra of the charge being searched come from the spectra index
+    if spectra_index:
+        return {SPECTRA_KEYS[bool(ms_params.charge)]}
+    return set()
+
+
+def _score_ms2_peak(db, peak, ms_params, metric, spectra_index):
+    """Score and sort the isomers of a peak against its MS2 spectrum."""
+    from api.spectra import spectra_cache
+    tolerance = _ms2_tolerance(ms_params)
+    if spectra_index:
+        spectra_cache.score_peak(db, peak, ms_params.scoring_function,
+                                 ms_params.energy_level, tolerance)
+    else:
+        peak.score_isomers(metric=metric, energy_level=ms_params.energy_level,
+                           tolerance=tolerance)
+
+
+def _ms2_tolerance(ms_params):
+    """Get the m/z tolerance (in Da) for matching MS2 peaks."""
+    if ms_params.ppm:
+        return 0.005  # default of Peak.score_isomers
+    return float(ms_params.tolerance) / 1000
+
+
+def _new_dataset(db, keggdb, text_type, ms_params, exclude=()):
+    """Create a MetabolomicsDataset with the native compounds of the models
+    in ms_params (defaults to ['eco'])."""
+    from minedatabase.metabolomics import MetabolomicsDataset
+    name = str(text_type) + time.strftime("_%d-%m-%Y_%H:%M:%S",
+                                          time.localtime())
+
+    if not ms_params.models:
+        ms_params.models = ['eco']
+
+    dataset = MetabolomicsDataset(name, ms_params)
+    for field in exclude:
+        dataset.hit_projection.pop(field, None)
+    dataset.native_set = model_cache.get_native_set(db, keggdb,
+                                                    ms_params.models)
+    return dataset
+
+
+def _find_hits(dataset, db, peak):
+    """Find the database hits of one peak, with the adducts for its charge,
+    and add them to the peak (as in MetabolomicsDataset.annotate_peaks)."""
+    for compound, _ in _iter_hits(dataset, db, peak, dataset.hit_projection):
+        peak.total_hits += 1
+        if compound.get('native_hit'):
+            peak.native_hit = True
+        if compound['Generation'] < peak.min_steps:
+            peak.min_steps = compound['Generation']
+        peak.formulas.add(compound['Formula'])
+        peak.isomers.append(compound)
+
+
+def _peak_adducts(dataset, peak):
+    """Get the adducts for the charge of a peak."""
+    positive = peak.charge == '+' or peak.charge == 'Positive' \
+        or (peak.charge and isinstance(peak.charge, bool))
+    negative = peak.charge == '-' or peak.charge == 'Negative' \
+        or (not peak.charge and isinstance(peak.charge, bool))
+
+    if positive:
+        return dataset.pos_adducts
+    if negative:
+        return dataset.neg_adducts
+    raise ValueError('Invalid compound charge specification (charge = %s).'
+                     % peak.charge)
+
+
+def _iter_hits(dataset, db, peak, projection):
+    """Find the database hits of one peak as
+    MetabolomicsDataset.find_db_hits does, but yield them one at a time.
+
+    The halogen filter is part of the query (with the stored halogen flag,
+    see api.properties), like the logP filter, so that filtered compounds
+    are not fetched. Compounds without the flag are filtered by formula.
+
+    Yields
+    ------
+    hit : dict
+        Compound document (with the fields in projection and 'Formula'),
+        with its 'adduct', 'peak_name' and 'native_hit' (if True).
+    mass : float
+        Neutral mass of the peak for the hit's adduct.
+    """
+    adducts = _peak_adducts(dataset, peak)
+    potential_masses = (peak.mz - adducts['f2']) / adducts['f1']
+    if dataset.options.ppm:
+        precision = (dataset.options.tolerance / 100000.) * potential_masses
+    else:
+        precision = dataset.options.tolerance * 0.001
+    upper_bounds = potential_masses + precision
+    lower_bounds = potential_masses - precision
+    projection = dict(projection, Formula=1)
+    if not dataset.options.halogens:
+        projection[HALOGEN_FIELD] = 1
+
+    for i, adduct in enumerate(adducts):
+        query_terms = [{"Mass": {"$gte": float(lower_bounds[i])}},
+                       {"Mass": {"$lte": float(upper_bounds[i])}},
+                       {'Charge': 1 if adduct['f0'] == '[M]+' else 0}]
+        if not dataset.options.halogens:
+            query_terms.append({HALOGEN_FIELD: {'$ne': True}})
+        if hasattr(dataset, 'min_logp'):
+            query_terms += [{"logP": {"$gte": dataset.min_logp}},
+                            {"logP": {"$lte": dataset.max_logp}}]
+        if hasattr(dataset, 'min_kovats'):
+            query_terms += [{"maxKovatsRI": {"$gte": dataset.min_kovats}},
+                            {"minKovatsRI": {"$lte": dataset.max_kovats}}]
+        for compound in db.compounds.find({"$and": query_terms}, projection):
+            if not dataset.options.halogens and \
+                    compound.pop(HALOGEN_FIELD, None) is None and \
+                    is_halogenated(compound['Formula']):
+                continue
+            if compound['_id'] in dataset.native_set:
+                compound['native_hit'] = True
+            compound['adduct'] = adduct['f0']
+            compound['peak_name'] = peak.name
+            yield compound, float(potential_masses[i])
+
+
+def _top_ms1_hits(dataset, db, peak, top_k):
+    """Get the top_k hits of a peak (native compounds first, then by
+    increasing mass error and generation), keeping at most top_k hits in
+    memory. Hits only have the fields needed to rank them."""
+    heap = []
+    hits = _iter_hits(dataset, db, peak, RANK_PROJECTION)
+    for i, (hit, mass) in enumerate(hits):
+        key = (hit.get('native_hit', False), -abs(hit['Mass'] - mass),
+               -hit['Generation'], -i)
+        _push(heap, top_k, key, hit)
+    return _ranked(heap)
+
+
+def _top_ms2_hits(dataset, db, peaks, ms_params, top_k):
+    """Get the top_k hits of some peaks by spectral score, keeping at most
+    top_k hits (and the candidates of one peak) in memory. Hits only have
+    the fields needed to rank them and their 'Spectral_score'.
+
+    Returns
+    -------
+    ranked : list
+        Best hits, best first.
+    total_hits : int
+        Number of hits of all peaks.
+    """
+    from api.spectra import spectra_cache, spectral_sort_key
+    heap, total_hits = [], 0
+    for peak in peaks:
+        hits = [hit for hit, _ in _iter_hits(dataset, db, peak,
+                                             RANK_PROJECTION)]
+        scores = spectra_cache.score_compounds(
+            db, peak.charge, ms_params.energy_level,
+            [hit['_id'] for hit in hits], peak.ms2peaks,
+            ms_params.scoring_function, _ms2_tolerance(ms_params))
+        for hit, score in zip(hits, scores):
+            hit['Spectral_score'] = score
+            _push(heap, top_k, (spectral_sort_key(hit), -total_hits), hit)
+            total_hits += 1
+    return _ranked(heap), total_hits
+
+
+def _push(heap, size, key, hit):
+    """Add a hit to a bounded min-heap of the size best (largest key) hits.
+    Keys must be unique."""
+    if len(heap) < size:
+        heapq.heappush(heap, (key, hit))
+    elif key > heap[0][0]:
+        heapq.heapreplace(heap, (key, hit))
+
+
+def _ranked(heap):
+    """Get the hits in a heap, best first."""
+    return [hit for _, hit in sorted(heap, key=lambda entry: entry[0],
+                                     reverse=True)]
+
+
+def _fetch_hits(db, ranked, projection):
+    """Replace ranked hits with their full compound documents (with the
+    fields in projection), keeping the fields added by the search."""
+    docs = {comp['_id']: comp for comp in db.compounds.find(
+        {'_id': {'$in': list({hit['_id'] for hit in ranked})}}, projection)}
+    hits = []
+    for hit in ranked:
+        if hit['_id'] not in docs:
+            continue  # removed since the search
+        full_hit = dict(docs[hit['_id']])
+        for field in SEARCH_FIELDS:
+            if field in hit:
+                full_hit[field] = hit[field]
+        hits.append(full_hit)
+    return hits
+
+
+def _iter_lines(source):
+    """Iterate over the lines of a text or a binary file."""
+    if isinstance(source, str):
+        yield from io.StringIO(source)
+        return
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        yield line
+
+
+def _iter_form(lines, charge):
+    """Parse m/z values, one per line."""
+    from minedatabase.metabolomics import Peak
+    for line in lines:
+        mz = line.rstrip('\n')
+        if mz.strip():
+            yield Peak(mz, 0, float(mz), charge, "False")
+
+
+def _iter_form_ms2(lines, charge):
+    """Parse a precursor m/z followed by "m/z intensity" lines."""
+    from minedatabase.metabolomics import Peak
+    split_form = [line.split() for line in lines if line.strip()]
+    if not split_form:
+        return
+    ms2_data = [(float(mz), float(i)) for mz, i in split_form[1:]]
+    yield Peak(split_form[0][0], 0, float(split_form[0][0]), charge, "False",
+               ms2=ms2_data)
+
+
+def _iter_mgf(lines, charge):
+    """Parse an mgf file, as minedatabase.metabolomics.read_mgf."""
+    from minedatabase.metabolomics import Peak
+    name, r_time, mass = 'N/A', 0, None
+    ms2 = []
+    for line in lines:
+        sl = line.strip(' \r\n').split('=')
+        if sl[0] == "PEPMASS":
+            mass = sl[1]
+        elif sl[0] == "TITLE":
+            name = sl[1]
+        elif sl[0] == "RTINSECONDS":
+            r_time = sl[1]
+        elif sl[0] == "END IONS":
+            yield Peak(name, r_time, mass, charge, "False", ms2=ms2)
+            ms2 = []
+        else:
+            try:
+                mz, i = sl[0].split('\t')
+                ms2.append((float(mz), float(i)))
+            except ValueError:
+                continue
+
+
+def _iter_msp(lines, charge):
+    """Parse an msp file (spectra separated by blank lines), as
+    minedatabase.metabolomics.read_msp."""
+    block = []
+    for line in lines:
+        if line.strip():
+            block.append(line.rstrip('\r\n'))
+        elif block:
+            yield _msp_peak(block, charge)
+            block = []
+    if block:
+        yield _msp_peak(block, charge)
+
+
+def _msp_peak(block, charge):
+    """Parse the lines of one msp spectrum."""
+    from minedatabase.metabolomics import Peak
+    ms2 = []
+    inchikey = "False"
+    name, mass = 'N/A', None
+    for line in block:
+        sl = line.split(': ')
+        sl[0] = sl[0].replace(' ', '').replace('/', '').upper()
+        if sl[0] == "PRECURSORMZ":
+            mass = sl[1]
+        elif sl[0] == "NAME":
+            name = sl[1]
+        elif sl[0] == "INCHIKEY":
+            inchikey = sl[1]
+        elif line and line[0].isdigit():
+            try:
+                row = re.split('[\t ]', line)
+                ms2.append((float(row[0]), float(row[1])))
+            except ValueError:
+                continue
+    return Peak(name, 0, mass, charge, inchikey, ms2=ms2)
+
+
+def _iter_mzxml(source, chunk_size=65536):
+    """Parse the MS2 scans of an mzXML file, as
+    minedatabase.metabolomics.read_mzxml (the charge comes from the polarity
+    of each scan). Scans are removed from the tree once parsed."""
+    from minedatabase.metabolomics import Peak
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    prefix = None
+    parents = []
+
+    def chunks():
+        if isinstance(source, str):
+            for i in range(0, len(source), chunk_size):
+                yield source[i:i + chunk_size]
+        else:
+            yield from iter(lambda: source.read(chunk_size), b'')
+
+    for chunk in itertools.chain(chunks(), [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if prefix is None:
+                    prefix = elem.tag.strip('mzXML')
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag != '%sscan' % prefix:
+                continue
+            if elem.attrib['msLevel'] == '2':
+                mz = elem.find('./%sprecursorMz' % prefix).text
+                r_time = elem.attrib['retentionTime'][2:-1]
+                yield Peak("%s @ %s" % (mz, r_time), r_time, mz,
+                           elem.attrib['polarity'], "False")
+            if parents:
+                parents[-1].remove(elem)
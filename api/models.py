@@ -0,0 +1,320 @@
+"""In-memory cache of KEGG organism model compound sets. Used to filter and
+score compounds against a model without querying the KEGG database for every
+request (see ModelCache)."""
+
+import threading
+import time
+
+from pymongo.errors import OperationFailure
+
+from api.index_refresh import top_mine_id
+from api.timing import timed
+
+
+class ModelCache(object):
+    """Keeps the compound membership of each KEGG model in memory.
+
+    For each model, the set of KEGG compound ids in that model is loaded once
+    from the KEGG database. For each (MINE database, model) pair, the set of
+    MINE compound _ids that are in that model is loaded once with a single
+    query. Likelihood scoring and native compound filtering then become set
+    intersections. All sets are dropped when the KEGG models collection
+    changes, and the sets of a MINE database when compounds are added to it
+    (its highest MINE_id changes), which are each checked at most once every
+    `refresh_interval` seconds.
+
+    Attributes
+    ----------
+    refresh_interval : float
+        Minimum number of seconds between checks of the KEGG database version.
+    """
+
+    def __init__(self, refresh_interval=300):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._parents = {}
+        self._natives = {}
+        self._version = None
+        self._last_check = None
+        self._db_watermarks = {}
+
+    def init_app(self, app):
+        """Read cache settings from a Flask app's config."""
+        self.refresh_interval = app.config.get('MODEL_CACHE_REFRESH',
+                                               self.refresh_interval)
+
+    def clear(self):
+        """Drop all cached model sets."""
+        with self._lock:
+            self._parents = {}
+            self._natives = {}
+
+    def get_parents(self, kegg_db, model_id):
+        """Get the KEGG compound ids in a model.
+
+        Parameters
+        ----------
+        kegg_db : Mongo DB
+            Should contain a "models" collection with a "Compounds" field.
+        model_id : str
+            KEGG organism code (e.g. 'hsa').
+
+        Returns
+        -------
+        parents : frozenset or None
+            KEGG compound ids in the model. None if the model does not exist.
+        """
+        self._check_version(kegg_db)
+        parents = self._parents.get(model_id)
+        if parents is None and model_id not in self._parents:
+            model = kegg_db.models.find_one({'_id': model_id},
+                                            {'Compounds': 1})
+            if model:
+                parents = frozenset(model.get('Compounds', []))
+            with self._lock:
+                self._parents[model_id] = parents
+        return parents
+
+    def get_native_set(self, db, kegg_db, model_ids):
+        """Get _ids of compounds in a MINE database that are in model(s).
+
+        Equivalent to minedatabase.metabolomics.get_KEGG_comps, but uses one
+        query per (database, model) pair and caches the result.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            MINE database containing compound documents.
+        kegg_db : Mongo DB
+            Contains models with associated KEGG compound ids.
+        model_ids : list
+            KEGG organism codes (e.g. ['eco']).
+
+        Returns
+        -------
+        native_set : set
+            Compound _ids in db linked to a KEGG compound in any of the models.
+        """
+        self._check_version(kegg_db)
+        self._check_watermark(db)
+        native_set = set()
+        for model_id in model_ids:
+            key = (db.name, model_id)
+            natives = self._natives.get(key)
+            if natives is None:
+                parents = self.get_parents(kegg_db, model_id)
+                if parents is None:
+                    raise ValueError(f'Invalid model specified: {model_id}')
+                cursor = db.compounds.find(
+                    {'DB_links.KEGG': {'$in': list(parents)}}, {'_id': 1})
+                natives = frozenset(x['_id'] for x in cursor)
+                with self._lock:
+                    self._natives[key] = natives
+            native_set |= natives
+        return native_set
+
+    @timed('scoring')
+    def score_compounds(self, kegg_db, compounds, model_id, parent_frac=0.75,
+                        reaction_frac=0.25):
+        """Add a 'Likelihood_score' to compounds based on a KEGG model.
+
+        Gives the same scores as minedatabase.utils.score_compounds, using the
+        cached model compound set instead of fetching the model each time.
+
+        Parameters
+        ----------
+        kegg_db : Mongo DB
+            Should contain a "models" collection with compound IDs listed.
+        compounds : list
+            Each element is a dict describing that compound.
+        model_id : str
+            KEGG organism code (e.g. 'hsa').
+        parent_frac : float, optional (default: 0.75)
+            Weighting for compounds derived from compounds in the model.
+        reaction_frac : float, optional (default: 0.25)
+            Weighting for compounds derived from known compounds not in the
+            model.
+
+        Returns
+        -------
+        compounds : list
+            Input compounds list, where each compound now has a
+            'Likelihood_score' key and value between 0 and 1.
+        """
+        if not model_id:
+            return compounds
+        parents = self.get_parents(kegg_db, model_id)
+        if parents is None:
+            return compounds
+
+        for comp in compounds:
+            if not parents.isdisjoint(_kegg_ids(comp)):
+                comp['Likelihood_score'] = parent_frac + reaction_frac
+                continue
+
+            if comp['Generation'] == 0:
+                comp['Likelihood_score'] = reaction_frac
+                continue
+
+            comp['Likelihood_score'] = 0.0
+            for source in comp['Sources']:
+                likelihood_score = reaction_frac
+                # 'Compound' is needed for legacy MINEs
+                s_comps = source.get('Compounds', [source.get('Compound')])
+                for s_comp in s_comps:
+                    if s_comp and not parents.isdisjoint(_kegg_ids(s_comp)):
+                        likelihood_score += parent_frac
+                if likelihood_score > comp['Likelihood_score']:
+                    comp['Likelihood_score'] = likelihood_score
+
+        return compounds
+
+    @timed('scoring')
+    def score_compounds_batch(self, kegg_db, compounds, model_id,
+                              parent_frac=0.75, reaction_frac=0.25):
+        """Add a 'Likelihood_score' to many compounds at once.
+
+        Gives the same scores as score_compounds, but flattens the KEGG ids of
+        all compounds and their sources into arrays first. Model membership is
+        then checked once per distinct KEGG id and scores are computed with
+        numpy reductions rather than compound by compound, which is much
+        faster for queries that return thousands of compounds.
+
+        Parameters
+        ----------
+        kegg_db : Mongo DB
+            Should contain a "models" collection with compound IDs listed.
+        compounds : list
+            Each element is a dict describing that compound. Should have a
+            'Generation' field (and optionally 'Sources' and 'DB_links').
+        model_id : str
+            KEGG organism code (e.g. 'hsa').
+        parent_frac : float, optional (default: 0.75)
+            Weighting for compounds derived from compounds in the model.
+        reaction_frac : float, optional (default: 0.25)
+            Weighting for compounds derived from known compounds not in the
+            model.
+
+        Returns
+        -------
+        compounds : list
+            Input compounds list, where each compound now has a
+            'Likelihood_score' key and value between 0 and 1.
+        """
+        import numpy as np  # imported on first use to keep startup fast
+        if not model_id or not compounds:
+            return compounds
+        parents = self.get_parents(kegg_db, model_id)
+        if parents is None:
+            return compounds
+
+        n_comps = len(compounds)
+        generation = np.empty(n_comps)
+        # Owner index arrays map each KEGG id to its compound (for direct
+        # links) or to its source compound, and each source compound to its
+        # source and each source to its compound.
+        direct_owner, direct_ids = [], []
+        source_owner = []
+        s_comp_owner, s_comp_ids_owner, s_comp_ids = [], [], []
+
+        for i, comp in enumerate(compounds):
+            generation[i] = comp['Generation']
+            kegg_ids = _kegg_ids(comp)
+            direct_owner.extend([i] * len(kegg_ids))
+            direct_ids.extend(kegg_ids)
+            # Seed (Generation 0) and coreactant compounds have no Sources
+            for source in comp.get('Sources', ()):
+                source_idx = len(source_owner)
+                source_owner.append(i)
+                # 'Compound' is needed for legacy MINEs
+                for s_comp in source.get('Compounds',
+                                         [source.get('Compound')]):
+                    if not s_comp:
+                        continue
+                    s_comp_idx = len(s_comp_owner)
+                    s_comp_owner.append(source_idx)
+                    kegg_ids = _kegg_ids(s_comp)
+                    s_comp_ids_owner.extend([s_comp_idx] * len(kegg_ids))
+                    s_comp_ids.extend(kegg_ids)
+
+        # Check model membership once per distinct KEGG id
+        in_model = {k: k in parents for k in set(direct_ids) | set(s_comp_ids)}
+
+        direct_hit = np.zeros(n_comps, dtype=bool)
+        hit_ids = np.fromiter((in_model[k] for k in direct_ids), dtype=bool,
+                              count=len(direct_ids))
+        direct_hit[np.asarray(direct_owner, dtype=np.intp)[hit_ids]] = True
+
+        # A source compound counts once if any of its KEGG ids is in the model
+        s_comp_hit = np.zeros(len(s_comp_owner), dtype=bool)
+        hit_ids = np.fromiter((in_model[k] for k in s_comp_ids), dtype=bool,
+                              count=len(s_comp_ids))
+        s_comp_hit[np.asarray(s_comp_ids_owner, dtype=np.intp)[hit_ids]] = True
+        source_hits = np.bincount(np.asarray(s_comp_owner, dtype=np.intp),
+                                  weights=s_comp_hit,
+                                  minlength=len(source_owner))
+        source_scores = reaction_frac + parent_frac * source_hits
+
+        # Best source score for each compound (0 if it has no sources)
+        scores = np.zeros(n_comps)
+        np.maximum.at(scores, np.asarray(source_owner, dtype=np.intp),
+                      source_scores)
+        scores[generation == 0] = reaction_frac
+        scores[direct_hit] = parent_frac + reaction_frac
+
+        for comp, score in zip(compounds, scores.tolist()):
+            comp['Likelihood_score'] = score
+
+        return compounds
+
+    def _check_version(self, kegg_db):
+        """Drop cached sets if the KEGG models collection has changed."""
+        now = time.monotonic()
+        if (self._last_check is not None
+                and now - self._last_check < self.refresh_interval):
+            return
+        self._last_check = now
+        version = _models_version(kegg_db)
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+
+    def _check_watermark(self, db):
+        """Drop the cached native sets of a MINE database if compounds have
+        been added to it."""
+        now = time.monotonic()
+        watermark, checked = self._db_watermarks.get(db.name, (None, None))
+        if checked is not None and now - checked < self.refresh_interval:
+            return
+        mine_id = top_mine_id(db)
+        with self._lock:
+            if mine_id != watermark:
+                self._natives = {key: natives for key, natives
+                                 in self._natives.items() if key[0] != db.name}
+            self._db_watermarks[db.name] = (mine_id, now)
+
+
+def _kegg_ids(comp):
+    """Get the KEGG ids linked to a compound document."""
+    try:
+        return comp['DB_links']['KEGG']
+    except (KeyError, TypeError):
+        return ()
+
+
+def _models_version(kegg_db):
+    """Get a token that changes whenever the KEGG models collection does.
+
+    Without the privileges for dbHash, the token is the number of models,
+    which misses in-place edits of existing models (restart the server, or
+    call ModelCache.clear, after those).
+    """
+    try:
+        return kegg_db.command('dbHash', collections=['models'])['md5']
+    except OperationFailure:
+        # dbHash requires extra privileges, so fall back to a cheaper check
+        return kegg_db.models.estimated_document_count()
+
+
+model_cache = ModelCache()  # pylint: disable=invalid-name
@@ -0,0 +1,97 @@
+"""Precomputed compound properties that the metabolomics searches filter on.
+Storing them on every compound lets the logP and halogen filters be part of
+the mass query (and of the index it uses), so that compounds they discard are
+never fetched. Run "flask backfill-properties" to add them to compounds that
+do not have them yet."""
+
+import logging
+import re
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import UpdateOne
+
+from api.database import get_db
+
+#: Compound field that is True if the formula has F, Cl or Br
+HALOGEN_FIELD = 'Halogenated'
+
+#: Same test as the halogen filter of minedatabase.metabolomics
+HALOGEN_PATTERN = re.compile('F[^e]|Cl|Br')
+
+
+def is_halogenated(formula):
+    """Check whether a molecular formula contains F, Cl or Br."""
+    return bool(HALOGEN_PATTERN.search(formula))
+
+
+def compute_logp(smiles):
+    """Crippen logP of a compound, as computed by minedatabase when compounds
+    are inserted. Returns None if the SMILES cannot be parsed."""
+    from rdkit.Chem import AllChem
+    mol = AllChem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    return AllChem.CalcCrippenDescriptors(mol)[0]
+
+
+def backfill_properties(db, batch_size=1000, logger=None):
+    """Store the filter properties of compounds that do not have them yet.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        MINE database to update.
+    batch_size : int, optional (default: 1000)
+        Number of compounds updated with each bulk write.
+    logger : logging.Logger, optional (default: None)
+        Logger for progress. Defaults to this module's logger.
+
+    Returns
+    -------
+    n_updated : int
+        Number of compounds updated.
+    """
+    logger = logger or logging.getLogger(__name__)
+    start = time.perf_counter()
+    query = {'$or': [{HALOGEN_FIELD: {'$exists': False}},
+                     {'logP': {'$exists': False}}]}
+    projection = {'Formula': 1, 'SMILES': 1, 'logP': 1}
+
+    n_updated = 0
+    updates = []
+    for comp in db.compounds.find(query, projection):
+        fields = {}
+        if 'Formula' in comp:
+            fields[HALOGEN_FIELD] = is_halogenated(comp['Formula'])
+        if 'logP' not in comp and 'SMILES' in comp:
+            logp = compute_logp(comp['SMILES'])
+            if logp is not None:
+                fields['logP'] = logp
+        if fields:
+            updates.append(UpdateOne({'_id': comp['_id']}, {'$set': fields}))
+        if len(updates) >= batch_size:
+            n_updated += db.compounds.bulk_write(updates,
+                                                 ordered=False).modified_count
+            updates = []
+    if updates:
+        n_updated += db.compounds.bulk_write(updates,
+                                             ordered=False).modified_count
+
+    logger.info('Backfilled properties of %s compounds in %s in %.1f s',
+                n_updated, db.name, time.perf_counter() - start)
+    return n_updated
+
+
+@click.command('backfill-properties')
+@click.option('--db', 'db_names', multiple=True,
+              help='MINE database to update (default: all in MINE_DB_NAMES).')
+@with_appcontext
+def backfill_properties_command(db_names):
+    """Store logP and halogen flags on compounds that do not have them."""
+    for db_name in db_names or current_app.config['MINE_DB_NAMES']:
+        n_updated = backfill_properties(get_db(db_name, read_only=False),
+                                        logger=current_app.logger)
+        click.echo(f'{db_name}: updated {n_updated} compounds')
@@ -0,0 +1,155 @@
+"""Mongo queries of the lookup routes (quick search, model search, get-ids,
+get-comps, get-rxns, get-ops and get-op-w-rxns). They are the queries of the
+minedatabase.queries functions of the same names, built here so that the
+Flask routes (which run them with PyMongo, see the functions below) and the
+async routes (which run them with PyMongo's asyncio client, see
+api.async_routes) stay the same."""
+
+#: Maximum number of compounds returned by quick searches that are not by
+#: name, and by text searches
+MAX_RESULTS = 500
+
+#: Fields of the compounds found by text search (by quick search)
+TEXT_SEARCH_PROJECTION = {'score': {'$meta': 'textScore'}, 'Formula': 1,
+                          'MINE_id': 1, 'Names': 1, 'Inchikey': 1,
+                          'SMILES': 1, 'Mass': 1}
+
+#: Sort of text search results, best match first
+TEXT_SCORE_SORT = [('score', {'$meta': 'textScore'})]
+
+#: Fields left out of the compounds returned by get-comps
+COMP_EXCLUDED_FIELDS = {'len_FP2': 0, 'FP2': 0, 'len_FP4': 0, 'FP4': 0}
+
+
+def default_projection():
+    """Get the fields of the compounds returned by searches,
+    minedatabase.queries.DEFAULT_PROJECTION. Imported on first use, since
+    minedatabase loads RDKit."""
+    from minedatabase.queries import DEFAULT_PROJECTION
+    return DEFAULT_PROJECTION
+
+
+def compound_query(field, key):
+    """Get the filter of a quick search for a key of a field (see
+    api.quick_search.classify_query). Names are matched as case-insensitive
+    regular expressions, as in minedatabase."""
+    if field == 'Names':
+        return {'Names': {'$regex': '^' + key + '$', '$options': 'i'}}
+    return {field: key}
+
+
+def text_query(query):
+    """Get the filter of a text search of compound names or models."""
+    return {'$text': {'$search': query}}
+
+
+def comp_query(cpd_id):
+    """Get the filter of a compound by MINE id (int) or _id."""
+    if isinstance(cpd_id, int):
+        return {'MINE_id': cpd_id}
+    return {'_id': cpd_id}
+
+
+def reaction_queries(cpd_id):
+    """Get the filters of the reactions a compound is a reactant and a
+    product of, for compounds without precomputed 'Reactant_in' and
+    'Product_of' (new MINEs)."""
+    return {'Reactants.c_id': cpd_id}, {'Products.c_id': cpd_id}
+
+
+def needs_reactions(cpd):
+    """Check whether a compound found by get-comps needs its reactions
+    looked up (see reaction_queries)."""
+    return bool(cpd) and 'Reactant_in' not in cpd and 'Product_of' not in cpd
+
+
+def op_query(op_id):
+    """Get the filter of an operator by _id or name (e.g. 1.1.-1.h)."""
+    return {'$or': [{'_id': op_id}, {'Name': op_id}]}
+
+
+def quick_search(db, field, key, query):
+    """Find compounds by identifier or name with Mongo queries, as
+    minedatabase.queries.quick_search.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        MINE database to search.
+    field : str
+        Field of the query (see api.quick_search.classify_query).
+    key : str or int
+        Value to look up in that field.
+    query : str
+        The query, for a text search if no compound has the name.
+
+    Returns
+    -------
+    results : list
+        Compound documents matching the query.
+    """
+    cursor = db.compounds.find(compound_query(field, key),
+                               default_projection())
+    if field != 'Names':
+        cursor = cursor.limit(MAX_RESULTS)
+    results = [x for x in cursor if x['_id'][0] == 'C']
+    if field == 'Names' and not results:
+        results = text_search(db, query)
+    return results
+
+
+def text_search(db, query):
+    """Find the compounds whose names best match a text query."""
+    cursor = db.compounds.find(text_query(query), TEXT_SEARCH_PROJECTION)
+    cursor = cursor.sort(TEXT_SCORE_SORT).limit(MAX_RESULTS)
+    return [x for x in cursor if x['_id'][0] == 'C']
+
+
+def model_search(db, query):
+    """Get the KEGG org codes of the models matching a text query (e.g.
+    'hsa' or 'yeast'), best match first."""
+    cursor = db.models.find(text_query(query),
+                            {'score': {'$meta': 'textScore'}})
+    return [x['_id'] for x in cursor.sort(TEXT_SCORE_SORT)]
+
+
+def get_ids(collection, query):
+    """Get the _ids of the documents of a collection matching a filter."""
+    return [x['_id'] for x in collection.find(query, {'_id': 1})]
+
+
+def get_comps(db, id_list):
+    """Get compounds by MINE id or _id (None for those not found), with the
+    _ids of the reactions they are in."""
+    compounds = []
+    for cpd_id in id_list:
+        cpd = db.compounds.find_one(comp_query(cpd_id), COMP_EXCLUDED_FIELDS)
+        if needs_reactions(cpd):
+            as_reactant, as_product = reaction_queries(cpd['_id'])
+            cpd['Reactant_in'] = get_ids(db.reactions, as_reactant)
+            cpd['Product_of'] = get_ids(db.reactions, as_product)
+        compounds.append(cpd)
+    return compounds
+
+
+def get_rxns(db, id_list):
+    """Get reactions by _id (None for those not found)."""
+    return [db.reactions.find_one({'_id': rxn_id}) for rxn_id in id_list]
+
+
+def get_ops(db, op_ids):
+    """Get operators by _id or name (None for those not found), or all
+    operators if op_ids is empty."""
+    if not op_ids:
+        return list(db.operators.find())
+    return [db.operators.find_one(op_query(op_id)) for op_id in op_ids]
+
+
+def get_op_w_rxns(db, op_id):
+    """Get an operator by _id or name, with the _ids of its reactions
+    ('Reaction_ids'), or None if it is not found."""
+    operator = db.operators.find_one(op_query(op_id))
+    if operator:
+        operator['Reaction_ids'] = db.reactions.distinct(
+            '_id', {'Operators': op_id})
+    return operator
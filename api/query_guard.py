@@ -0,0 +1,217 @@
+"""Guard for user-supplied Mongo queries. Every query is explained before it
+is run so that queries which would scan a whole collection can be rejected or
+capped, and an index that would have served the query can be suggested."""
+
+from ast import literal_eval
+
+from pymongo.errors import ExecutionTimeout
+
+from api.exceptions import InvalidUsage
+
+#: Valid values for the QUERY_COLLSCAN_POLICY config setting
+COLLSCAN_POLICIES = ('allow', 'cap', 'reject')
+
+#: Mongo operators that match a single value (first fields in an index)
+EQUALITY_OPERATORS = {'$eq', '$in', '$all', '$elemMatch', '$exists'}
+
+
+def guarded_find(db, mongo_query, projection, policy='cap', limit=1000,
+                 max_time_ms=10000, collection='compounds'):
+    """Run a user-supplied query after checking its query plan.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        DB to search.
+    mongo_query : str
+        A valid Mongo query as a literal string (e.g. '{"ID": "cpd00001"}').
+    projection : dict
+        The fields which should be returned.
+    policy : str, optional (default: 'cap')
+        What to do if the query needs a collection scan. 'allow' runs it
+        as is, 'cap' returns at most `limit` documents and 'reject' raises
+        InvalidUsage.
+    limit : int, optional (default: 1000)
+        Maximum number of documents returned by a collection scan when policy
+        is 'cap'.
+    max_time_ms : int, optional (default: 10000)
+        Server-side time limit for the query, in milliseconds. Not applied if
+        None or 0.
+    collection : str, optional (default: 'compounds')
+        Name of the collection to query.
+
+    Returns
+    -------
+    results : list
+        Documents matching the query.
+    advisory : dict
+        Query plan summary with keys 'collscan' (bool), 'indexes_used'
+        (list of index names), 'capped' (bool) and, only if 'collscan',
+        'suggested_indexes' (list of dicts with the 'name' and 'keys' of each
+        index that would serve the query).
+
+    Raises
+    ------
+    InvalidUsage
+        If the query is malformed, rejected by the policy or too slow.
+    """
+    if policy not in COLLSCAN_POLICIES:
+        raise ValueError(f'Invalid collection scan policy: {policy}')
+    # We don't want users poking around here
+    if db.name == 'admin' or not mongo_query:
+        raise InvalidUsage('Illegal query')
+    try:
+        query_dict = literal_eval(mongo_query)
+    except (ValueError, SyntaxError):
+        raise InvalidUsage(f'Unable to parse query: {mongo_query}')
+    if not isinstance(query_dict, dict):
+        raise InvalidUsage('Query must be a dictionary.')
+
+    advisory = explain_query(db, query_dict, projection, collection,
+                             max_time_ms)
+
+    cursor = db[collection].find(query_dict, projection)
+    if advisory['collscan']:
+        if policy == 'reject':
+            raise InvalidUsage('Query would scan the entire collection. Use '
+                               'indexed fields (see suggested_indexes).',
+                               status_code=403, payload=advisory)
+        if policy == 'cap':
+            cursor = cursor.limit(limit)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+
+    try:
+        results = list(cursor)
+    except ExecutionTimeout:
+        raise InvalidUsage(f'Query exceeded time limit of {max_time_ms} ms.',
+                           status_code=504, payload=advisory)
+
+    advisory['capped'] = (policy == 'cap' and advisory['collscan']
+                          and len(results) == limit)
+
+    return results, advisory
+
+
+def explain_query(db, query_dict, projection=None, collection='compounds',
+                  max_time_ms=None):
+    """Get the winning query plan for a find and summarize it.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        DB to search.
+    query_dict : dict
+        Mongo query filter.
+    projection : dict, optional (default: None)
+        The fields which should be returned.
+    collection : str, optional (default: 'compounds')
+        Name of the collection to query.
+    max_time_ms : int, optional (default: None)
+        Server-side time limit for planning the query, in milliseconds.
+
+    Returns
+    -------
+    advisory : dict
+        See guarded_find.
+    """
+    find_cmd = {'find': collection, 'filter': query_dict}
+    if projection:
+        find_cmd['projection'] = projection
+    if max_time_ms:
+        find_cmd['maxTimeMS'] = max_time_ms
+    try:
+        explanation = db.command('explain', find_cmd,
+                                 verbosity='queryPlanner')
+    except ExecutionTimeout:
+        raise InvalidUsage(f'Query exceeded time limit of {max_time_ms} ms.',
+                           status_code=504)
+
+    stages = list(_walk_plan(explanation['queryPlanner']['winningPlan']))
+    collscan = any(stage.get('stage') == 'COLLSCAN' for stage in stages)
+    advisory = {
+        'collscan': collscan,
+        'indexes_used': [stage['indexName'] for stage in stages
+                         if 'indexName' in stage],
+        'capped': False,
+    }
+    if collscan:
+        advisory['suggested_indexes'] = [
+            {'name': index_name(keys), 'keys': keys}
+            for keys in suggest_indexes(query_dict)]
+
+    return advisory
+
+
+def suggest_indexes(query_dict):
+    """Suggest indexes that would let Mongo serve a query without a scan.
+
+    Fields matched against a single value come first, followed by fields
+    matched against a range (the equality-range rule). Each branch of an $or
+    needs its own index, so one suggestion is returned per branch.
+
+    Parameters
+    ----------
+    query_dict : dict
+        Mongo query filter.
+
+    Returns
+    -------
+    suggestions : list
+        Each element is a list of (field, 1) tuples describing one index, as
+        accepted by pymongo's create_index.
+    """
+    equality, ranges, branches = [], [], []
+    _collect_fields(query_dict, equality, ranges, branches)
+
+    suggestions = []
+    base = [(field, 1) for field in equality + ranges]
+    if branches:
+        for branch in branches:
+            for branch_index in suggest_indexes(branch):
+                suggestions.append(_unique(base + branch_index))
+    elif base:
+        suggestions.append(_unique(base))
+
+    return suggestions
+
+
+def index_name(keys):
+    """Get the default Mongo name for an index (e.g. 'Mass_1_Charge_1')."""
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+def _collect_fields(query_dict, equality, ranges, branches):
+    """Sort the fields of a query into equality and range matches."""
+    for key, value in query_dict.items():
+        if key == '$and':
+            for sub_query in value:
+                _collect_fields(sub_query, equality, ranges, branches)
+        elif key == '$or':
+            branches.extend(value)
+        elif key.startswith('$'):
+            continue  # e.g. $text, which has its own index type
+        elif (isinstance(value, dict) and value
+              and all(op.startswith('$') for op in value)
+              and not set(value) <= EQUALITY_OPERATORS):
+            ranges.append(key)
+        else:
+            equality.append(key)
+
+
+def _unique(keys):
+    """Remove repeated fields from an index, keeping the first of each."""
+    seen = set()
+    return [(field, direction) for field, direction in keys
+            if not (field in seen or seen.add(field))]
+
+
+def _walk_plan(stage):
+    """Yield every stage in a query plan tree."""
+    yield stage
+    if 'queryPlan' in stage:  # plans from the slot-based engine
+        yield from _walk_plan(stage['queryPlan'])
+    if 'inputStage' in stage:
+        yield from _walk_plan(stage['inputStage'])
+    for input_stage in stage.get('inputStages', []):
+        yield from _walk_plan(input_stage)
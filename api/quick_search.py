@@ -0,0 +1,226 @@
+"""In-memory index of the identifiers quick search looks compounds up by. The
+kind of identifier is worked out from the query as in
+minedatabase.queries.quick_search, and the matching compound _ids are found
+in a hash table of that kind of key, so a search needs at most one Mongo
+query (fetching the matching compounds by _id) instead of one query per
+kind of key."""
+
+import re
+
+from api.index_refresh import IndexCache
+from api.queries import (MAX_RESULTS, default_projection, quick_search,
+                         text_search)
+
+#: Compound fields indexed for quick search. Names are indexed in lowercase,
+#: since they are matched regardless of case.
+KEY_FIELDS = ('MINE_id', 'DB_links.KEGG', 'DB_links.Model_SEED', 'Inchikey',
+              'Names')
+
+
+class QuickSearchIndex(object):
+    """Maps the identifiers of the compounds in a MINE database to their _ids.
+
+    Only compounds (whose _id starts with 'C') are indexed, since quick search
+    does not return coreactants. Indexes are not modified once built: updated
+    returns a new index with added, changed or removed compounds.
+
+    Attributes
+    ----------
+    keys : dict
+        For each field in KEY_FIELDS, maps each key to the _id of the compound
+        that has it, or to a list of _ids if several compounds have it.
+    comp_keys : dict
+        (field, key) pairs indexed for each compound _id, to remove them when
+        the compound changes.
+    """
+
+    def __init__(self):
+        self.keys = {field: {} for field in KEY_FIELDS}
+        self.comp_keys = {}
+
+    @classmethod
+    def from_db(cls, db):
+        """Index all compounds of a MINE database."""
+        index = cls()
+        projection = {field: 1 for field in KEY_FIELDS}
+        for comp in db.compounds.find({}, projection).sort('MINE_id', 1):
+            index.add(comp)
+        return index
+
+    def __len__(self):
+        return len(self.keys['MINE_id'])
+
+    def updated(self, comps, removed=()):
+        """Get a new index with added, changed or removed compounds. The keys
+        that changed compounds no longer have are removed.
+
+        Parameters
+        ----------
+        comps : list
+            Compound documents (with the KEY_FIELDS).
+        removed : set, optional (default: ())
+            _ids of removed compounds.
+
+        Returns
+        -------
+        index : QuickSearchIndex
+        """
+        index = QuickSearchIndex()
+        index.keys = {field: dict(keys) for field, keys in self.keys.items()}
+        index.comp_keys = dict(self.comp_keys)
+        for _id in removed:
+            index.remove(_id)
+        for comp in comps:
+            index.remove(comp['_id'])
+            index.add(comp)
+        return index
+
+    def add(self, comp):
+        """Index the identifiers of a compound document (unless it is a
+        coreactant)."""
+        _id = comp['_id']
+        if _id[0] != 'C':
+            return
+        db_links = comp.get('DB_links', {})
+        pairs = [('MINE_id', comp.get('MINE_id')),
+                 ('Inchikey', comp.get('Inchikey'))]
+        pairs += [('DB_links.KEGG', kegg_id)
+                  for kegg_id in db_links.get('KEGG', [])]
+        pairs += [('DB_links.Model_SEED', seed_id)
+                  for seed_id in db_links.get('Model_SEED', [])]
+        pairs += [('Names', name) for name in
+                  set(name.lower() for name in comp.get('Names', []))]
+        pairs = tuple(pair for pair in pairs if pair[1] is not None)
+        for field, key in pairs:
+            _add_key(self.keys[field], key, _id)
+        self.comp_keys[_id] = pairs
+
+    def remove(self, _id):
+        """Remove the identifiers of a compound from the index."""
+        for field, key in self.comp_keys.pop(_id, ()):
+            _remove_key(self.keys[field], key, _id)
+
+    def lookup(self, field, key):
+        """Get the _ids of the compounds with a key, in the order they were
+        indexed."""
+        if field == 'Names':
+            key = key.lower()
+        ids = self.keys[field].get(key, [])
+        return [ids] if isinstance(ids, str) else list(ids)
+
+
+class QuickSearchCache(IndexCache):
+    """Keeps a QuickSearchIndex of each MINE database (see
+    api.index_refresh.IndexCache)."""
+
+    index_class = QuickSearchIndex
+    name = 'quick_search'
+
+    def compounds(self, *args):
+        return {}, {field: 1 for field in KEY_FIELDS}
+
+    def search(self, db, query, use_index=True):
+        """Find compounds by identifier or name.
+
+        Same as minedatabase.queries.quick_search, except that names are
+        matched literally (ignoring case) rather than as regular expressions.
+        Databases without an index in memory (see find_index) are searched
+        with the queries of minedatabase (see api.queries.quick_search).
+
+        Parameters
+        ----------
+        db : Mongo DB
+            MINE database to search.
+        query : str
+            A MINE id, KEGG code, ModelSEED id, Inchikey or Name.
+        use_index : bool, optional (default: True)
+            If False, search with Mongo queries (QUICK_SEARCH_INDEX off).
+
+        Returns
+        -------
+        results : list
+            Compound documents (with the fields in
+            minedatabase.queries.DEFAULT_PROJECTION) matching the query.
+        """
+        field, key = classify_query(query)
+        index = None
+        if use_index and field != '_id':
+            index = self.find_index(db)
+        if index is None:
+            return quick_search(db, field, key, query)
+        results = _fetch_in_order(db, index_ids(index, field, key),
+                                  default_projection())
+        if field == 'Names' and not results:
+            results = text_search(db, query)
+        return results
+
+
+def classify_query(query):
+    """Work out which compound field a quick search query is for, as in
+    minedatabase.queries.quick_search.
+
+    Returns
+    -------
+    field : str
+        '_id' or one of KEY_FIELDS.
+    key : str or int
+        Value to look up in that field.
+    """
+    if re.match(r"C\w{40}", query):
+        return '_id', query
+    if re.match(r"C\d{5}", query):
+        return 'DB_links.KEGG', query
+    if re.match(r'cpd\d{5}', query):
+        return 'DB_links.Model_SEED', query
+    if re.search(r"[A-Z]{14}-[A-Z]{10}-[A-Z]", query):
+        return 'Inchikey', query.split("=", 1)[-1]
+    if query.isdigit():
+        return 'MINE_id', int(query)
+    return 'Names', query
+
+
+def index_ids(index, field, key):
+    """Get the _ids of the compounds a quick search returns from an index,
+    in order."""
+    ids = index.lookup(field, key)
+    if field != 'Names':
+        ids = ids[:MAX_RESULTS]
+    return ids
+
+
+def _add_key(mapping, key, _id):
+    """Map a key to an _id, keeping a list only for keys with several. Lists
+    are replaced rather than extended, since earlier versions of an index
+    share them."""
+    if key is None:
+        return
+    ids = mapping.get(key)
+    if ids is None:
+        mapping[key] = _id
+    elif isinstance(ids, list):
+        if _id not in ids:
+            mapping[key] = ids + [_id]
+    elif ids != _id:
+        mapping[key] = [ids, _id]
+
+
+def _remove_key(mapping, key, _id):
+    """Unmap a key from an _id, replacing lists as _add_key does."""
+    ids = mapping.get(key)
+    if ids == _id:
+        del mapping[key]
+    elif isinstance(ids, list) and _id in ids:
+        ids = [x for x in ids if x != _id]
+        mapping[key] = ids[0] if len(ids) == 1 else ids
+
+
+def _fetch_in_order(db, ids, projection):
+    """Fetch compounds by _id, in the order of ids."""
+    if not ids:
+        return []
+    docs = {comp['_id']: comp for comp in db.compounds.find(
+        {'_id': {'$in': ids}}, projection)}
+    return [docs[_id] for _id in ids if _id in docs]
+
+
+quick_search_cache = QuickSearchCache()  # pylint: disable=invalid-name
@@ -0,0 +1,453 @@
+"""Persistent result cache shared by the worker processes of a host. Responses
+of expensive routes are stored compressed in a SQLite file (in WAL mode, so
+that workers read while another writes), keyed by the request (see
+api.coalesce.request_key) and the version of the databases it read. Results
+survive restarts, and the least recently used ones are evicted when the file
+grows past its size limit."""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import click
+from bson import json_util
+from flask import current_app, make_response, request
+from flask.cli import with_appcontext
+from pymongo.errors import OperationFailure, PyMongoError
+
+from api.coalesce import (dump_response, load_response, private_temp_dir,
+                           request_key)
+from api.database import get_db
+from api.index_refresh import top_mine_id
+from api.telemetry import metrics
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+#: Collections with at most this many documents are hashed (with dbHash) to
+#: find in-place changes to them on servers without change streams
+SMALL_COLLECTION_DOCS = 10000
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+)"""
+
+_STREAMS_SCHEMA = """CREATE TABLE IF NOT EXISTS streams (
+    db_name TEXT PRIMARY KEY,
+    resume_token TEXT NOT NULL,
+    generation INTEGER NOT NULL
+)"""
+
+_VERSIONS_SCHEMA = """CREATE TABLE IF NOT EXISTS versions (
+    db_name TEXT PRIMARY KEY,
+    version TEXT,
+    checked REAL NOT NULL
+)"""
+
+
+class ResultCache(object):
+    """Key-value store of compressed results (bytes) in a SQLite file.
+
+    Each thread of each process uses its own connection, so the cache can be
+    shared by forked workers.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file (created if needed).
+    max_bytes : int
+        Size of the stored (compressed) results above which the least
+        recently used ones are evicted.
+    max_item_bytes : int, optional (default: max_bytes // 10)
+        Results larger than this (compressed) are not stored.
+    """
+
+    def __init__(self, path, max_bytes, max_item_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes or max_bytes // 10
+        self._local = threading.local()
+
+    def get(self, key):
+        """Get the result stored for a key, or None."""
+        conn = self._connect()
+        row = conn.execute('SELECT value FROM results WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        # Record the access at most once a minute, to limit writes
+        now = time.time()
+        with conn:
+            conn.execute('UPDATE results SET accessed = ? '
+                         'WHERE key = ? AND accessed < ?', (now, key, now - 60))
+        return zlib.decompress(row[0])
+
+    def set(self, key, result):
+        """Store a result, evicting old ones if the cache is full.
+
+        Returns
+        -------
+        stored : bool
+            False if the result was too large to store.
+        """
+        value = zlib.compress(result)
+        if len(value) > self.max_item_bytes:
+            return False
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                         (key, value, len(value), time.time()))
+        self._evict(conn)
+        return True
+
+    def clear(self):
+        """Remove all results."""
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM results')
+        self.compact()
+
+    def compact(self):
+        """Rebuild the SQLite file to return the space of evicted results."""
+        conn = self._connect()
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('VACUUM')
+
+    def stats(self):
+        """Get the number of results and their total size in bytes."""
+        count, size = self._connect().execute(
+            'SELECT COUNT(*), TOTAL(size) FROM results').fetchone()
+        return {'count': count, 'bytes': int(size)}
+
+    def stream_state(self, db_name):
+        """Get the change stream resume token and generation stored for a
+        database (see DatabaseVersions), or None."""
+        row = self._connect().execute(
+            'SELECT resume_token, generation FROM streams WHERE db_name = ?',
+            (db_name,)).fetchone()
+        if row is None:
+            return None
+        return json_util.loads(row[0]), row[1]
+
+    def set_stream_state(self, db_name, old_token, resume_token, generation):
+        """Store the change stream resume token and generation of a
+        database, unless another process has stored a token since old_token
+        (None if there was none)."""
+        token = json_util.dumps(resume_token)
+        conn = self._connect()
+        with conn:
+            if old_token is None:
+                conn.execute('INSERT OR IGNORE INTO streams VALUES (?, ?, ?)',
+                             (db_name, token, generation))
+            else:
+                conn.execute('UPDATE streams SET resume_token = ?, '
+                             'generation = ? WHERE db_name = ? '
+                             'AND resume_token = ?',
+                             (token, generation, db_name,
+                              json_util.dumps(old_token)))
+
+    def db_version(self, db_name):
+        """Get the version stored for a database (see DatabaseVersions) and
+        the time it was last checked, or None if it was never checked. The
+        version is None until the first check is done."""
+        row = self._connect().execute(
+            'SELECT version, checked FROM versions WHERE db_name = ?',
+            (db_name,)).fetchone()
+        if row is None:
+            return None
+        return (None if row[0] is None else json.loads(row[0])), row[1]
+
+    def claim_version_check(self, db_name, checked, now):
+        """Record that this process checks the version of a database at time
+        now, unless another process has claimed the check since `checked`
+        (None if it was never checked).
+
+        Returns
+        -------
+        claimed : bool
+        """
+        conn = self._connect()
+        with conn:
+            if checked is None:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO versions VALUES (?, NULL, ?)',
+                    (db_name, now))
+            else:
+                cursor = conn.execute(
+                    'UPDATE versions SET checked = ? '
+                    'WHERE db_name = ? AND checked = ?',
+                    (now, db_name, checked))
+        return cursor.rowcount == 1
+
+    def set_db_version(self, db_name, version):
+        """Store the version of a database found by a claimed check."""
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE versions SET version = ? WHERE db_name = ?',
+                         (json.dumps(version, default=str), db_name))
+
+    def _connect(self):
+        """Get this thread's connection, opening it in the current process
+        (connections must not be shared across a fork)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')  # before the table
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        with conn:
+            conn.execute(_SCHEMA)
+            conn.execute(_STREAMS_SCHEMA)
+            conn.execute(_VERSIONS_SCHEMA)
+            conn.execute('CREATE INDEX IF NOT EXISTS results_accessed '
+                         'ON results (accessed)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _evict(self, conn):
+        """Remove the least recently used results until the cache holds at
+        most 90% of max_bytes, then free their pages."""
+        total = conn.execute('SELECT TOTAL(size) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - 0.9 * self.max_bytes
+        with conn:
+            rows = conn.execute('SELECT key, size FROM results '
+                                'ORDER BY accessed').fetchall()
+            evicted = []
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            conn.executemany('DELETE FROM results WHERE key = ?', evicted)
+        conn.execute('PRAGMA incremental_vacuum')
+        metrics.increment('result_cache.evicted', len(evicted))
+
+
+class DatabaseVersions(object):
+    """Tokens that change whenever a Mongo database changes, checked at most
+    once every `refresh_interval` seconds per database, by one worker of the
+    host, in a background thread. Versions are kept in the result cache file,
+    so requests only read them and never wait for a check.
+
+    On servers that support change streams (replica sets), the version of a
+    database is a generation number that is incremented whenever its change
+    stream has events. The generation and the stream's resume token are also
+    kept in the result cache file, so they survive restarts. Otherwise, the
+    version is made of the database's collection counts, its highest MINE_id
+    and the dbHash of its small collections (see _db_version), which miss
+    in-place updates to large collections.
+
+    Parameters
+    ----------
+    cache : ResultCache
+        Stores the change stream states.
+    refresh_interval : float, optional (default: 60)
+        Minimum number of seconds between checks of a database.
+    """
+
+    def __init__(self, cache, refresh_interval=60):
+        self.cache = cache
+        self.refresh_interval = refresh_interval
+
+    def get(self, db_name):
+        """Get the version token of a database, starting a check in the
+        background if it is due.
+
+        Returns
+        -------
+        version : list or str or None
+            None if the database has not been checked yet.
+        """
+        now = time.time()
+        state = self.cache.db_version(db_name)
+        version, checked = (None, None) if state is None else state
+        if (checked is None or now - checked >= self.refresh_interval) and \
+                self.cache.claim_version_check(db_name, checked, now):
+            threading.Thread(target=self._check, args=(get_db(db_name),),
+                             name='result-cache-versions',
+                             daemon=True).start()
+        return version
+
+    def _check(self, db):
+        """Find and store the version of a database."""
+        try:
+            version = self._stream_version(db)
+            if version is None:
+                version = _db_version(db)
+            self.cache.set_db_version(db.name, version)
+        except Exception:  # pylint: disable=broad-except
+            # Keep the previous version, and check again after the interval
+            logger.exception('Checking the version of %s failed', db.name)
+
+    def _stream_version(self, db):
+        """Get the generation of a database's changes, after recording any
+        changes since its stored resume token, or None if change streams are
+        not supported."""
+        state = self.cache.stream_state(db.name)
+        if state is not None:
+            old_token, generation = state
+            try:
+                changed = _has_changes(db, old_token)
+            except PyMongoError:
+                changed = True  # can no longer resume, so start again
+            if not changed:
+                return ['changes', generation]
+        try:
+            token = _change_stream_token(db)
+        except PyMongoError:
+            return None
+        if state is None:
+            self.cache.set_stream_state(db.name, None, token, 0)
+        else:
+            self.cache.set_stream_state(db.name, old_token, token,
+                                        generation + 1)
+        # Another worker may have recorded the same changes first
+        return ['changes', self.cache.stream_state(db.name)[1]]
+
+
+def cache_result(view):
+    """Decorator that serves a route's successful responses from the result
+    cache (see ResultCache), when RESULT_CACHE is enabled.
+
+    Responses are keyed by the request (as for coalescing) and the versions
+    of the route's MINE database and of the KEGG database (for model
+    annotations), so they are recomputed after either changes. Hits and
+    misses are recorded in the metrics store ('result_cache.hits' and
+    'result_cache.misses', labelled by endpoint).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        if not config['RESULT_CACHE']:
+            return view(*args, **kwargs)
+
+        db_names = [config['KEGG_DB_NAME']]
+        if 'db_name' in request.view_args:
+            db_names.append(request.view_args['db_name'])
+        db_versions = _get_versions(config)
+        versions = [db_versions.get(name) for name in db_names]
+        if None in versions:
+            # Responses cannot be keyed until the databases have been checked
+            return view(*args, **kwargs)
+        key = hashlib.sha256(json.dumps(
+            [request_key()] + versions, default=str).encode()).hexdigest()
+
+        cache = _get_result_cache(config)
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.increment('result_cache.hits', label=request.endpoint)
+            return load_response(cached)
+
+        metrics.increment('result_cache.misses', label=request.endpoint)
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            cache.set(key, dump_response(response))
+        return response
+
+    return wrapper
+
+
+@click.command('result-cache')
+@click.option('--clear', is_flag=True, help='Remove all cached results.')
+@click.option('--compact', is_flag=True,
+              help='Rebuild the cache file to return unused space.')
+@with_appcontext
+def result_cache_command(clear, compact):
+    """Show the size of the result cache, and optionally clear or compact
+    it."""
+    cache = _get_result_cache(current_app.config)
+    if clear:
+        cache.clear()
+    elif compact:
+        cache.compact()
+    stats = cache.stats()
+    click.echo(f"{cache.path}: {stats['count']} results, "
+               f"{stats['bytes']} bytes")
+
+
+_result_caches = {}  # pylint: disable=invalid-name
+_db_versions = {}  # pylint: disable=invalid-name
+_caches_lock = threading.Lock()  # pylint: disable=invalid-name
+
+
+def _get_result_cache(config):
+    """Get the ResultCache instance for an app's settings."""
+    path = config['RESULT_CACHE_PATH'] or os.path.join(
+        private_temp_dir('mine-server-results'), 'results.sqlite3')
+    with _caches_lock:
+        if path not in _result_caches:
+            _result_caches[path] = ResultCache(
+                path, config['RESULT_CACHE_MAX_BYTES'],
+                config['RESULT_CACHE_MAX_ITEM_BYTES'])
+        return _result_caches[path]
+
+
+def _get_versions(config):
+    """Get the DatabaseVersions instance for an app's settings."""
+    cache = _get_result_cache(config)
+    key = (cache.path, config['RESULT_CACHE_VERSION_REFRESH'])
+    with _caches_lock:
+        if key not in _db_versions:
+            _db_versions[key] = DatabaseVersions(cache, key[1])
+        return _db_versions[key]
+
+
+def _change_stream_token(db):
+    """Get a resume token for the changes to a database from now on.
+
+    Raises
+    ------
+    OperationFailure
+        If the server does not support change streams.
+    """
+    with db.watch(max_await_time_ms=1) as stream:
+        stream.try_next()
+        return stream.resume_token
+
+
+def _has_changes(db, resume_token):
+    """Check whether a database has changed since a resume token.
+
+    Raises
+    ------
+    PyMongoError
+        If the change stream cannot be resumed.
+    """
+    with db.watch(resume_after=resume_token, max_await_time_ms=1) as stream:
+        return stream.try_next() is not None
+
+
+def _db_version(db):
+    """Get a token that changes when documents are added to or removed from
+    a database, or changed in its small collections, without change streams.
+
+    The collection counts and highest MINE_id are cheap to get. dbHash reads
+    every document, so it is only run on the collections with at most
+    SMALL_COLLECTION_DOCS documents (if permitted).
+    """
+    counts = {name: db[name].estimated_document_count()
+              for name in db.list_collection_names()}
+    small = sorted(name for name, count in counts.items()
+                   if count <= SMALL_COLLECTION_DOCS)
+    md5 = None
+    if small:
+        try:
+            md5 = db.command('dbHash', collections=small)['md5']
+        except OperationFailure:
+            pass  # dbHash requires extra privileges
+    return [sorted(counts.items()), top_mine_id(db), md5]
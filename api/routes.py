@@ -1,28 +1,45 @@
 """Here, routes are defined for all possible API requests. Note that nearly
-all actual logic is imported from the minedatabase package."""
+all actual logic is imported from the minedatabase package (the queries of
+the lookup routes are built in api.queries, which the async routes share).
+The minedatabase modules load RDKit, pandas and NumPy, so they are imported
+by the routes that use them rather than at startup."""
 
+import json
+import os
 from ast import literal_eval
 
 from flask import Blueprint
 from flask import current_app as app
-from flask import jsonify, request
+from flask import request, stream_with_context
 
-from api.database import mongo
+from api import queries
+from api.autocomplete import autocomplete_cache
+from api.coalesce import coalesce
+from api.database import get_db
 from api.exceptions import InvalidUsage
-from minedatabase.metabolomics import (ms2_search, ms_adduct_search,
-                                       read_adduct_names, spectra_download)
-from minedatabase.queries import (advanced_search, get_comps, get_ids,
-                                  get_op_w_rxns, get_ops, get_rxns,
-                                  model_search, quick_search,
-                                  similarity_search, structure_search,
-                                  substructure_search)
-from minedatabase.utils import score_compounds, get_smiles_from_mol_string
+from api.metabolomics import (ms2_batch_search, ms2_search, ms_adduct_search,
+                             read_adduct_names)
+from api.models import model_cache
+from api.query_guard import guarded_find
+from api.quick_search import quick_search_cache
+from api.result_cache import cache_result
+from api.structures import batch_structure_search, structure_search
+from api.telemetry import metrics
+from api.timing import (add_server_timing, jsonify, phase, start_timing,
+                        timed)
 
 
+#: Datafile type of uploaded files, by file extension
+UPLOAD_TEXT_TYPES = {'.mgf': 'mgf', '.msp': 'msp', '.mzxml': 'mzXML'}
+
 # pylint: disable=invalid-name
 mineserver_api = Blueprint('mineserver_api', __name__)
 # pylint: enable=invalid-name
 
+# Report the time of each phase of a request (see api.timing)
+mineserver_api.before_request(start_timing)
+mineserver_api.after_request(add_server_timing)
+
 
 @mineserver_api.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
@@ -47,13 +64,51 @@ def quick_search_api(db_name, query):
     :return: JSON Documents matching query.
     :rtype: flask.Response
     """
-    db = mongo.cx[db_name]
-    results = quick_search(db, query)
+    db = get_db(db_name)
+    results = quick_search_cache.search(
+        db, query, use_index=app.config['QUICK_SEARCH_INDEX'])
     json_results = jsonify(results)
 
     return json_results
 
 
+@mineserver_api.route('/autocomplete/<db_name>/q=<query>')
+def autocomplete_api(db_name, query):
+    """Suggest compound names for a partly typed name.
+
+    .. :quickref: Compound; Autocomplete compound names
+
+    Fast enough to be called on every keystroke. Names starting with the
+    query are suggested first, then (for queries of three characters or
+    more) names that are similar to it, to allow for typos. Within each,
+    names of compounds from earlier generations come first.
+
+    :param str db_name:
+        Name of Mongo database to query against.
+    :param str query:
+        Start of a compound name.
+    :param int,optional limit:
+        Maximum number of suggestions, given in the query string (e.g.
+        ?limit=5). Defaults to 10.
+
+    :return:
+        JSON array of suggestions, each with the 'name', its lowest compound
+        'generation' and 'match' ('prefix' or 'fuzzy').
+    :rtype: flask.Response
+    """
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        raise InvalidUsage('<limit> must be an integer.')
+    if not 0 < limit <= app.config['AUTOCOMPLETE_MAX_LIMIT']:
+        raise InvalidUsage('<limit> must be between 1 and %s.'
+                           % app.config['AUTOCOMPLETE_MAX_LIMIT'])
+
+    db = get_db(db_name)
+    suggestions = autocomplete_cache.complete(db, query, limit)
+    return jsonify(suggestions)
+
+
 # Routes for mol input
 @mineserver_api.route('/similarity-search/<db_name>', methods=['POST'])
 @mineserver_api.route('/similarity-search/<db_name>/<float:min_tc>',
@@ -70,6 +125,8 @@ def quick_search_api(db_name, query):
                       '/<int:limit>')
 @mineserver_api.route('/similarity-search/<db_name>/smiles=<smiles>'
                       '/<float:min_tc>/<int:limit>')
+@cache_result
+@coalesce
 def similarity_search_api(db_name, smiles=None, min_tc=0.7, limit=-1):
     """Perform a similarity search for a SMILES string and return results.
 
@@ -108,18 +165,100 @@ def similarity_search_api(db_name, smiles=None, min_tc=0.7, limit=-1):
 
     if json_data and 'mol' in json_data:
         mol_str = str(json_data['mol'])
-        smiles = get_smiles_from_mol_string(mol_str)
+        from minedatabase.utils import get_smiles_from_mol_string
+        with phase('parse'):
+            smiles = get_smiles_from_mol_string(mol_str)
 
     if json_data and 'model' in json_data:
         model = str(json_data['model'])
     else:
         model = None
 
-    model_db = mongo.cx[app.config['KEGG_DB_NAME']]
+    model_db = get_db(app.config['KEGG_DB_NAME'])
 
-    db = mongo.cx[db_name]
-    results = similarity_search(db, smiles, min_tc=min_tc, limit=limit,
-                                model_db=model_db, parent_filter=model)
+    db = get_db(db_name)
+    from minedatabase.queries import similarity_search
+    with phase('rdkit'):
+        results = similarity_search(db, smiles, min_tc=min_tc, limit=limit)
+    results = model_cache.score_compounds(model_db, results, model)
+    json_results = jsonify(results)
+
+    return json_results
+
+
+@mineserver_api.route('/similarity-batch-search/<db_name>', methods=['POST'])
+@cache_result
+@coalesce
+def similarity_batch_search_api(db_name):
+    """Perform similarity searches for many structures at once.
+
+    .. :quickref: Compound; Structure similarity search for a list of
+                  structures
+
+    Attach all arguments besides db_name as JSON data in POST request. The
+    fingerprints of the database are kept in memory, and the Tanimoto
+    coefficients of all structures are computed together, a block of
+    compounds at a time.
+
+    :param str db_name:
+        Name of Mongo database to query against.
+    :param list structures:
+        SMILES strings (or mol objects in str format) of the query molecules.
+        At most SIMILARITY_BATCH_MAX_SIZE (see api/config.py).
+    :param float,optional min_tc:
+        Minimum Tanimoto Coefficient required for similarity match. Defaults to
+        0.7.
+    :param int,optional limit:
+        Maximum number of results (compounds) to return for each structure,
+        most similar first. By default, returns all results (limit=-1).
+    :param str,optional mode:
+        'database' to search the compounds of the database, or 'queries' to
+        compare the structures to each other (e.g. to cluster them).
+        Defaults to 'database'.
+    :param str,optional model:
+        KEGG organism code (e.g. 'hsa'). Adds a 'Likelihood_score' to each
+        compound, as in similarity-search. Defaults to None.
+
+    :return:
+        JSON array with a document per structure, in order, with its 'index',
+        'structure' and 'hits' (by decreasing 'Tanimoto' coefficient:
+        similar compounds, or the 'index' of similar structures in 'queries'
+        mode), or an 'error' message if it could not be parsed.
+    :rtype: flask.Response
+    """
+    json_data = request.get_json() or {}
+
+    structures = json_data.get('structures')
+    if not isinstance(structures, list) or \
+            not all(isinstance(x, str) for x in structures):
+        raise InvalidUsage('<structures> argument must be a list of SMILES '
+                           'or mol strings.')
+    max_size = app.config['SIMILARITY_BATCH_MAX_SIZE']
+    if len(structures) > max_size:
+        raise InvalidUsage('<structures> may have at most %s structures.'
+                           % max_size)
+    try:
+        min_tc = float(json_data.get('min_tc', 0.7))
+        limit = int(json_data.get('limit', -1))
+    except (TypeError, ValueError):
+        raise InvalidUsage('<min_tc> must be a number and <limit> an integer.')
+    if not 0 < min_tc <= 1:
+        raise InvalidUsage('<min_tc> must be greater than 0 and at most 1.')
+    mode = json_data.get('mode', 'database')
+    if mode not in ('database', 'queries'):
+        raise InvalidUsage("<mode> must be 'database' or 'queries'.")
+    model = json_data.get('model')
+
+    db = get_db(db_name)
+    from api.fingerprints import batch_similarity_search
+    results = batch_similarity_search(db, structures, min_tc=min_tc,
+                                      limit=limit, mode=mode)
+    if model and mode == 'database':
+        model_db = get_db(app.config['KEGG_DB_NAME'])
+        hits = {id(comp): comp for result in results
+                for comp in result.get('hits', [])}
+        model_cache.score_compounds_batch(model_db, list(hits.values()),
+                                          str(model))
     json_results = jsonify(results)
 
     return json_results
@@ -133,6 +272,8 @@ def similarity_search_api(db_name, smiles=None, min_tc=0.7, limit=-1):
 @mineserver_api.route('/structure-search/<db_name>/smiles=<smiles>')
 @mineserver_api.route('/structure-search/<db_name>/smiles=<smiles>'
                       '/stereo=<stereo>')
+@cache_result
+@coalesce
 def structure_search_api(db_name, smiles=None, stereo=True):
     """Perform an exact structure search and return results.
 
@@ -151,7 +292,8 @@ def structure_search_api(db_name, smiles=None, stereo=True):
         structures, and cannot convert it to SMILES. Captured from form data.
         Defaults to None.
     :param bool,optional stereo:
-        If true, uses sterochemistry in finding exact match. Defaults to True.
+        If true, uses sterochemistry in finding exact match (matching the full
+        InChIKey rather than its connectivity block). Defaults to True.
     :param str,optional model:
         KEGG organism code (e.g. 'hsa'). Adds annotations to each compound
         based on whether it is in or could be derived from the KEGG compounds
@@ -165,18 +307,81 @@ def structure_search_api(db_name, smiles=None, stereo=True):
 
     if json_data and 'mol' in json_data:
         mol_str = str(json_data['mol'])
-        smiles = get_smiles_from_mol_string(mol_str)
+        from minedatabase.utils import get_smiles_from_mol_string
+        with phase('parse'):
+            smiles = get_smiles_from_mol_string(mol_str)
 
     if json_data and 'model' in json_data:
         model = str(json_data['model'])
     else:
         model = None
 
-    model_db = mongo.cx[app.config['KEGG_DB_NAME']]
+    model_db = get_db(app.config['KEGG_DB_NAME'])
+
+    db = get_db(db_name)
+    try:
+        results = structure_search(db, smiles, stereo=_read_bool(stereo))
+    except ValueError as error:
+        raise InvalidUsage(str(error))
+    results = model_cache.score_compounds(model_db, results, model)
+    json_results = jsonify(results)
+
+    return json_results
+
+
+@mineserver_api.route('/structure-batch-search/<db_name>', methods=['POST'])
+@cache_result
+@coalesce
+def structure_batch_search_api(db_name):
+    """Perform exact structure searches for many structures at once.
+
+    .. :quickref: Compound; Exact structure search for a list of structures
+
+    Attach all arguments besides db_name as JSON data in POST request. The
+    InChIKeys of all structures are computed first and then looked up with
+    a few database queries, so whole metabolite lists can be mapped onto a
+    MINE database.
+
+    :param str db_name:
+        Name of Mongo database to query against.
+    :param list structures:
+        SMILES strings (or mol objects in str format) of the query molecules.
+        At most STRUCTURE_BATCH_MAX_SIZE (see api/config.py).
+    :param bool,optional stereo:
+        If true, uses sterochemistry in finding exact matches (matching the
+        full InChIKey rather than its connectivity block). Defaults to True.
+    :param str,optional model:
+        KEGG organism code (e.g. 'hsa'). Adds a 'Likelihood_score' to each
+        compound, as in structure-search. Defaults to None.
 
-    db = mongo.cx[db_name]
-    results = structure_search(db, smiles, stereo=stereo, model_db=model_db,
-                               parent_filter=model)
+    :return:
+        JSON array with a document per structure, in order, with its 'index',
+        'structure', 'inchikey' and 'hits' (matching compounds), or an
+        'error' message if it could not be parsed.
+    :rtype: flask.Response
+    """
+    json_data = request.get_json() or {}
+
+    structures = json_data.get('structures')
+    if not isinstance(structures, list) or \
+            not all(isinstance(x, str) for x in structures):
+        raise InvalidUsage('<structures> argument must be a list of SMILES '
+                           'or mol strings.')
+    max_size = app.config['STRUCTURE_BATCH_MAX_SIZE']
+    if len(structures) > max_size:
+        raise InvalidUsage('<structures> may have at most %s structures.'
+                           % max_size)
+    stereo = _read_bool(json_data.get('stereo', True))
+    model = json_data.get('model')
+
+    db = get_db(db_name)
+    results = batch_structure_search(db, structures, stereo=stereo)
+    if model:
+        model_db = get_db(app.config['KEGG_DB_NAME'])
+        hits = {id(comp): comp for result in results
+                for comp in result.get('hits', [])}
+        model_cache.score_compounds_batch(model_db, list(hits.values()),
+                                          str(model))
     json_results = jsonify(results)
 
     return json_results
@@ -190,6 +395,8 @@ def structure_search_api(db_name, smiles=None, stereo=True):
 @mineserver_api.route('/substructure-search/<db_name>/smiles=<smiles>')
 @mineserver_api.route('/substructure-search/<db_name>/smiles=<smiles>'
                       '/<int:limit>')
+@cache_result
+@coalesce
 def substructure_search_api(db_name, smiles=None, limit=-1):
     """Perform a substructure search and return results.
 
@@ -218,18 +425,22 @@ def substructure_search_api(db_name, smiles=None, limit=-1):
 
     if json_data and 'mol' in json_data:
         mol_str = str(json_data['mol'])
-        smiles = get_smiles_from_mol_string(mol_str)
+        from minedatabase.utils import get_smiles_from_mol_string
+        with phase('parse'):
+            smiles = get_smiles_from_mol_string(mol_str)
 
     if json_data and 'model' in json_data:
         model = str(json_data['model'])
     else:
         model = None
 
-    model_db = mongo.cx[app.config['KEGG_DB_NAME']]
+    model_db = get_db(app.config['KEGG_DB_NAME'])
 
-    db = mongo.cx[db_name]
-    results = substructure_search(db, smiles, limit=limit, model_db=model_db,
-                                  parent_filter=model)
+    db = get_db(db_name)
+    from minedatabase.queries import substructure_search
+    with phase('rdkit'):
+        results = substructure_search(db, smiles, limit=limit)
+    results = model_cache.score_compounds(model_db, results, model)
     json_results = jsonify(results)
 
     return json_results
@@ -249,32 +460,55 @@ def model_search_api(query):
     :return: JSON Document with KEGG org codes matching query.
     :rtype: flask.Response
     """
-    db = mongo.cx[app.config['KEGG_DB_NAME']]
-    results = model_search(db, query)
+    db = get_db(app.config['KEGG_DB_NAME'])
+    results = queries.model_search(db, query)
     json_results = jsonify(results)
 
     return json_results
 
 
 @mineserver_api.route('/database-query/<db_name>/q=<mongo_query>')
-def database_query_api(db_name, mongo_query):
+@mineserver_api.route('/database-query/<db_name>/q=<mongo_query>'
+                      '/model=<model>')
+@cache_result
+@coalesce
+def database_query_api(db_name, mongo_query, model=None):
     """Perform a direct query built with Mongo syntax.
 
     .. :quickref: MINE DB; Query MINE DB with Mongo syntax
 
+    The query plan is checked before the query is run. Depending on the
+    server's QUERY_COLLSCAN_POLICY, queries that would scan the entire
+    collection are run as is, capped to QUERY_COLLSCAN_LIMIT results or
+    rejected (403). Every query is limited to QUERY_MAX_TIME_MS on the server
+    (504 if exceeded). A summary of the query plan, including suggested
+    indexes for collection scans, is returned in the X-Query-Advisory header
+    (or in the error payload if the query is rejected).
+
     :param str db_name:
         Name of Mongo database to query against.
     :param str mongo_query:
         A valid Mongo query (e.g. .../q={"ID": "cpd00001"}).
+    :param str,optional model:
+        KEGG organism code (e.g. 'hsa'). Adds annotations to each compound
+        based on whether it is in or could be derived from the KEGG compounds
+        in this organism (provided in the 'Likelihood_score' field of each
+        compound document). Defaults to None.
 
     :return: JSON Documents matching provided Mongo query.
     :rtype: flask.Response
     """
-    db = mongo.cx[db_name]
-    results = advanced_search(db, mongo_query)
-    # TODO: add model to score_compounds (where None currently is)
-    results = score_compounds(db, results, None)
+    model_db = get_db(app.config['KEGG_DB_NAME'])
+
+    db = get_db(db_name)
+    results, advisory = guarded_find(
+        db, mongo_query, queries.default_projection(),
+        policy=app.config['QUERY_COLLSCAN_POLICY'],
+        limit=app.config['QUERY_COLLSCAN_LIMIT'],
+        max_time_ms=app.config['QUERY_MAX_TIME_MS'])
+    results = model_cache.score_compounds_batch(model_db, results, model)
     json_results = jsonify(results)
+    json_results.headers['X-Query-Advisory'] = json.dumps(advisory)
 
     return json_results
 
@@ -298,8 +532,9 @@ def get_ids_api(db_name, collection_name, query=None):
     :return: List of ids matching query in JSON format.
     :rtype: flask.Response
     """
-    db = mongo.cx[db_name]
-    results = get_ids(db, collection_name, query)
+    db = get_db(db_name)
+    query = literal_eval(query) if query else {}
+    results = queries.get_ids(db[collection_name], query)
     json_results = jsonify(results)
 
     return json_results
@@ -326,8 +561,8 @@ def get_comps_api(db_name):
     if not id_list:
         raise InvalidUsage('id_list must be specified in form data.')
 
-    db = mongo.cx[db_name]
-    results = get_comps(db, id_list)
+    db = get_db(db_name)
+    results = queries.get_comps(db, id_list)
     json_results = jsonify(results)
 
     return json_results
@@ -351,8 +586,8 @@ def get_rxns_api(db_name):
     """
     id_list = request.get_json()['id_list']
 
-    db = mongo.cx[db_name]
-    results = get_rxns(db, id_list)
+    db = get_db(db_name)
+    results = queries.get_rxns(db, id_list)
     json_results = jsonify(results)
 
     return json_results
@@ -380,8 +615,8 @@ def get_ops_api(db_name):
     else:
         id_list = None
 
-    db = mongo.cx[db_name]
-    results = get_ops(db, id_list)
+    db = get_db(db_name)
+    results = queries.get_ops(db, id_list)
     json_results = jsonify(results)
 
     return json_results
@@ -401,8 +636,8 @@ def get_op_w_rxns_api(db_name, op_id):
     :return: Operator JSON document (including associated reactions).
     :rtype: flask.Response
     """
-    db = mongo.cx[db_name]
-    results = get_op_w_rxns(db, op_id)
+    db = get_db(db_name)
+    results = queries.get_op_w_rxns(db, op_id)
     if results:
         json_results = jsonify(results)
         return json_results
@@ -445,12 +680,15 @@ def get_adduct_names_api(adduct_type='all'):
 
 
 @mineserver_api.route('/ms-adduct-search/<db_name>', methods=['POST'])
+@cache_result
+@coalesce
 def ms_adduct_search_api(db_name):
     """Search for commpound-adducts matching precursor mass(es).
 
     .. :quickref: Compound; Search MINE compounds with MS1 data
 
-    Attach all arguments besides db_name as JSON data in POST request.
+    Attach all arguments besides db_name as JSON data in POST request, or
+    upload the datafile as multipart/form-data (see file).
 
     :param str db_name:
         Name of Mongo database to query against.
@@ -464,6 +702,10 @@ def ms_adduct_search_api(db_name):
     :param str,optional text_type:
         Type of metabolomics datafile (mgf, mzXML, and msp are supported). If
         None, assumes m/z values are separated by newlines. Default is None.
+    :param file,optional file:
+        Metabolomics datafile, uploaded as multipart/form-data instead of
+        text. The other arguments are then form fields, and text_type
+        defaults to the type given by the file extension.
     :param list,optional adducts:
         List of adducts to use. If not specified, uses all adducts
         (adducts=None).
@@ -480,13 +722,17 @@ def ms_adduct_search_api(db_name):
         Filtered out if set to True. Defaults to False.
     :param bool,optional verbose:
         If True, verbose output. Defaults to False.
+    :param int,optional top_k:
+        If given, only return the top_k best compounds for each peak (native
+        compounds first, then by increasing mass error and generation).
+        Defaults to None (all compounds).
 
     :return:
         JSON array of compounds that match m/z within defined tolerance and
         after passing other defined filters (such as logP).
     :rtype: flask.Response
     """
-    json_data = request.get_json()
+    json_data = _read_ms_request()
 
     if 'tolerance' in json_data:
         tolerance = float(json_data['tolerance'])
@@ -555,10 +801,11 @@ def ms_adduct_search_api(db_name):
         'verbose': verbose
     }
 
-    db = mongo.cx[db_name]
-    keggdb = mongo.cx[app.config['KEGG_DB_NAME']]
+    db = get_db(db_name)
+    keggdb = get_db(app.config['KEGG_DB_NAME'])
 
-    results = ms_adduct_search(db, keggdb, text, text_type, ms_params)
+    results = ms_adduct_search(db, keggdb, text, text_type, ms_params,
+                               top_k=_read_top_k(json_data))
     json_results = jsonify(results)
 
     if results:
@@ -568,12 +815,15 @@ def ms_adduct_search_api(db_name):
 
 
 @mineserver_api.route('/ms2-search/<db_name>', methods=['POST'])
+@cache_result
+@coalesce
 def ms2_search_api(db_name):
     """Search for commpound-adducts matching precursor mass(es).
 
     .. :quickref: Compound; Search MINE compounds with MS2 data
 
-    Attach all arguments besides db_name as form data in POST request.
+    Attach all arguments besides db_name as JSON data in POST request, or
+    upload the datafile as multipart/form-data (see file).
 
     :param str db_name:
         Name of Mongo database to query against.
@@ -591,6 +841,10 @@ def ms2_search_api(db_name):
     :param str,optional text_type:
         Type of metabolomics datafile (mgf, mzXML, and msp are supported). If
         None, assumes m/z values are separated by newlines. Default is None.
+    :param file,optional file:
+        Metabolomics datafile, uploaded as multipart/form-data instead of
+        text. The other arguments are then form fields, and text_type
+        defaults to the type given by the file extension.
     :param list,optional adducts:
         List of adducts to use. If not specified, uses all adducts.
         (adducts=None)
@@ -605,14 +859,209 @@ def ms2_search_api(db_name):
     :param bool,optional halogens:
         Specifies whether to filter out compounds containing F, Cl, or Br.
         Filtered out if set to True. Defaults to False.
+    :param int,optional top_k:
+        If given, only return the top_k compounds with the best spectral
+        scores (over all spectra), best first. Defaults to None (all
+        compounds).
 
     :return:
         JSON array of compounds that match m/z within defined tolerance and
         after passing other defined filters (such as logP).
     :rtype: flask.Response
     """
-    json_data = request.get_json()
+    json_data = _read_ms_request()
+    text, text_type, ms_params = _read_ms2_params(json_data)
+
+    db = get_db(db_name)
+    keggdb = get_db(app.config['KEGG_DB_NAME'])
+
+    results = ms2_search(db, keggdb, text, text_type, ms_params,
+                         spectra_index=app.config['MS2_SPECTRA_INDEX'],
+                         top_k=_read_top_k(json_data))
+    json_results = jsonify(results)
+
+    return json_results
+
+
+@mineserver_api.route('/ms2-batch-search/<db_name>', methods=['POST'])
+def ms2_batch_search_api(db_name):
+    """Search for compounds matching every MS2 spectrum in a datafile.
+
+    .. :quickref: Compound; Search MINE compounds with a run of MS2 spectra
+
+    Takes the same arguments as ms2-search (as JSON in the POST request, or
+    with the datafile uploaded as multipart/form-data), where text is a whole
+    mgf, msp or mzXML run with any number of spectra. Spectra are parsed as
+    the datafile is read and searched in parallel, and the results of each
+    spectrum are streamed back as soon as it is done.
+
+    :param str db_name:
+        Name of Mongo database to query against.
+    :param int,optional top_k:
+        Number of best-scoring compounds returned for each spectrum. Defaults
+        to 10.
+
+    :return:
+        Newline-delimited JSON (application/x-ndjson), with one document per
+        spectrum in the order they finish. Each document has the 'index' of
+        the spectrum in the datafile, its 'name' and precursor 'mz', its
+        'total_hits' and its 'hits' (the top_k compounds with the best
+        spectral scores, best first), or an 'error' message.
+    :rtype: flask.Response
+    """
+    json_data = _read_ms_request()
+    text, text_type, ms_params = _read_ms2_params(json_data)
+    top_k = _read_top_k(json_data, default=10)
+
+    db = get_db(db_name)
+    keggdb = get_db(app.config['KEGG_DB_NAME'])
+
+    try:
+        results = ms2_batch_search(
+            db, keggdb, text, text_type, ms_params, top_k=top_k,
+            workers=app.config['MS2_BATCH_WORKERS'],
+            spectra_index=app.config['MS2_SPECTRA_INDEX'])
+    except (ValueError, IOError) as error:
+        raise InvalidUsage(str(error))
+
+    lines = (json.dumps(result) + '\n' for result in results)
+    return app.response_class(stream_with_context(lines),
+                              mimetype='application/x-ndjson')
+
+
+@mineserver_api.route('/spectra-download/<db_name>', methods=['GET', 'POST'])
+@mineserver_api.route('/spectra-download/<db_name>/q=<mongo_query>',
+                      methods=['GET', 'POST'])
+@coalesce
+def spectra_download_api(db_name, mongo_query=None):
+    """Download one or more spectra for compounds matching a given query.
+
+    .. :quickref: Spectra; Get computationally predicted MS2 spectra
+
+    :param str db_name:
+        Name of DB containing compound documents to search.
+    :param str,optional mongo_query:
+        A valid Mongo query as a literal string. If None, all compound spectra
+        are returned. Defaults to None.
+    :param str,optional parent_filter:
+        If set to a metabolic model's Mongo _id, only get spectra for compounds
+        in or derived from that metabolic model. Defaults to None.
+    :param bool,optional putative:
+        If False, only find known compounds (i.e. in Generation 0). Otherwise,
+        finds both known and predicted compounds. Defaults to True.
+
+    :return: Text of all matching spectra, including headers and peak lists.
+    :rtype: flask.Response
+    """
+    parent_filter = None
+    putative = None
+    if request.method == 'POST':
+        json_data = request.get_json()
+
+        if 'parent_filter' in json_data:
+            parent_filter = json_data['parent_filter']
+
+        if 'putative' in json_data:
+            putative = bool(json_data['putative'])
+
+    db = get_db(db_name)
+    from minedatabase.metabolomics import spectra_download
+    results = spectra_download(db, mongo_query=mongo_query,
+                               parent_filter=parent_filter, putative=putative)
+
+    return app.response_class(results)
+
+
+@mineserver_api.route('/telemetry')
+def telemetry_api():
+    """Get server metrics for this worker process.
+
+    .. :quickref: Server; Get server metrics
+
+    Includes Mongo connection pool metrics (checkouts, failed checkouts,
+    connections checked out and time spent waiting for a connection, per
+    server address).
+
+    :return:
+        JSON document with 'counters', 'gauges' and 'timers' (each timer has
+        a 'count' and the 'total', 'mean' and 'max' in seconds).
+    :rtype: flask.Response
+    """
+    return jsonify(metrics.snapshot())
+
+
+@mineserver_api.route('/ready')
+def ready_api():
+    """Check whether this worker has finished warming up (see api.warmup).
+
+    .. :quickref: Server; Check readiness
+
+    Load balancers and orchestrators should only send traffic to workers
+    that are ready.
+
+    :return:
+        JSON document with 'ready', the seconds each warm-up step took
+        ('timings') and the errors of failed steps ('errors'). The status
+        code is 200 if ready and 503 otherwise.
+    :rtype: flask.Response
+    """
+    state = app.extensions['warm_up']
+    response = jsonify({'ready': state.ready, 'timings': state.timings,
+                        'errors': state.errors})
+    response.status_code = 200 if state.ready else 503
+    return response
 
+
+@timed('parse')
+def _read_ms_request():
+    """Read the arguments of the metabolomics search routes.
+
+    Arguments are sent as JSON, or as multipart/form-data with the datafile
+    uploaded as 'file'. Form field values are parsed as JSON if they can be
+    (e.g. true or ["eco"]), and the uploaded file is not read into memory:
+    'text' is the file itself, for the searches to parse as they go.
+
+    Returns
+    -------
+    json_data : dict
+        Arguments, by name.
+    """
+    upload = request.files.get('file')
+    if upload is None:
+        return request.get_json()
+
+    json_data = {}
+    for key, value in request.form.items():
+        try:
+            json_data[key] = json.loads(value)
+        except ValueError:
+            json_data[key] = value
+    # JSON has no tuples, so e.g. logp=[-1, 2] is read as "(-1, 2)", the
+    # form the routes expect from JSON requests
+    if isinstance(json_data.get('logp'), list):
+        json_data['logp'] = str(tuple(json_data['logp']))
+    json_data['text'] = upload.stream
+
+    if 'text_type' not in json_data:
+        extension = os.path.splitext(upload.filename or '')[1].lower()
+        if extension in UPLOAD_TEXT_TYPES:
+            json_data['text_type'] = UPLOAD_TEXT_TYPES[extension]
+
+    return json_data
+
+
+def _read_ms2_params(json_data):
+    """Read the MS2 search arguments of the ms2-search routes.
+
+    Returns
+    -------
+    text : str or file
+        Text as in metabolomics datafile, or the uploaded datafile.
+    text_type : str or None
+        Type of metabolomics datafile.
+    ms_params : dict
+        Search settings, as in minedatabase.metabolomics.ms2_search.
+    """
     if 'tolerance' in json_data:
         tolerance = float(json_data['tolerance'])
     else:
@@ -694,51 +1143,25 @@ def ms2_search_api(db_name):
         'verbose': verbose
     }
 
-    db = mongo.cx[db_name]
-    keggdb = mongo.cx[app.config['KEGG_DB_NAME']]
+    return text, text_type, ms_params
 
-    results = ms2_search(db, keggdb, text, text_type, ms_params)
-    json_results = jsonify(results)
 
-    return json_results
+def _read_bool(value):
+    """Read a boolean argument, given as a bool or (in URLs) as a string."""
+    if isinstance(value, str):
+        return value.strip().lower() not in ('false', '0', 'no', '')
+    return bool(value)
 
 
-@mineserver_api.route('/spectra-download/<db_name>', methods=['GET', 'POST'])
-@mineserver_api.route('/spectra-download/<db_name>/q=<mongo_query>',
-                      methods=['GET', 'POST'])
-def spectra_download_api(db_name, mongo_query=None):
-    """Download one or more spectra for compounds matching a given query.
-
-    .. :quickref: Spectra; Get computationally predicted MS2 spectra
-
-    :param str db_name:
-        Name of DB containing compound documents to search.
-    :param str,optional mongo_query:
-        A valid Mongo query as a literal string. If None, all compound spectra
-        are returned. Defaults to None.
-    :param str,optional parent_filter:
-        If set to a metabolic model's Mongo _id, only get spectra for compounds
-        in or derived from that metabolic model. Defaults to None.
-    :param bool,optional putative:
-        If False, only find known compounds (i.e. in Generation 0). Otherwise,
-        finds both known and predicted compounds. Defaults to True.
-
-    :return: Text of all matching spectra, including headers and peak lists.
-    :rtype: flask.Response
-    """
-    parent_filter = None
-    putative = None
-    if request.method == 'POST':
-        json_data = request.get_json()
-
-        if 'parent_filter' in json_data:
-            parent_filter = json_data['parent_filter']
-
-        if 'putative' in json_data:
-            putative = bool(json_data['putative'])
-
-    db = mongo.cx[db_name]
-    results = spectra_download(db, mongo_query=mongo_query,
-                               parent_filter=parent_filter, putative=putative)
-
-    return app.response_class(results)
+def _read_top_k(json_data, default=None):
+    """Read the optional top_k argument of the metabolomics search routes."""
+    top_k = json_data.get('top_k', default)
+    if top_k is None:
+        return None
+    try:
+        top_k = int(top_k)
+    except (TypeError, ValueError):
+        top_k = 0
+    if top_k < 1:
+        raise InvalidUsage('<top_k> must be a positive integer.')
+    return top_k
@@ -1,12 +1,7 @@
 """This is the main file that runs the app. FLASK_APP env variable should be
 set to a path to this file (e.g. on Windows "set FLASK_APP=api/run.py")."""
 
-import logging
-import os
-from logging.handlers import RotatingFileHandler
-
 from flask import Flask
-from flask.logging import default_handler
 from flask_cors import CORS
 
 import sys
@@ -17,12 +12,21 @@ sys.path.insert(0, '../../MINE-Database')
 sys.path.insert(0, '..')  # required in deployment to import api modules
 
 
+from api.admission import admission_control
 from api.config import Config
-from api.database import mongo
+from api.database import databases
+from api.db_indexes import check_indexes_command, start_startup_check
+from api.index_refresh import IndexCache
+from api.log_queue import log_pipeline
+from api.models import model_cache
+from api.properties import backfill_properties_command
+from api.result_cache import result_cache_command
 from api.routes import mineserver_api
+from api.snapshot import export_snapshot_command
+from api.warmup import start_warm_up
 
 
-def create_app(instance_config=Config):
+def create_app(instance_config=Config, preload=False):
     """Create a Flask instance of MINE-Server with a specified configuration.
 
     Parameters
@@ -30,6 +34,12 @@ def create_app(instance_config=Config):
     instance_config : Config (default: app.config.Config)
         Specifies configuration for this instance. Useful to change when
         running unit tests (see app.config_unittest.ConfigUnitTest).
+    preload : bool, optional (default: False)
+        Set to True when the app is created before forking workers (e.g.
+        gunicorn's preload_app, see gunicorn.conf.py). Shared resources are
+        then warmed up before returning, and each worker must call
+        api.warmup.warm_up_worker after the fork. Otherwise, warm-up runs in
+        the background.
 
     Notes
     -----
@@ -44,38 +54,39 @@ def create_app(instance_config=Config):
     app.register_blueprint(mineserver_api, url_prefix='/mineserver')
 
     # Connect to Mongo Database
-    mongo.init_app(app)
+    databases.init_app(app)
+    model_cache.init_app(app)
+    IndexCache.init_app(app)
+
+    # Workers forked from a preloaded app share identical requests
+    if app.config['COALESCE_ACROSS_WORKERS'] is None:
+        app.config['COALESCE_ACROSS_WORKERS'] = preload
+
+    # Limit concurrent requests by route cost class
+    admission_control.init_app(app)
 
     # Allow CORS so we can have front end and back end on same server
     CORS(app)
 
-    # Initialize logger
-    if __name__ != '__main__':
-        gunicorn_logger = logging.getLogger('gunicorn.error')
-        app.logger.handlers = gunicorn_logger.handlers
-        app.logger.setLevel(gunicorn_logger.level)
-
-    root = logging.getLogger()
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    file_handler = RotatingFileHandler('logs/mine-server.log',
-                                       maxBytes=1000000, backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.DEBUG)
-    root.addHandler(file_handler)
-
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(logging.WARNING)
-    app.logger.addHandler(stream_handler)
-
-    # Add any other (e.g. rdkit) logs to flask logs
-    root.addHandler(default_handler)
-
-    app.logger.setLevel(logging.DEBUG)
+    # Register CLI commands
+    app.cli.add_command(check_indexes_command)
+    app.cli.add_command(backfill_properties_command)
+    app.cli.add_command(result_cache_command)
+    app.cli.add_command(export_snapshot_command)
+
+    # Initialize logger (records are written by a background thread,
+    # including any other (e.g. rdkit) logs reaching the root logger)
+    log_pipeline.init_app(app)
+
     app.logger.info('MINE-Server startup')
     app.logger.info('Running at http://127.0.0.1:5000')
 
+    # Check that the databases have the indexes the routes rely on
+    start_startup_check(app)
+
+    # Preload caches and connections (see the readiness route)
+    start_warm_up(app, preload=preload)
+
     return app
 
 
@@ -0,0 +1,997 @@
+"""Offline snapshots of MINE databases, served without a Mongo server.
+
+`flask export-snapshot` writes MINE databases (and the KEGG models) to a
+local directory, and with SNAPSHOT_DIR set, get_db returns SnapshotDatabase
+objects for the read-only routes instead of Mongo databases. They support
+the subset of the pymongo Database/Collection/Cursor API that the routes and
+minedatabase.queries use, with the same query semantics, so routes return
+the same documents as from Mongo.
+
+Each collection is stored as:
+    documents.bson: its documents, BSON-encoded one after the other (in
+        Mongo's natural order)
+    offsets.npy: start of each document in documents.bson (plus the end of
+        the file)
+    index.<field>.keys.npy and index.<field>.rows.npy: a sorted column of
+        the values of an indexed field (one entry per array element) and the
+        row of the document of each value
+
+All files are memory-mapped, so opening a snapshot only reads its manifest,
+and a query reads just the index entries and documents it needs. Queries on
+indexed fields (the _id and the first field of each index in
+api.db_indexes) look up candidate rows by binary search; other queries scan
+the collection. $text searches match whole words (without Mongo's
+stemming) and scan the collection."""
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+
+import bson
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo.errors import OperationFailure
+
+from api.database import get_db
+from api.db_indexes import KEGG_INDEXES, MINE_INDEXES
+from api.query_guard import index_name
+
+#: Version of the snapshot format
+FORMAT_VERSION = 1
+
+#: Fields not indexed in snapshots, since their indexes would be much larger
+#: than the documents (fingerprint bits)
+SKIPPED_INDEX_FIELDS = {'RDKit', 'MACCS'}
+
+#: String index keys longer than this many bytes are stored as hashes, which
+#: only serve equality lookups
+MAX_KEY_BYTES = 64
+
+#: Fields of the text index of each collection (see $text)
+TEXT_FIELDS = {'compounds': ('Names', 'Pathways'), 'models': ('_id', 'Name')}
+
+_MISSING = object()
+_RE_TYPE = type(re.compile(''))
+
+
+class SnapshotStore(object):
+    """The databases in a snapshot directory.
+
+    Parameters
+    ----------
+    path : str
+        Directory written by export_snapshot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as infile:
+            self.manifest = json.load(infile)
+        if self.manifest.get('format') != FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot format in {path}')
+        self._lock = threading.Lock()
+        self._databases = {}
+
+    def __contains__(self, db_name):
+        return db_name in self.manifest['databases']
+
+    def get_database(self, db_name):
+        """Get a database of the snapshot (opened on first use)."""
+        with self._lock:
+            if db_name not in self._databases:
+                self._databases[db_name] = SnapshotDatabase(
+                    db_name, os.path.join(self.path, db_name),
+                    self.manifest['databases'][db_name])
+            return self._databases[db_name]
+
+
+class SnapshotDatabase(object):
+    """Read-only stand-in for a pymongo Database, backed by a snapshot."""
+
+    def __init__(self, name, path, manifest):
+        self.name = name
+        self.path = path
+        self.manifest = manifest
+        self._lock = threading.Lock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = SnapshotCollection(
+                    self, name, self.manifest['collections'].get(name))
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self):
+        """Get the names of the collections in the snapshot."""
+        return sorted(self.manifest['collections'])
+
+    def command(self, command, value=None, **kwargs):
+        """Run the database commands that the app uses ('ping', 'dbStats',
+        'dbHash' and 'explain' of a find).
+
+        Raises
+        ------
+        OperationFailure
+            For other commands.
+        """
+        collections = self.manifest['collections']
+        if command == 'ping':
+            return {'ok': 1.0}
+        if command == 'dbStats':
+            return {'db': self.name, 'ok': 1.0,
+                    'collections': len(collections),
+                    'objects': sum(x['count'] for x in collections.values()),
+                    'dataSize': sum(x['bytes'] for x in collections.values())}
+        if command == 'dbHash':
+            names = kwargs.get('collections') or sorted(collections)
+            md5s = {name: collections[name]['md5'] for name in names
+                    if name in collections}
+            digest = hashlib.md5(json.dumps(md5s, sort_keys=True).encode())
+            return {'md5': digest.hexdigest(), 'collections': md5s, 'ok': 1.0}
+        if command == 'explain' and 'find' in value:
+            collection = self[value['find']]
+            return {'queryPlanner': {
+                'namespace': f"{self.name}.{value['find']}",
+                'winningPlan': collection.plan(value.get('filter') or {})[0]},
+                'ok': 1.0}
+        raise OperationFailure(f'Command {command} is not supported by '
+                               'snapshots')
+
+    def watch(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """Change streams are not supported by snapshots, which do not
+        change."""
+        raise OperationFailure('Change streams are not supported by '
+                               'snapshots')
+
+
+class SnapshotCollection(object):
+    """Read-only stand-in for a pymongo Collection, backed by a snapshot."""
+
+    def __init__(self, database, name, manifest):
+        import numpy as np
+
+        self.database = database
+        self.name = name
+        self.manifest = manifest
+        self._indexes = {}
+        self._offsets = None
+        self._data = None
+        if manifest is None:  # not in the snapshot, so empty
+            self._offsets = np.zeros(1, dtype=np.int64)
+            return
+
+        path = os.path.join(database.path, name)
+        self._offsets = np.load(os.path.join(path, 'offsets.npy'),
+                                mmap_mode='r')
+        if os.path.getsize(os.path.join(path, 'documents.bson')):
+            with open(os.path.join(path, 'documents.bson'), 'rb') as infile:
+                self._data = mmap.mmap(infile.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        for field, info in manifest['indexes'].items():
+            prefix = os.path.join(path, f'index.{field}')
+            self._indexes[field] = dict(
+                info, keys=np.load(prefix + '.keys.npy', mmap_mode='r'),
+                rows=np.load(prefix + '.rows.npy', mmap_mode='r'))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def find(self, filter=None,  # pylint: disable=redefined-builtin
+             projection=None):
+        """Find documents, as pymongo's Collection.find."""
+        return SnapshotCursor(self, filter or {}, projection)
+
+    def find_one(self, filter=None,  # pylint: disable=redefined-builtin
+                 projection=None):
+        """Find a document, as pymongo's Collection.find_one."""
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for doc in self.find(filter, projection).limit(1):
+            return doc
+        return None
+
+    def count_documents(self, filter):  # pylint: disable=redefined-builtin
+        """Count the documents matching a filter."""
+        return sum(1 for _ in self._matching_rows(filter))
+
+    def count(self, filter=None):  # pylint: disable=redefined-builtin
+        """Count documents (deprecated pymongo API used by minedatabase)."""
+        if not filter:
+            return len(self)
+        return self.count_documents(filter)
+
+    def estimated_document_count(self):
+        """Get the number of documents in the collection."""
+        return len(self)
+
+    def distinct(self, key, filter=None):  # pylint: disable=redefined-builtin
+        """Get the distinct values of a field."""
+        return self.find(filter).distinct(key)
+
+    def index_information(self):
+        """Get the indexes of the snapshot, as pymongo's
+        Collection.index_information."""
+        return {_index_name(field): {'key': [(field, 1)]}
+                for field in self._indexes}
+
+    def aggregate(self, pipeline):  # pylint: disable=unused-argument
+        """Aggregations are not supported by snapshots."""
+        raise OperationFailure('Aggregations are not supported by snapshots')
+
+    def watch(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """Change streams are not supported by snapshots, which do not
+        change."""
+        raise OperationFailure('Change streams are not supported by '
+                               'snapshots')
+
+    def document(self, row):
+        """Decode the document in a row."""
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        return bson.decode(self._data[start:end])
+
+    def plan(self, query):
+        """Choose how to find the documents matching a query.
+
+        Returns
+        -------
+        plan : dict
+            Summary of the plan, as the winningPlan of Mongo's explain.
+        rows : iterable
+            Rows of the candidate documents, in index order for index scans.
+        """
+        import numpy as np
+
+        if '$text' in query:
+            return {'stage': 'TEXT'}, range(len(self))
+        best = None
+        for field, condition in _top_level_conditions(query):
+            rows = self._index_rows(field, condition)
+            if rows is not None and (best is None or len(rows) < len(best[1])):
+                best = (field, rows)
+        if best is not None:
+            field, rows = best
+            return _fetch_plan(field), _unique_rows(rows)
+
+        branches = query.get('$or')
+        if branches:
+            plans, all_rows = [], []
+            for branch in branches:
+                plan, rows = self.plan(branch)
+                if plan['stage'] != 'FETCH':
+                    break
+                plans.append(plan['inputStage'])
+                all_rows.append(rows)
+            else:
+                return ({'stage': 'FETCH', 'inputStage': {
+                    'stage': 'OR', 'inputStages': plans}},
+                        _unique_rows(np.concatenate(all_rows)))
+        return {'stage': 'COLLSCAN'}, range(len(self))
+
+    def _matching_rows(self, query):
+        """Yield the rows of the documents matching a query (without $text)
+        with the documents."""
+        _, rows = self.plan(query)
+        for row in rows:
+            doc = self.document(row)
+            if matches(doc, query):
+                yield row, doc
+
+    def _index_rows(self, field, condition):
+        """Get the rows of the documents whose indexed field may match a
+        condition, or None if the index cannot serve it."""
+        import numpy as np
+
+        index = self._indexes.get(field)
+        if index is None:
+            return None
+        keys, rows = index['keys'], index['rows']
+        kind = index['kind']
+
+        if isinstance(condition, dict) and condition and \
+                all(op.startswith('$') for op in condition):
+            if '$eq' in condition:
+                values = [condition['$eq']]
+            elif '$in' in condition:
+                values = condition['$in']
+            elif '$all' in condition and condition['$all'] and \
+                    not isinstance(condition['$all'][0], dict):
+                values = condition['$all'][:1]
+            elif {'$gt', '$gte', '$lt', '$lte'} & set(condition) and \
+                    kind != 'hash':
+                return self._range_rows(keys, rows, kind, condition)
+            elif '$regex' in condition and kind == 'string':
+                prefix = _regex_prefix(condition['$regex'],
+                                       condition.get('$options', ''))
+                if not prefix:
+                    return None
+                lo = np.searchsorted(keys, prefix, side='left')
+                hi = np.searchsorted(keys, prefix + b'\xff', side='left')
+                return np.asarray(rows[lo:hi])
+            else:
+                return None
+        else:
+            values = [condition]
+
+        if not all(_key_type(value) is not None for value in values):
+            return None  # e.g. null, regular expression or array values
+        found = []
+        for value in sorted(set(_encode_key(value, kind) for value in values
+                                if _key_type(value) == _index_type(kind))):
+            if value is None:
+                continue
+            lo = np.searchsorted(keys, value, side='left')
+            hi = np.searchsorted(keys, value, side='right')
+            found.append(rows[lo:hi])
+        return np.concatenate(found) if found else np.zeros(0, np.int64)
+
+    def _range_rows(self, keys, rows, kind, condition):
+        """Rows of the index entries within the bounds of a condition."""
+        import numpy as np
+
+        lo, hi = 0, len(keys)
+        for op, value in condition.items():
+            if op not in ('$gt', '$gte', '$lt', '$lte'):
+                continue
+            if _key_type(value) != _index_type(kind):
+                return np.zeros(0, np.int64)  # Mongo compares within a type
+            key = _encode_key(value, kind)
+            if key is None:
+                return np.zeros(0, np.int64)
+            if op == '$gt':
+                lo = max(lo, np.searchsorted(keys, key, side='right'))
+            elif op == '$gte':
+                lo = max(lo, np.searchsorted(keys, key, side='left'))
+            elif op == '$lt':
+                hi = min(hi, np.searchsorted(keys, key, side='left'))
+            else:
+                hi = min(hi, np.searchsorted(keys, key, side='right'))
+        return np.asarray(rows[lo:max(lo, hi)])
+
+
+class SnapshotCursor(object):
+    """Read-only stand-in for a pymongo Cursor. The query runs when the
+    cursor is first iterated."""
+
+    def __init__(self, collection, query, projection=None):
+        self.collection = collection
+        self.query = query
+        if isinstance(projection, (list, tuple)):
+            projection = {field: 1 for field in projection}
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=1):
+        """Sort by a key, or by a list of (key, direction) pairs."""
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        """Skip the first documents."""
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        """Return at most limit documents (all if 0)."""
+        self._limit = limit
+        return self
+
+    def max_time_ms(self, max_time_ms):  # pylint: disable=unused-argument
+        """Accepted for compatibility; snapshot queries are not timed out."""
+        return self
+
+    def batch_size(self, batch_size):  # pylint: disable=unused-argument
+        """Accepted for compatibility."""
+        return self
+
+    def distinct(self, key):
+        """Get the distinct values of a field in the matching documents."""
+        values = []
+        for doc in _Query(self.collection, self.query).docs():
+            for value in _values(doc, key.split('.'), expand=True):
+                if value is not _MISSING and value not in values:
+                    values.append(value)
+        return values
+
+    def __iter__(self):
+        if self._results is None:
+            self._results = iter(self._run())
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            iter(self)
+        return next(self._results)
+
+    def _run(self):
+        """Yield the projected documents matching the query."""
+        query = _Query(self.collection, self.query)
+        scored = query.scored_docs()
+        if self._sort:
+            scored = _sorted(list(scored), self._sort)
+        n_yielded = 0
+        for i, (doc, score) in enumerate(scored):
+            if i < self._skip:
+                continue
+            if self._limit and n_yielded >= self._limit:
+                return
+            n_yielded += 1
+            yield project(doc, self.projection, score)
+
+
+class _Query(object):
+    """A find query on a snapshot collection, with its $text search."""
+
+    def __init__(self, collection, query):
+        self.collection = collection
+        self.query = {key: value for key, value in query.items()
+                      if key != '$text'}
+        text = query.get('$text')
+        self.terms = _terms(text['$search']) if text else None
+
+    def docs(self):
+        """Yield the matching documents."""
+        for doc, _ in self.scored_docs():
+            yield doc
+
+    def scored_docs(self):
+        """Yield the matching documents with their text search score (None
+        without $text)."""
+        _, rows = self.collection.plan(self.query)
+        fields = TEXT_FIELDS.get(self.collection.name, ())
+        for row in rows:
+            doc = self.collection.document(row)
+            if not matches(doc, self.query):
+                continue
+            if self.terms is None:
+                yield doc, None
+                continue
+            words = [word for field in fields
+                     for value in _values(doc, field.split('.'), expand=True)
+                     if isinstance(value, str) for word in _terms(value)]
+            score = sum(words.count(term) for term in self.terms)
+            if score:
+                yield doc, score / max(len(words), 1) + 0.5 * score
+
+
+def matches(doc, query):
+    """Check whether a document matches a Mongo query filter.
+
+    Supports the logical operators $and, $or and $nor and the field
+    operators $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists, $regex,
+    $all, $elemMatch, $size and $not, on dotted paths through embedded
+    documents and arrays.
+    """
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(doc, sub_query) for sub_query in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, sub_query) for sub_query in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, sub_query) for sub_query in condition):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure(f'Unsupported query operator {key}')
+        elif not _match_field(_values(doc, key.split('.')), condition):
+            return False
+    return True
+
+
+def project(doc, projection, score=None):
+    """Apply a find projection to a document.
+
+    Parameters
+    ----------
+    doc : dict
+        Document to project.
+    projection : dict or None
+        Fields to include (1) or exclude (0), and fields for the text score
+        ({'$meta': 'textScore'}).
+    score : float, optional (default: None)
+        Text search score of the document.
+
+    Returns
+    -------
+    projected : dict
+    """
+    if not projection:
+        return doc
+    meta = [field for field, value in projection.items()
+            if isinstance(value, dict)]
+    fields = {field: value for field, value in projection.items()
+              if not isinstance(value, dict)}
+    include = any(value for field, value in fields.items() if field != '_id')
+    if include:
+        tree = _projection_tree(field for field, value in fields.items()
+                                if value and field != '_id')
+        projected = _include(doc, tree)
+        if fields.get('_id', 1) and '_id' in doc:
+            projected = dict([('_id', doc['_id'])] + list(projected.items()))
+    else:
+        projected = _exclude(doc, _projection_tree(
+            field for field, value in fields.items() if not value))
+    for field in meta:
+        projected[field] = score
+    return projected
+
+
+def export_snapshot(db, out_dir, collections=None, index_spec=None,
+                    logger=None):
+    """Write the collections of a Mongo database to a snapshot directory.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        Database to export.
+    out_dir : str
+        Snapshot directory. The database is written to a subdirectory, and
+        the manifest is updated once it is complete.
+    collections : list, optional (default: None)
+        Collections to export. Defaults to all collections.
+    index_spec : dict, optional (default: None)
+        Maps collection names to lists of index keys (as in
+        api.db_indexes.MINE_INDEXES). The _id and the first field of each
+        index (except text indexes and SKIPPED_INDEX_FIELDS) are indexed.
+    logger : logging.Logger, optional (default: None)
+        Logger for progress.
+
+    Returns
+    -------
+    manifest : dict
+        Manifest entry of the exported database.
+    """
+    index_spec = index_spec or {}
+    collections = collections or sorted(db.list_collection_names())
+    tmp_dir = os.path.join(out_dir, f'.{db.name}.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    db_manifest = {'collections': {}, 'exported': time.time()}
+    for name in collections:
+        start = time.perf_counter()
+        fields = ['_id'] + [keys[0][0] for keys in index_spec.get(name, [])
+                            if keys[0][1] != 'text' and
+                            keys[0][0] not in SKIPPED_INDEX_FIELDS]
+        db_manifest['collections'][name] = write_collection(
+            os.path.join(tmp_dir, name), db[name].find(),
+            list(dict.fromkeys(fields)))
+        if logger:
+            logger.info('Exported %s.%s (%s documents) in %.1f s', db.name,
+                        name, db_manifest['collections'][name]['count'],
+                        time.perf_counter() - start)
+
+    db_dir = os.path.join(out_dir, db.name)
+    shutil.rmtree(db_dir, ignore_errors=True)
+    os.replace(tmp_dir, db_dir)
+    _update_manifest(out_dir, db.name, db_manifest)
+    return db_manifest
+
+
+def write_collection(path, docs, index_fields):
+    """Write documents and their indexes to a collection directory.
+
+    Returns
+    -------
+    manifest : dict
+        Collection manifest with the document 'count', their size in 'bytes',
+        the 'md5' of their BSON and the 'indexes' written.
+    """
+    import numpy as np
+
+    os.makedirs(path, exist_ok=True)
+    offsets = [0]
+    entries = {field: [] for field in index_fields}
+    md5 = hashlib.md5()
+    with open(os.path.join(path, 'documents.bson'), 'wb') as outfile:
+        for row, doc in enumerate(docs):
+            data = bson.encode(doc)
+            outfile.write(data)
+            md5.update(data)
+            offsets.append(offsets[-1] + len(data))
+            for field, field_entries in entries.items():
+                for value in set(_index_values(doc, field)):
+                    field_entries.append((value, row))
+    np.save(os.path.join(path, 'offsets.npy'),
+            np.array(offsets, dtype=np.int64))
+
+    indexes = {}
+    for field, field_entries in entries.items():
+        kind = _entries_kind([value for value, _ in field_entries])
+        if kind is None:
+            continue
+        keys = [_encode_key(value, kind) for value, _ in field_entries]
+        rows = np.array([row for _, row in field_entries], dtype=np.int64)
+        if kind == 'number':
+            keys = np.array(keys, dtype=np.float64)
+        elif kind == 'hash':
+            keys = np.array(keys, dtype=np.uint64)
+        else:
+            keys = np.array(keys, dtype=bytes)
+        order = np.lexsort((rows, keys))
+        prefix = os.path.join(path, f'index.{field}')
+        np.save(prefix + '.keys.npy', keys[order])
+        np.save(prefix + '.rows.npy', rows[order])
+        indexes[field] = {'kind': kind, 'entries': len(rows)}
+
+    return {'count': len(offsets) - 1, 'bytes': offsets[-1],
+            'md5': md5.hexdigest(), 'indexes': indexes}
+
+
+@click.command('export-snapshot')
+@click.option('--db', 'db_names', multiple=True,
+              help='MINE database to export (default: all in MINE_DB_NAMES).')
+@click.option('--out', 'out_dir', default=None,
+              help='Snapshot directory (default: SNAPSHOT_DIR).')
+@with_appcontext
+def export_snapshot_command(db_names, out_dir):
+    """Export MINE databases and the KEGG models to a snapshot directory."""
+    config = current_app.config
+    out_dir = out_dir or config['SNAPSHOT_DIR']
+    if not out_dir:
+        raise click.UsageError('Set --out or SNAPSHOT_DIR.')
+    os.makedirs(out_dir, exist_ok=True)
+    for db_name in db_names or config['MINE_DB_NAMES']:
+        manifest = export_snapshot(get_db(db_name, read_only=False), out_dir,
+                                   index_spec=MINE_INDEXES,
+                                   logger=current_app.logger)
+        click.echo(f"{db_name}: exported {len(manifest['collections'])} "
+                   'collections')
+    export_snapshot(get_db(config['KEGG_DB_NAME'], read_only=False), out_dir,
+                    collections=['models'], index_spec=KEGG_INDEXES,
+                    logger=current_app.logger)
+    click.echo(f"{config['KEGG_DB_NAME']}: exported models")
+
+
+def _update_manifest(out_dir, db_name, db_manifest):
+    """Add a database to the manifest of a snapshot directory."""
+    path = os.path.join(out_dir, 'manifest.json')
+    manifest = {'format': FORMAT_VERSION, 'databases': {}}
+    if os.path.exists(path):
+        with open(path) as infile:
+            manifest = json.load(infile)
+    manifest['databases'][db_name] = db_manifest
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _values(value, parts, expand=False):
+    """Get the values at a dotted path in a document, following arrays as
+    Mongo does. Arrays at the end of the path are returned both whole and as
+    their elements (or only as their elements if expand). Returns an empty
+    list if the path is missing."""
+    if not parts:
+        if isinstance(value, list):
+            return list(value) if expand else [value] + list(value)
+        return [value]
+    part, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        if part in value:
+            return _values(value[part], rest, expand)
+        return []
+    if isinstance(value, list):
+        found = []
+        if part.isdigit() and int(part) < len(value):
+            found += _values(value[int(part)], rest, expand)
+        for item in value:
+            if isinstance(item, dict):
+                found += _values(item, parts, expand)
+        return found
+    return []
+
+
+def _match_field(values, condition):
+    """Check a field condition against the values at its path."""
+    if isinstance(condition, dict) and condition and \
+            all(op.startswith('$') for op in condition):
+        return all(_match_operator(values, op, argument, condition)
+                   for op, argument in condition.items())
+    return _match_operator(values, '$eq', condition, {})
+
+
+def _match_operator(values, op, argument, condition):
+    """Check one query operator against the values at a path."""
+    if op == '$eq':
+        if argument is None:
+            return not values or any(value is None for value in values)
+        return any(_equal(value, argument) for value in values)
+    if op == '$ne':
+        return not _match_operator(values, '$eq', argument, condition)
+    if op in ('$gt', '$gte', '$lt', '$lte'):
+        return any(_compare(value, op, argument) for value in values)
+    if op == '$in':
+        return any(_match_operator(values, '$eq', item, condition)
+                   for item in argument)
+    if op == '$nin':
+        return not _match_operator(values, '$in', argument, condition)
+    if op == '$exists':
+        return bool(values) == bool(argument)
+    if op == '$regex':
+        pattern = _regex(argument, condition.get('$options', ''))
+        return any(isinstance(value, str) and pattern.search(value)
+                   for value in values)
+    if op == '$options':
+        return True  # used with $regex
+    if op == '$all':
+        return bool(argument) and all(
+            _match_operator(values, '$eq', item, condition)
+            if not (isinstance(item, dict) and '$elemMatch' in item)
+            else _match_operator(values, '$elemMatch', item['$elemMatch'],
+                                 condition) for item in argument)
+    if op == '$elemMatch':
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                if isinstance(item, dict) and \
+                        not all(key.startswith('$') for key in argument):
+                    if matches(item, argument):
+                        return True
+                elif _match_field([item], argument):
+                    return True
+        return False
+    if op == '$size':
+        return any(isinstance(value, list) and len(value) == argument
+                   for value in values)
+    if op == '$not':
+        return not _match_field(values, argument)
+    raise OperationFailure(f'Unsupported query operator {op}')
+
+
+def _type_order(value):
+    """Mongo's ordering of BSON types (values only compare within a type)."""
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, bson.ObjectId):
+        return 7
+    return 9
+
+
+def _equal(value, argument):
+    """Check whether a value equals a query value (or matches a regular
+    expression)."""
+    if isinstance(argument, _RE_TYPE):
+        return isinstance(value, str) and bool(argument.search(value))
+    return _type_order(value) == _type_order(argument) and value == argument
+
+
+def _compare(value, op, argument):
+    """Compare a value with a query value of the same type."""
+    if _type_order(value) != _type_order(argument) or value is None or \
+            isinstance(value, (dict, list)):
+        return False
+    try:
+        if op == '$gt':
+            return value > argument
+        if op == '$gte':
+            return value >= argument
+        if op == '$lt':
+            return value < argument
+        return value <= argument
+    except TypeError:
+        return False
+
+
+def _regex(pattern, options):
+    """Compile a $regex pattern with its options."""
+    if isinstance(pattern, _RE_TYPE):
+        return pattern
+    flags = 0
+    for option, flag in (('i', re.IGNORECASE), ('m', re.MULTILINE),
+                         ('s', re.DOTALL), ('x', re.VERBOSE)):
+        if option in options:
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _regex_prefix(pattern, options):
+    """Get the literal prefix (as UTF-8) that all matches of an anchored
+    regular expression start with, as Mongo does to use an index for it.
+    Returns None if the pattern is not anchored (including alternatives) or
+    is case-insensitive."""
+    if isinstance(pattern, _RE_TYPE) or 'i' in options or \
+            not pattern.startswith('^') or '|' in pattern:
+        return None
+    prefix = re.match(r'[^.^$*+?{}\[\]\\|()]*', pattern[1:]).group()
+    if pattern[1 + len(prefix):1 + len(prefix) + 1] in ('*', '?', '{'):
+        prefix = prefix[:-1]  # the last character is optional
+    return prefix.encode() or None
+
+
+def _sorted(scored, sort):
+    """Sort (document, score) pairs by a list of (key, direction) pairs."""
+    for key, direction in reversed(sort):
+        if isinstance(direction, dict):  # {'$meta': 'textScore'}
+            scored.sort(key=lambda pair: pair[1] or 0, reverse=True)
+            continue
+        descending = direction in (-1, 'descending')
+
+        def sort_key(pair, key=key, descending=descending):
+            values = _values(pair[0], key.split('.'), expand=True) or [None]
+            keys = [(_type_order(value), value) for value in values]
+            return _SortKey(max(keys) if descending else min(keys))
+
+        scored.sort(key=sort_key, reverse=descending)
+    return scored
+
+
+class _SortKey(object):
+    """Sort key that compares values of different types by type order."""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        if self.key[0] != other.key[0]:
+            return self.key[0] < other.key[0]
+        try:
+            return self.key[1] < other.key[1]
+        except TypeError:
+            return False
+
+
+def _projection_tree(fields):
+    """Turn dotted projection fields into a tree of nested dicts (True for
+    whole fields)."""
+    tree = {}
+    for field in fields:
+        node = tree
+        parts = field.split('.')
+        for part in parts[:-1]:
+            child = node.setdefault(part, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def _include(value, tree):
+    """Keep the fields of a projection tree, in document order."""
+    if isinstance(value, list):
+        return [_include(item, tree) for item in value
+                if isinstance(item, (dict, list))]
+    projected = {}
+    for key, item in value.items():
+        node = tree.get(key)
+        if node is True:
+            projected[key] = item
+        elif node is not None and isinstance(item, (dict, list)):
+            projected[key] = _include(item, node)
+    return projected
+
+
+def _exclude(value, tree):
+    """Remove the fields of a projection tree."""
+    if isinstance(value, list):
+        return [_exclude(item, tree) if isinstance(item, (dict, list))
+                else item for item in value]
+    projected = {}
+    for key, item in value.items():
+        node = tree.get(key)
+        if node is True:
+            continue
+        if node is not None and isinstance(item, (dict, list)):
+            projected[key] = _exclude(item, node)
+        else:
+            projected[key] = item
+    return projected
+
+
+def _top_level_conditions(query):
+    """Yield the (field, condition) pairs that all matches must satisfy."""
+    for key, condition in query.items():
+        if key == '$and':
+            for sub_query in condition:
+                yield from _top_level_conditions(sub_query)
+        elif not key.startswith('$'):
+            yield key, condition
+
+
+def _fetch_plan(field):
+    """Plan summary of an index scan on a field."""
+    return {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN',
+                                             'indexName': _index_name(field)}}
+
+
+def _index_name(field):
+    """Mongo's name for the index on a field."""
+    return '_id_' if field == '_id' else index_name([(field, 1)])
+
+
+def _unique_rows(rows):
+    """Remove repeated rows (from multikey indexes), keeping the first."""
+    import numpy as np
+
+    rows = np.asarray(rows, dtype=np.int64)
+    _, first = np.unique(rows, return_index=True)
+    return rows[np.sort(first)]
+
+
+def _index_values(doc, field):
+    """Get the scalar values of a field to index (elements of arrays)."""
+    return [value for value in _values(doc, field.split('.'), expand=True)
+            if not isinstance(value, (dict, list)) and value is not None]
+
+
+def _key_type(value):
+    """Type of index key a query value is compared with, or None if it
+    cannot be looked up in an index."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    return None
+
+
+def _index_type(kind):
+    """Type of the values of an index kind."""
+    return 'number' if kind == 'number' else 'string'
+
+
+def _entries_kind(values):
+    """Kind of index for the values of a field: 'number', 'string' (sorted
+    UTF-8 bytes), 'hash' (hashes of long strings) or None if the values are
+    of other or mixed types."""
+    types = {_key_type(value) for value in values}
+    if types == {'number'}:
+        return 'number'
+    if types == {'string'}:
+        longest = max(len(value.encode()) for value in values)
+        return 'string' if longest <= MAX_KEY_BYTES else 'hash'
+    return None
+
+
+def _encode_key(value, kind):
+    """Encode a value as a key of an index kind."""
+    if kind == 'number':
+        return float(value)
+    data = value.encode()
+    if kind == 'hash':
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                              'little')
+    if len(data) > MAX_KEY_BYTES or data.endswith(b'\0'):
+        return None
+    return data
+
+
+def _terms(text):
+    """Split text into lowercase words for $text search."""
+    return re.findall(r'\w+', text.lower())
@@ -0,0 +1,407 @@
+"""In-memory index of the predicted (CFM) MS2 spectra of MINE databases. MS2
+searches score all mass-matched candidates of a peak at once with array
+operations over the index (see SpectraIndex.score) instead of comparing
+spectra one compound at a time, and the mass lookup no longer has to fetch
+the spectra from Mongo."""
+
+import math
+
+import numpy as np
+
+from api.index_refresh import IndexCache
+from api.timing import timed
+
+#: Compound field holding the predicted spectra for each charge
+SPECTRA_KEYS = {True: 'Pos_CFM_spectra', False: 'Neg_CFM_spectra'}
+
+#: Fragmentation energy levels of the predicted spectra
+ENERGY_LEVELS = (10, 20, 40)
+
+#: Scoring functions that can be used with SpectraIndex.score
+METRICS = ('jaccard', 'dot product')
+
+
+class SpectraIndex(object):
+    """Predicted spectra of many compounds at one charge and energy level,
+    stored as a sparse compounds x m/z matrix in CSR layout.
+
+    Row i holds the peaks of compound ids[i] sorted by m/z: their m/z values
+    are mz[indptr[i]:indptr[i + 1]] and their intensities are
+    intensity[indptr[i]:indptr[i + 1]]. Exact m/z values are kept rather
+    than fixed-width bins, so that peaks match exactly as in
+    minedatabase.metabolomics.approximate_matches.
+
+    Parameters
+    ----------
+    ids : list
+        Compound _ids.
+    spectra : list
+        Spectrum of each compound, as a list of (m/z, intensity) pairs.
+
+    Attributes
+    ----------
+    rows : dict
+        Row of each compound _id. Rows of compounds whose spectra have been
+        replaced (see updated) are not in it.
+    sq_norms : numpy.ndarray
+        Sum of squared intensities of each row.
+    """
+
+    def __init__(self, ids, spectra):
+        self.ids = list(ids)
+        self.rows = {_id: i for i, _id in enumerate(self.ids)}
+        spectra = [sorted((float(mz), float(i)) for mz, i in spectrum)
+                   for spectrum in spectra]
+        lengths = [len(spectrum) for spectrum in spectra]
+        self.indptr = np.zeros(len(spectra) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=self.indptr[1:])
+        self.mz = np.array([mz for spectrum in spectra for mz, _ in spectrum],
+                           dtype=float)
+        self.intensity = np.array([i for spectrum in spectra
+                                   for _, i in spectrum], dtype=float)
+        # Summed in m/z order, as in minedatabase.metabolomics.dot_product
+        self.sq_norms = np.array([sum(i * i for _, i in spectrum)
+                                  for spectrum in spectra], dtype=float)
+
+    @classmethod
+    def from_db(cls, db, charge, energy_level):
+        """Load the predicted spectra of all compounds in a MINE database.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            Contains compound documents with predicted spectra.
+        charge : bool
+            Positive or negative mode (True for positive, False for negative).
+        energy_level : int
+            Fragmentation energy level (10, 20 or 40).
+
+        Returns
+        -------
+        index : SpectraIndex
+            Has a row for each compound with a spectrum at this energy level.
+        """
+        query, projection = spectra_query(charge, energy_level)
+        return cls(*_spectra(db.compounds.find(query, projection), charge,
+                             energy_level))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def updated(self, ids, spectra, removed=()):
+        """Get a new index with added or changed spectra.
+
+        Rows are appended, and the rows of changed or removed compounds are
+        dropped from rows (and from the arrays, once they are more than half
+        of them).
+
+        Parameters
+        ----------
+        ids : list
+            _ids of compounds with new spectra.
+        spectra : list
+            Spectrum of each compound, as a list of (m/z, intensity) pairs.
+        removed : set, optional (default: ())
+            _ids of compounds whose spectra were removed.
+
+        Returns
+        -------
+        index : SpectraIndex
+        """
+        added = SpectraIndex(ids, spectra)
+        index = SpectraIndex([], [])
+        index.ids = self.ids + added.ids
+        index.rows = dict(self.rows)
+        for _id in removed:
+            index.rows.pop(_id, None)
+        index.rows.update((_id, row + len(self.ids))
+                          for _id, row in added.rows.items())
+        index.indptr = np.concatenate([self.indptr,
+                                       added.indptr[1:] + self.indptr[-1]])
+        index.mz = np.concatenate([self.mz, added.mz])
+        index.intensity = np.concatenate([self.intensity, added.intensity])
+        index.sq_norms = np.concatenate([self.sq_norms, added.sq_norms])
+        if len(index.ids) > 2 * len(index.rows):
+            index = index._compacted()
+        return index
+
+    def _compacted(self):
+        """Get a copy of the index without the rows missing from rows."""
+        live = np.array(sorted(self.rows.values()), dtype=np.intp)
+        starts = self.indptr[live]
+        lengths = self.indptr[live + 1] - starts
+        peaks = _ranges(starts, lengths)
+        index = SpectraIndex([], [])
+        index.ids = [self.ids[row] for row in live.tolist()]
+        index.rows = {_id: i for i, _id in enumerate(index.ids)}
+        index.indptr = np.zeros(len(live) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=index.indptr[1:])
+        index.mz = self.mz[peaks]
+        index.intensity = self.intensity[peaks]
+        index.sq_norms = self.sq_norms[live]
+        return index
+
+    def spectrum(self, row):
+        """Get the spectrum in a row as a list of (m/z, intensity) pairs."""
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return list(zip(self.mz[start:end].tolist(),
+                        self.intensity[start:end].tolist()))
+
+    def score(self, rows, query, metric='dot product', tolerance=0.005):
+        """Score the spectra in some rows against a query spectrum.
+
+        Gives the same scores as the minedatabase jaccard and dot_product
+        functions. Those match peaks greedily in m/z order, which pairs each
+        peak with the one peak of the other spectrum within tolerance, if
+        there is only one. All matching pairs are found at once by searching
+        the sorted query m/z values, and scores are summed per row. Rows with
+        a peak within tolerance of several peaks (where greedy matching
+        depends on the order) are scored with the minedatabase function.
+
+        Parameters
+        ----------
+        rows : list
+            Rows to score.
+        query : list
+            Query spectrum, as a list of (m/z, intensity) pairs.
+        metric : str, optional (default: 'dot product')
+            Either 'jaccard' or 'dot product'.
+        tolerance : float, optional (default: 0.005)
+            Maximum m/z difference of matching peaks, in Da.
+
+        Returns
+        -------
+        scores : numpy.ndarray
+            Score of each row, between 0 and 1.
+        """
+        if metric not in METRICS:
+            raise ValueError("metric must be either 'jaccard' or "
+                             "'dot product'.")
+        query = sorted((float(mz), float(i)) for mz, i in query)
+        q_mz = np.array([mz for mz, _ in query], dtype=float)
+        q_int = np.array([i for _, i in query], dtype=float)
+
+        rows = np.asarray(rows, dtype=np.intp)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        peaks = _ranges(starts, lengths)
+        owner = np.repeat(np.arange(len(rows)), lengths)
+        c_mz, c_int = self.mz[peaks], self.intensity[peaks]
+
+        # Pairs of (candidate peak, query peak) within tolerance. The search
+        # window is widened so rounding cannot drop a pair, then filtered
+        # with the same comparison as approximate_matches.
+        lo = np.searchsorted(q_mz, c_mz - 2 * tolerance)
+        hi = np.searchsorted(q_mz, c_mz + 2 * tolerance, side='right')
+        pair_peak = np.repeat(np.arange(len(peaks)), hi - lo)
+        pair_query = _ranges(lo, hi - lo)
+        within = np.abs(q_mz[pair_query] - c_mz[pair_peak]) < tolerance
+        pair_peak, pair_query = pair_peak[within], pair_query[within]
+        pair_owner = owner[pair_peak]
+
+        ambiguous = lengths == 0
+        shared_peak = np.bincount(pair_peak, minlength=len(peaks)) > 1
+        ambiguous[owner[shared_peak]] = True
+        keys, counts = np.unique(pair_owner * len(query) + pair_query,
+                                 return_counts=True)
+        ambiguous[keys[counts > 1] // len(query)] = True
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if metric == 'dot product':
+                dots = np.bincount(pair_owner, minlength=len(rows),
+                                   weights=q_int[pair_query] * c_int[pair_peak])
+                q_norm = math.sqrt(sum(i * i for _, i in query))
+                scores = dots / (q_norm * np.sqrt(self.sq_norms[rows]))
+            else:
+                both = (q_int[pair_query] != 0) & (c_int[pair_peak] != 0)
+                intersect = np.bincount(pair_owner, weights=both,
+                                        minlength=len(rows))
+                scores = intersect / (len(query) + lengths - intersect)
+
+        for i in np.flatnonzero(ambiguous):
+            scores[i] = _score_one(query, self.spectrum(rows[i]), metric,
+                                   tolerance)
+        return scores
+
+
+class SpectraCache(IndexCache):
+    """Keeps a SpectraIndex for each (MINE database, charge, energy level),
+    built on first use (see api.index_refresh.IndexCache)."""
+
+    index_class = SpectraIndex
+    name = 'spectra'
+
+    def compounds(self, charge, energy_level):
+        return spectra_query(charge, energy_level)
+
+    def apply(self, index, changes, charge, energy_level):
+        return index.updated(*_spectra(changes.docs, charge, energy_level),
+                             removed=changes.removed)
+
+    def get_index(self, db, charge, energy_level):
+        """Get the spectra index of a MINE database, building it if needed.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            Contains compound documents with predicted spectra.
+        charge : bool
+            Positive or negative mode (True for positive, False for negative).
+        energy_level : int
+            Fragmentation energy level (10, 20 or 40).
+
+        Returns
+        -------
+        index : SpectraIndex
+        """
+        return super().get_index(db, bool(charge), int(energy_level))
+
+    def find_index(self, db, charge, energy_level):
+        """Get the spectra index of a MINE database for a search, or None
+        (see api.index_refresh.IndexCache.find_index). Energy levels without
+        predicted spectra have no index."""
+        if int(energy_level) not in ENERGY_LEVELS:
+            return None
+        return super().find_index(db, bool(charge), int(energy_level))
+
+    @timed('scoring')
+    def score_peak(self, db, peak, metric='dot product', energy_level=20,
+                   tolerance=0.005):
+        """Score the isomers of a peak against its MS2 spectrum.
+
+        Same as minedatabase.metabolomics.Peak.score_isomers: a
+        'Spectral_score' (score * 1000, rounded) is added to each isomer and
+        isomers are sorted by it, best first. Isomers without a predicted
+        spectrum get a score of None and are sorted last.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            MINE database the isomers were found in.
+        peak : minedatabase.metabolomics.Peak
+            Peak with ms2peaks and isomers.
+        metric : str, optional (default: 'dot product')
+            Either 'jaccard' or 'dot product'.
+        energy_level : int, optional (default: 20)
+            Fragmentation energy level (10, 20 or 40).
+        tolerance : float, optional (default: 0.005)
+            Maximum m/z difference of matching peaks, in Da.
+        """
+        for hit in peak.isomers:
+            hit.pop(SPECTRA_KEYS[bool(peak.charge)], None)
+        scores = self.score_compounds(
+            db, peak.charge, energy_level, [hit['_id'] for hit in peak.isomers],
+            peak.ms2peaks, metric, tolerance)
+        for hit, score in zip(peak.isomers, scores):
+            hit['Spectral_score'] = score
+
+        peak.isomers.sort(key=spectral_sort_key, reverse=True)
+
+    @timed('scoring')
+    def score_compounds(self, db, charge, energy_level, ids, query,
+                        metric='dot product', tolerance=0.005):
+        """Get the spectral scores of compounds against a query spectrum.
+
+        Parameters
+        ----------
+        db : Mongo DB
+            MINE database containing the compounds.
+        charge : bool
+            Positive or negative mode (True for positive, False for negative).
+        energy_level : int
+            Fragmentation energy level (10, 20 or 40).
+        ids : list
+            Compound _ids.
+        query : list
+            Query spectrum, as a list of (m/z, intensity) pairs.
+        metric : str, optional (default: 'dot product')
+            Either 'jaccard' or 'dot product'.
+        tolerance : float, optional (default: 0.005)
+            Maximum m/z difference of matching peaks, in Da.
+
+        Returns
+        -------
+        scores : list
+            Spectral score (score * 1000, rounded) of each compound, or None
+            for compounds without a predicted spectrum.
+        """
+        if not query:
+            raise ValueError('The ms2 peak list is empty')
+        charge = bool(charge)
+        spec_key = SPECTRA_KEYS[charge]
+        index = self.find_index(db, charge, energy_level)
+        index_rows = index.rows if index is not None else {}
+
+        scores = [None] * len(ids)
+        indexed, rows, missing = [], [], []
+        for i, _id in enumerate(ids):
+            row = index_rows.get(_id)
+            if row is None:
+                missing.append(i)
+            else:
+                indexed.append(i)
+                rows.append(row)
+
+        if indexed:
+            for i, score in zip(indexed, index.score(rows, query, metric,
+                                                     tolerance).tolist()):
+                scores[i] = round(score * 1000)
+
+        # Compounds not in the index (added since it was built, or without a
+        # spectrum), or all of them if the database has no index
+        if missing:
+            level = '%s V' % energy_level
+            spectra = {comp['_id']: comp.get(spec_key, {}).get(level)
+                       for comp in db.compounds.find(
+                           {'_id': {'$in': [ids[i] for i in missing]}},
+                           {'%s.%s' % (spec_key, level): 1})}
+            for i in missing:
+                spectrum = spectra.get(ids[i])
+                if spectrum is not None:
+                    score = _score_one(query, spectrum, metric, tolerance)
+                    scores[i] = round(score * 1000)
+
+        return scores
+
+
+def spectra_query(charge, energy_level):
+    """Get the query and projection of the compounds with predicted spectra
+    at a charge and energy level."""
+    field = '%s.%s V' % (SPECTRA_KEYS[bool(charge)], energy_level)
+    return {field: {'$exists': True}}, {field: 1}
+
+
+def _spectra(comps, charge, energy_level):
+    """Get the _ids and spectra (at a charge and energy level) of compound
+    documents."""
+    spec_key = SPECTRA_KEYS[bool(charge)]
+    level = '%s V' % energy_level
+    ids, spectra = [], []
+    for comp in comps:
+        ids.append(comp['_id'])
+        spectra.append(comp[spec_key][level])
+    return ids, spectra
+
+
+def _ranges(starts, lengths):
+    """Concatenate the ranges [start, start + length) into one array."""
+    firsts = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum(), dtype=np.intp) + \
+        np.repeat(starts - firsts, lengths)
+
+
+def _score_one(query, spectrum, metric, tolerance):
+    """Score one spectrum with the minedatabase scoring function."""
+    from minedatabase.metabolomics import dot_product, jaccard
+    func = dot_product if metric == 'dot product' else jaccard
+    return func(list(query), [tuple(peak) for peak in spectrum],
+                epsilon=tolerance)
+
+
+def spectral_sort_key(hit):
+    """Sort key putting isomers without a spectral score last."""
+    score = hit['Spectral_score']
+    return (score is not None, score or 0)
+
+
+spectra_cache = SpectraCache()  # pylint: disable=invalid-name
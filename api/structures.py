@@ -0,0 +1,133 @@
+"""Exact structure searches by InChIKey. A structure matches the compounds
+with the same InChIKey or, ignoring stereochemistry, the same connectivity
+block (the first 14 characters of the InChIKey), which are both lookups on
+the indexed Inchikey field. Batch searches look up the keys of many
+structures with a few queries."""
+
+from api.queries import default_projection
+from api.timing import timed
+
+#: Maximum number of compounds returned for a structure (as for quick search)
+MAX_RESULTS = 500
+
+
+@timed('rdkit')
+def inchikey(structure):
+    """Get the InChIKey of a structure.
+
+    Parameters
+    ----------
+    structure : str
+        A molecule in Molfile (with newlines) or SMILES format.
+
+    Returns
+    -------
+    inchi_key : str
+    """
+    from rdkit.Chem import AllChem
+    if "\n" in structure:
+        mol = AllChem.MolFromMolBlock(str(structure))
+    else:
+        mol = AllChem.MolFromSmiles(str(structure))
+    if not mol:
+        raise ValueError("Unable to parse comp_structure")
+    inchi_key = AllChem.InchiToInchiKey(AllChem.MolToInchi(mol))
+    if not inchi_key:
+        raise ValueError("Unable to compute the InChIKey of comp_structure")
+    return inchi_key
+
+
+def structure_search(db, structure, stereo=True):
+    """Find compounds that are exact matches to a structure.
+
+    Same results as minedatabase.queries.structure_search, with a single
+    query on the Inchikey index.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        MINE database to search.
+    structure : str
+        A molecule in Molfile or SMILES format.
+    stereo : bool, optional (default: True)
+        If True, uses stereochemistry in finding exact matches.
+
+    Returns
+    -------
+    results : list
+        Compound documents matching the structure.
+    """
+    inchi_key = inchikey(structure)
+    if stereo:
+        return [comp for comp in db.compounds.find(
+            {'Inchikey': inchi_key}, default_projection()).limit(MAX_RESULTS)
+                if comp['_id'][0] == 'C']
+    return list(db.compounds.find(_block_query(inchi_key[:14]),
+                                  default_projection()))
+
+
+def batch_structure_search(db, structures, stereo=True, chunk_size=500):
+    """Find the exact matches to many structures.
+
+    Parameters
+    ----------
+    db : Mongo DB
+        MINE database to search.
+    structures : list
+        Molecules in Molfile or SMILES format.
+    stereo : bool, optional (default: True)
+        If True, uses stereochemistry in finding exact matches.
+    chunk_size : int, optional (default: 500)
+        Number of distinct keys looked up by each query.
+
+    Returns
+    -------
+    results : list
+        A dict for each structure, in order, with its 'index', 'structure',
+        'inchikey' and 'hits' (compound documents matching it, as in
+        structure_search), or an 'error' message if it could not be parsed.
+    """
+    results = []
+    for i, structure in enumerate(structures):
+        result = {'index': i, 'structure': structure}
+        try:
+            result['inchikey'] = inchikey(structure)
+        except (ValueError, TypeError) as error:
+            result['error'] = str(error)
+        results.append(result)
+
+    # Hits by InChIKey (or by connectivity block if not stereo)
+    keys = sorted({_search_key(result['inchikey'], stereo)
+                   for result in results if 'inchikey' in result})
+    hits = {key: [] for key in keys}
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        if stereo:
+            query = {'Inchikey': {'$in': chunk}}
+        else:
+            query = {'$or': [_block_query(block) for block in chunk]}
+        for comp in db.compounds.find(query, default_projection()):
+            key_hits = hits.get(_search_key(comp['Inchikey'], stereo))
+            if key_hits is None:
+                continue
+            if stereo and (comp['_id'][0] != 'C' or
+                           len(key_hits) >= MAX_RESULTS):
+                continue
+            key_hits.append(comp)
+
+    for result in results:
+        if 'inchikey' in result:
+            result['hits'] = hits[_search_key(result['inchikey'], stereo)]
+    return results
+
+
+def _search_key(inchi_key, stereo):
+    """Key that matching compounds share: the InChIKey, or its connectivity
+    block if not stereo."""
+    return inchi_key if stereo else inchi_key[:14]
+
+
+def _block_query(block):
+    """Query for the InChIKeys starting with a connectivity block, as an
+    index range rather than a regular expression."""
+    return {'Inchikey': {'$gte': block + '-', '$lt': block + '.'}}
@@ -0,0 +1,77 @@
+"""In-process metrics store. Counters, gauges and timers are recorded here
+and served by the telemetry route. Values are per worker process."""
+
+import threading
+
+
+class Metrics(object):
+    """Thread-safe store of named counters, gauges and timers.
+
+    Names may have a label appended in braces (e.g. 'mongo.pool.wait{db1}')
+    to keep separate values for different clusters, routes, etc.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+
+    def increment(self, name, value=1, label=None):
+        """Add value to a counter."""
+        key = _key(name, label)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, label=None):
+        """Set a gauge to value."""
+        with self._lock:
+            self._gauges[_key(name, label)] = value
+
+    def add_gauge(self, name, delta, label=None):
+        """Add delta (which may be negative) to a gauge."""
+        key = _key(name, label)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name, seconds, label=None):
+        """Record one duration (in seconds) for a timer."""
+        key = _key(name, label)
+        with self._lock:
+            timer = self._timers.setdefault(
+                key, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+
+    def snapshot(self):
+        """Get a copy of all metrics.
+
+        Returns
+        -------
+        snapshot : dict
+            Has 'counters' and 'gauges' (dicts of name to value) and 'timers'
+            (dict of name to a dict with 'count', 'total', 'mean' and 'max',
+            in seconds).
+        """
+        with self._lock:
+            timers = {key: dict(timer, mean=timer['total'] / timer['count'])
+                      for key, timer in self._timers.items()}
+            return {'counters': dict(self._counters),
+                    'gauges': dict(self._gauges),
+                    'timers': timers}
+
+    def reset(self):
+        """Remove all metrics."""
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._timers = {}
+
+
+def _key(name, label):
+    """Combine a metric name and an optional label."""
+    return name if label is None else f'{name}{{{label}}}'
+
+
+metrics = Metrics()  # pylint: disable=invalid-name
@@ -0,0 +1,98 @@
+"""Per-request timing of the phases of a request: input parsing, RDKit
+computation, Mongo commands, scoring and serialization. Phase times are
+returned in a Server-Timing header and recorded in the metrics store, so
+browser devtools and load tests show where the time of each request goes.
+
+Code marks its phases with `phase` (a context manager) or `timed` (a
+decorator). Phases are exclusive: the time of nested phases and of Mongo
+commands (counted by api.database.CommandMetricsListener) is not counted
+again in the enclosing phase. Outside of a request, phases are not timed."""
+
+import functools
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from flask import jsonify as flask_jsonify
+from flask import request
+
+from api.database import request_mongo_stats
+from api.telemetry import metrics
+
+#: Phases reported in the Server-Timing header, with their descriptions
+PHASES = {
+    'parse': 'Input parsing',
+    'rdkit': 'RDKit',
+    'mongo': 'Mongo',
+    'scoring': 'Scoring',
+    'serialization': 'Serialization',
+}
+
+
+@contextmanager
+def phase(name):
+    """Time a block of code as part of a phase of the current request."""
+    if not has_request_context() or 'phase_times' not in g:
+        yield
+        return
+    stack = g.phase_stack
+    frame = {'nested': 0.0}
+    stack.append(frame)
+    mongo_start = request_mongo_stats()['seconds']
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        mongo = request_mongo_stats()['seconds'] - mongo_start
+        own = max(0.0, elapsed - frame['nested'] - mongo)
+        g.phase_times[name] = g.phase_times.get(name, 0.0) + own
+        if stack:
+            stack[-1]['nested'] += elapsed - mongo
+
+
+def timed(name):
+    """Decorator that times each call of a function as part of a phase."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def jsonify(*args, **kwargs):
+    """flask.jsonify, timed as the serialization phase."""
+    with phase('serialization'):
+        return flask_jsonify(*args, **kwargs)
+
+
+def start_timing():
+    """Start timing the phases of the current request (before_request)."""
+    g.phase_times = {}
+    g.phase_stack = []
+    g.request_start = time.perf_counter()
+
+
+def add_server_timing(response):
+    """Add the phase times of the current request to its response as a
+    Server-Timing header, and record them in the metrics store ('timing.'
+    followed by the phase name, labelled by endpoint) (after_request)."""
+    if 'request_start' not in g:
+        return response
+    times = dict(g.phase_times)
+    times['mongo'] = request_mongo_stats()['seconds']
+    total = time.perf_counter() - g.request_start
+
+    entries = []
+    for name, description in PHASES.items():
+        seconds = times.get(name, 0.0)
+        entries.append(f'{name};dur={seconds * 1000:.2f};desc="{description}"')
+        if seconds:
+            metrics.observe('timing.' + name, seconds, label=request.endpoint)
+    entries.append(f'total;dur={total * 1000:.2f};desc="Total"')
+    metrics.observe('timing.total', total, label=request.endpoint)
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
@@ -0,0 +1,246 @@
+"""Warm-up of expensive resources at startup, so that the first requests to
+each worker do not pay for them. Steps run in one of two phases:
+
+'process' steps load shared, read-only resources (heavy imports, adduct
+files, caches). When the app is preloaded by gunicorn (see gunicorn.conf.py),
+they run before workers are forked so that copy-on-write shares them.
+
+'worker' steps open per-process resources that cannot be shared across a
+fork (e.g. Mongo connections). They run in each worker after the fork.
+
+The readiness route reports ready only once both phases have finished and
+all steps have succeeded. Failed steps are retried in the background in each
+worker, with exponential backoff, until they succeed."""
+
+import importlib
+import threading
+import time
+
+from api.database import databases
+
+_STEPS = []
+
+
+def warm_up_step(name, phase='process'):
+    """Decorator that registers func(app) as a warm-up step."""
+    def decorator(func):
+        _STEPS.append((phase, name, func))
+        return func
+    return decorator
+
+
+class WarmUpState(object):
+    """Progress of the warm-up of one app.
+
+    Parameters
+    ----------
+    steps : list, optional (default: None)
+        (phase, name, func) of each step. Defaults to the steps registered
+        with warm_up_step.
+
+    Attributes
+    ----------
+    timings : dict
+        Seconds taken by each finished step, by step name.
+    errors : dict
+        Error message for each failed step (until it succeeds), by step name.
+    """
+
+    def __init__(self, steps=None):
+        self.steps = _STEPS if steps is None else steps
+        self.timings = {}
+        self.errors = {}
+        self._phases_done = set()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        """Whether both phases finished without errors."""
+        return self._phases_done >= {'process', 'worker'} and not self.errors
+
+    def run(self, app, phase):
+        """Run all steps of a phase, logging the time each one took."""
+        for step_phase, name, func in self.steps:
+            if step_phase == phase:
+                self._run_step(app, name, func)
+        self.skip(phase)
+
+    def retry(self, app, max_delay=60, delay=1):
+        """Retry failed steps until they all succeed, waiting delay seconds
+        before the first retry and doubling it (up to max_delay) after each.
+        Call with an app context."""
+        while self.errors:
+            time.sleep(delay)
+            for _, name, func in self.steps:
+                if name in self.errors:
+                    self._run_step(app, name, func)
+            delay = min(2 * delay, max_delay)
+
+    def start_retries(self, app):
+        """Retry failed steps in a background thread, if there are any."""
+        if not self.errors:
+            return
+
+        def retry():
+            with app.app_context():
+                self.retry(app, app.config['WARM_UP_RETRY_MAX_DELAY'])
+
+        threading.Thread(target=retry, name='warm-up-retry',
+                         daemon=True).start()
+
+    def _run_step(self, app, name, func):
+        """Run a step, recording its time or error."""
+        start = time.perf_counter()
+        try:
+            func(app)
+        except Exception as error:  # pylint: disable=broad-except
+            app.logger.exception('Warm-up step %s failed', name)
+            with self._lock:
+                self.errors[name] = str(error)
+            return
+        elapsed = time.perf_counter() - start
+        app.logger.info('Warm-up step %s took %.3f s', name, elapsed)
+        with self._lock:
+            self.timings[name] = elapsed
+            self.errors.pop(name, None)
+
+    def skip(self, phase):
+        """Mark a phase as done without running its steps."""
+        with self._lock:
+            self._phases_done.add(phase)
+
+
+def start_warm_up(app, preload=False):
+    """Warm up an app according to its WARM_UP config setting.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        App to warm up. Its WarmUpState is stored in
+        app.extensions['warm_up'].
+    preload : bool, optional (default: False)
+        If True, the app is loaded before forking workers. The 'process'
+        phase runs now (blocking) and the 'worker' phase must be run in each
+        worker with warm_up_worker, which also retries failed steps of both
+        phases. Otherwise, both phases (and retries) run in a background
+        thread.
+    """
+    state = app.extensions['warm_up'] = WarmUpState()
+    if not app.config['WARM_UP']:
+        state.skip('process')
+        state.skip('worker')
+        return
+
+    if preload:
+        with app.app_context():
+            state.run(app, 'process')
+        return
+
+    def run():
+        with app.app_context():
+            state.run(app, 'process')
+            state.run(app, 'worker')
+            state.retry(app, app.config['WARM_UP_RETRY_MAX_DELAY'])
+
+    threading.Thread(target=run, name='warm-up', daemon=True).start()
+
+
+def warm_up_worker(app):
+    """Run the 'worker' phase in a newly forked worker (gunicorn post_fork).
+
+    Mongo clients that were used before the fork are replaced first, since
+    PyMongo clients are not fork-safe. Failed steps of both phases are then
+    retried in a background thread (threads do not survive the fork, so
+    retries cannot start before it).
+    """
+    databases.connect(app)
+    state = app.extensions['warm_up']
+    with app.app_context():
+        state.run(app, 'worker')
+    state.start_retries(app)
+
+
+@warm_up_step('imports')
+def _import_modules(app):  # pylint: disable=unused-argument
+    """Import minedatabase and RDKit modules used by the routes, and send
+    RDKit's messages to the logging pipeline."""
+    for module in ('rdkit.Chem.AllChem', 'minedatabase.queries',
+                   'minedatabase.metabolomics', 'minedatabase.utils',
+                   'api.metabolomics', 'api.spectra'):
+        importlib.import_module(module)
+    from api.log_queue import capture_rdkit_logs
+    capture_rdkit_logs()
+
+
+@warm_up_step('adducts')
+def _read_adducts(app):
+    """Read the adduct files into the adduct name cache."""
+    from api.metabolomics import read_adduct_names
+    read_adduct_names(app.config['POS_ADDUCT_PATH'])
+    read_adduct_names(app.config['NEG_ADDUCT_PATH'])
+
+
+@warm_up_step('models')
+def _load_models(app):
+    """Load the compound sets of commonly used KEGG models."""
+    from api.database import get_db
+    from api.models import model_cache
+    kegg_db = get_db(app.config['KEGG_DB_NAME'])
+    for model_id in app.config['WARM_UP_MODELS']:
+        model_cache.get_parents(kegg_db, model_id)
+        for db_name in app.config['MINE_DB_NAMES']:
+            model_cache.get_native_set(get_db(db_name), kegg_db, [model_id])
+
+
+@warm_up_step('spectra')
+def _load_spectra(app):
+    """Build the MS2 spectra indexes of the MINE databases."""
+    from api.database import get_db
+    from api.spectra import spectra_cache
+    if not app.config['MS2_SPECTRA_INDEX']:
+        return
+    for db_name in app.config['MINE_DB_NAMES']:
+        for energy_level in app.config['WARM_UP_MS2_ENERGY_LEVELS']:
+            for charge in (True, False):
+                spectra_cache.get_index(get_db(db_name), charge, energy_level)
+
+
+@warm_up_step('quick_search')
+def _load_quick_search(app):
+    """Build the quick search indexes of the MINE databases."""
+    from api.database import get_db
+    from api.quick_search import quick_search_cache
+    if not app.config['QUICK_SEARCH_INDEX']:
+        return
+    for db_name in app.config['MINE_DB_NAMES']:
+        quick_search_cache.get_index(get_db(db_name))
+
+
+@warm_up_step('autocomplete')
+def _load_autocomplete(app):
+    """Build the autocomplete name indexes of the MINE databases."""
+    from api.autocomplete import autocomplete_cache
+    from api.database import get_db
+    if not app.config['AUTOCOMPLETE_INDEX']:
+        return
+    for db_name in app.config['MINE_DB_NAMES']:
+        autocomplete_cache.get_index(get_db(db_name))
+
+
+@warm_up_step('fingerprints')
+def _load_fingerprints(app):
+    """Build the fingerprint indexes of the MINE databases."""
+    from api.database import get_db
+    from api.fingerprints import fingerprint_cache
+    if not app.config['WARM_UP_FINGERPRINTS']:
+        return
+    for db_name in app.config['MINE_DB_NAMES']:
+        fingerprint_cache.get_index(get_db(db_name))
+
+
+@warm_up_step('mongo', phase='worker')
+def _connect_mongo(app):
+    """Open a connection to every configured database."""
+    from api.database import get_db
+    for db_name in [app.config['KEGG_DB_NAME']] + app.config['MINE_DB_NAMES']:
+        get_db(db_name).command('ping')
@@ -0,0 +1,67 @@
+"""Measure request throughput of a running MINE-Server instance. Used to
+compare the WSGI (api.run) and asyncio (api.async_run) serving modes.
+
+Example (same route against each server):
+    python benchmarks/throughput.py \
+        http://127.0.0.1:5000/mineserver/quick-search/KEGGexp2/q=C00022 \
+        --requests 5000 --concurrency 200
+"""
+
+import argparse
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def fetch(url):
+    """Request url, returning (HTTP status, latency in seconds)."""
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        status = error.code
+    return status, time.perf_counter() - start
+
+
+def run(url, n_requests, concurrency):
+    """Send n_requests to url with the given number of concurrent clients.
+
+    Returns
+    -------
+    stats : dict
+        Throughput (requests/s), error count and latency percentiles (ms).
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(fetch, [url] * n_requests))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'throughput': n_requests / elapsed,
+        'errors': sum(1 for status, _ in results if status != 200),
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', nargs='+', help='URL(s) to benchmark.')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Number of requests per URL.')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Number of concurrent clients.')
+    args = parser.parse_args()
+
+    for url in args.url:
+        stats = run(url, args.requests, args.concurrency)
+        print(f"{url}\n  {stats['throughput']:.1f} req/s, "
+              f"p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, "
+              f"{stats['errors']} errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Gunicorn settings for MINE-Server (gunicorn -c gunicorn.conf.py).
+
+The app is created once in the master process, which warms up shared caches
+before the workers are forked so that they share them copy-on-write. Each
+worker then opens its own Mongo connections in post_fork. The admission
+control slots shared by the workers are given back when a worker dies (e.g.
+killed by the timeout) in child_exit."""
+
+import multiprocessing
+
+from api.admission import admission_control, worker_threads
+from api.config import Config
+from api.warmup import warm_up_worker
+
+wsgi_app = 'api.run:create_app(preload=True)'  # pylint: disable=invalid-name
+bind = '0.0.0.0:5000'  # pylint: disable=invalid-name
+workers = multiprocessing.cpu_count() * 2 + 1  # pylint: disable=invalid-name
+preload_app = True  # pylint: disable=invalid-name
+
+# Threaded workers, so that requests waiting for an admission control slot
+# (or running heavy searches) do not hold a whole worker. Sized so that the
+# limited cost classes take at most half of the threads. The workers keep
+# heartbeating while their threads run long requests (e.g. batch MS2 searches
+# streaming results for minutes), so the default timeout is kept.
+worker_class = 'gthread'  # pylint: disable=invalid-name
+threads = worker_threads(  # pylint: disable=invalid-name
+    Config.ADMISSION_CLASSES, Config.ADMISSION_DEFAULT_CLASS, workers)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Replace the master's Mongo clients and warm up this worker."""
+    warm_up_worker(server.app.wsgi())
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Give back the admission control slots held by a dead worker."""
+    admission_control.reclaim(worker.pid)
@@ -14,7 +14,7 @@ setup(name='mine-server',
       license='MIT',
       packages=setuptools.find_packages(),
       install_requires=['pymongo', 'sphinxcontrib-httpdomain'],
-      extras_require={},
+      extras_require={'async': ['quart', 'pymongo>=4.9']},
       classifiers=[
           'Development Status :: 5 - Production/Stable',
           'Intended Audience :: Science/Research',
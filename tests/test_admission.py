@@ -0,0 +1,91 @@
+"""Test admission control by route cost class."""
+
+import multiprocessing
+import os
+import threading
+import time
+
+from api.admission import AdmissionClass, worker_threads
+from api.config import Config
+
+
+def test_admission_class_queue():
+    """
+    GIVEN a cost class with one slot and a queue of one
+    WHEN a request holds the slot and another is waiting for it
+    THEN make sure a third request is rejected straight away, and the waiting
+    one is admitted once the slot is released
+    """
+    cost_class = AdmissionClass('heavy', max_concurrent=1, max_queue=1,
+                                queue_timeout=5)
+    assert cost_class.acquire()
+
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(
+        cost_class.acquire()))
+    waiter.start()
+    while cost_class.queued < 1:
+        time.sleep(0.01)
+
+    start = time.perf_counter()
+    assert not cost_class.acquire()
+    assert time.perf_counter() - start < 1
+
+    cost_class.release()
+    waiter.join()
+    assert admitted == [True]
+    assert cost_class.running == 1
+    assert cost_class.queued == 0
+    cost_class.release()
+    assert cost_class.running == 0
+
+
+def test_admission_class_timeout():
+    """
+    GIVEN a cost class whose only slot is taken
+    WHEN a request waits longer than the queue timeout
+    THEN make sure it is rejected
+    """
+    cost_class = AdmissionClass('heavy', max_concurrent=1, max_queue=4,
+                                queue_timeout=0.1)
+    assert cost_class.acquire()
+    assert not cost_class.acquire()
+    assert cost_class.queued == 0
+
+
+def test_admission_class_reclaim():
+    """
+    GIVEN a cost class shared with a worker process
+    WHEN the worker dies while holding the only slot
+    THEN make sure the slot is given back by reclaiming the worker's slots
+    """
+    cost_class = AdmissionClass('heavy', max_concurrent=1, max_queue=1,
+                                queue_timeout=0.1)
+    context = multiprocessing.get_context('fork')
+    worker = context.Process(target=lambda: os._exit(
+        0 if cost_class.acquire() else 1))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+    assert cost_class.running == 1
+    assert not cost_class.acquire()
+
+    assert cost_class.reclaim(worker.pid) == 1
+    assert cost_class.running == 0
+    assert cost_class.acquire()
+    cost_class.release()
+
+
+def test_worker_threads():
+    """
+    GIVEN the default cost classes
+    WHEN the threads of each worker are sized from them
+    THEN make sure the limited classes can take at most half of all threads
+    """
+    for workers in (1, 3, 17):
+        threads = worker_threads(Config.ADMISSION_CLASSES,
+                                 Config.ADMISSION_DEFAULT_CLASS, workers)
+        limited = sum(settings['max_concurrent'] + settings['max_queue']
+                      for name, settings in Config.ADMISSION_CLASSES.items()
+                      if name != Config.ADMISSION_DEFAULT_CLASS)
+        assert 2 * limited <= workers * threads
@@ -3,7 +3,9 @@ contain data. The content of the responses is not tested, as the content is
 generated by dependencies in minedatabase, which already have their own
 tests."""
 
+import io
 import json
+import time
 
 import pytest
 from flask import url_for
@@ -68,6 +70,35 @@ def test_quick_search_api(client):
                   db_name='mongotest', query='cpd00348')
     response = client.get(url)
     assert_response_fields(response)
+    assert 'mongo;dur=' in response.headers['Server-Timing']
+
+
+def test_autocomplete_api(client):
+    """
+    GIVEN the start of a compound name, with and without a typo
+    WHEN autocomplete suggestions are received
+    THEN make sure the compound name is suggested
+    """
+    url = url_for('mineserver_api.quick_search_api',
+                  db_name='mongotest', query='cpd00348')
+    name = client.get(url).json[0]['Names'][0]
+
+    url = url_for('mineserver_api.autocomplete_api', db_name='mongotest',
+                  query=name[:4], limit=50)
+    response = client.get(url)
+    assert_response_fields(response)
+    assert name in [x['name'] for x in response.json]
+    assert all(x['match'] == 'prefix' for x in response.json)
+
+    typo = name[:-2] + name[-1]
+    url = url_for('mineserver_api.autocomplete_api', db_name='mongotest',
+                  query=typo)
+    response = client.get(url)
+    assert name.lower() in [x['name'].lower() for x in response.json]
+
+    url = url_for('mineserver_api.autocomplete_api', db_name='mongotest',
+                  query=name, limit=0)
+    assert client.get(url).status_code == 400
 
 
 def test_similarity_search_api(client, mol_str):
@@ -111,6 +142,41 @@ def test_similarity_search_api(client, mol_str):
     assert_response_fields(response)
 
 
+def test_similarity_batch_search_api(client):
+    """
+    GIVEN a list of structures, one of them invalid
+    WHEN they are queried against a MINE DB in one request
+    THEN make sure each gets the same matches as a single similarity search
+    """
+    smiles = r'Nc1ncnc2c1ncn2[C@@H]1O[C@H](COP(=O)(O)OP(=O)(O)O)[C@@H](O)' \
+             r'[C@H]1O'
+    url = url_for('mineserver_api.similarity_search_api', db_name='mongotest',
+                  smiles=smiles, min_tc=0.5)
+    expected = client.get(url).json
+
+    url = url_for('mineserver_api.similarity_batch_search_api',
+                  db_name='mongotest')
+    json_dict = {'structures': [smiles, 'CCO', 'not a smiles'], 'min_tc': 0.5}
+    response = post_json(client, url, json_dict)
+    assert_response_fields(response)
+    results = response.json
+    assert [result['index'] for result in results] == [0, 1, 2]
+    assert sorted(x['_id'] for x in results[0]['hits']) == \
+        sorted(x['_id'] for x in expected)
+    scores = [x['Tanimoto'] for x in results[0]['hits']]
+    assert scores == sorted(scores, reverse=True)
+    assert 'error' in results[2]
+
+    json_dict['limit'] = 1
+    response = post_json(client, url, json_dict)
+    assert len(response.json[0]['hits']) == min(1, len(expected))
+
+    json_dict = {'structures': [smiles, smiles, 'CCO'], 'mode': 'queries'}
+    response = post_json(client, url, json_dict)
+    assert_response_fields(response)
+    assert response.json[0]['hits'] == [{'index': 1, 'Tanimoto': 1.0}]
+
+
 def test_structure_search_api(client, mol_str):
     """
     GIVEN a structure in SMILES format
@@ -135,6 +201,36 @@ def test_structure_search_api(client, mol_str):
     assert_response_fields(response)
 
 
+def test_structure_batch_search_api(client, mol_str):
+    """
+    GIVEN a list of structures in SMILES and mol format, one of them invalid
+    WHEN they are queried against a MINE DB in one request
+    THEN make sure each gets the same matches as a single structure search
+    """
+    smiles = r'Nc1ncnc2c1ncn2[C@@H]1O[C@H](COP(=O)(O)OP(=O)(O)O)[C@@H](O)' \
+             r'[C@H]1O'
+    url = url_for('mineserver_api.structure_search_api', db_name='mongotest',
+                  smiles=smiles)
+    expected = client.get(url).json
+
+    url = url_for('mineserver_api.structure_batch_search_api',
+                  db_name='mongotest')
+    json_dict = {'structures': [smiles, mol_str, 'not a smiles']}
+    response = post_json(client, url, json_dict)
+    assert_response_fields(response)
+    results = response.json
+    assert [result['index'] for result in results] == [0, 1, 2]
+    assert sorted(x['_id'] for x in results[0]['hits']) == \
+        sorted(x['_id'] for x in expected)
+    assert 'hits' in results[1]
+    assert 'error' in results[2]
+
+    json_dict = {'structures': [smiles], 'stereo': False}
+    response = post_json(client, url, json_dict)
+    assert_response_fields(response)
+    assert len(response.json[0]['hits']) >= len(expected)
+
+
 def test_substructure_search_api(client, mol_str):
     """
     GIVEN a substructure in SMILES format
@@ -188,6 +284,12 @@ def test_database_query_api(client):
     response = client.get(url)
     assert_response_fields(response)
 
+    url = url_for('mineserver_api.database_query_api', db_name='mongotest',
+                  mongo_query=query, model='eco')
+    response = client.get(url)
+    assert_response_fields(response)
+    assert all('Likelihood_score' in comp for comp in response.json)
+
 
 def test_get_ids_api(client):
     """
@@ -386,6 +488,67 @@ def test_ms_adduct_search_api_mzxml(client):
     assert_response_fields(response)
 
 
+def test_ms_adduct_search_api_upload(client):
+    """
+    GIVEN a request with an MS1 adduct search query with an uploaded mzXML file
+    WHEN a response is received
+    THEN make sure the response matches the same search sent as JSON
+    """
+    config = Config()
+    with open(config.TEST_DATA_DIR + '/mzxml_data.mzxml', 'rb') as infile:
+        mzxml_data = infile.read()
+
+    url = url_for('mineserver_api.ms_adduct_search_api', db_name='mongotest')
+    form_data = {
+        'tolerance': '1000',
+        'charge': 'true',
+        'file': (io.BytesIO(mzxml_data), 'mzxml_data.mzxml')
+    }
+    response = client.post(url, data=form_data,
+                           content_type='multipart/form-data')
+    assert_response_fields(response)
+
+    json_dict = {
+        'tolerance': 1000,
+        'charge': True,
+        'text': mzxml_data.decode(),
+        'text_type': 'mzxml'
+    }
+    assert response.json == post_json(client, url, json_dict).json
+
+
+def test_ms_adduct_search_api_upload_logp(client):
+    """
+    GIVEN a request with an MS1 adduct search query with an uploaded file and
+        a logp range (a JSON list) in the form
+    WHEN a response is received
+    THEN make sure the response matches the same search sent as JSON
+    """
+    config = Config()
+    with open(config.TEST_DATA_DIR + '/mzxml_data.mzxml', 'rb') as infile:
+        mzxml_data = infile.read()
+
+    url = url_for('mineserver_api.ms_adduct_search_api', db_name='mongotest')
+    form_data = {
+        'tolerance': '1000',
+        'charge': 'true',
+        'logp': '[-35, 35]',
+        'file': (io.BytesIO(mzxml_data), 'mzxml_data.mzxml')
+    }
+    response = client.post(url, data=form_data,
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+
+    json_dict = {
+        'tolerance': 1000,
+        'charge': True,
+        'logp': '(-35, 35)',
+        'text': mzxml_data.decode(),
+        'text_type': 'mzxml'
+    }
+    assert response.json == post_json(client, url, json_dict).json
+
+
 def test_ms_adduct_search_api_msp(client):
     """
     GIVEN a request with an MS1 adduct search query is made in MSP format
@@ -496,6 +659,78 @@ def test_ms2_search_api_all_params(client):
     assert_response_fields(response)
 
 
+def test_ms_adduct_search_api_top_k(client):
+    """
+    GIVEN an MS1 adduct search query with top_k
+    WHEN a response is received
+    THEN make sure at most top_k compounds are returned for each peak
+    """
+    url = url_for('mineserver_api.ms_adduct_search_api', db_name='mongotest')
+    json_dict = {
+        'tolerance': 1000,
+        'charge': True,
+        'text': '161\n162',
+        'top_k': 2
+    }
+    response = post_json(client, url, json_dict)
+    assert_response_fields(response)
+    peak_names = [hit['peak_name'] for hit in response.json]
+    assert all(peak_names.count(name) <= 2 for name in peak_names)
+
+
+def test_ms2_search_api_top_k(client):
+    """
+    GIVEN an MS2 search query with and without top_k
+    WHEN responses are received
+    THEN make sure top_k returns the best-scoring compounds of the full search
+    """
+    url = url_for('mineserver_api.ms2_search_api', db_name='mongotest')
+    json_dict = {
+        'tolerance': 10,
+        'charge': True,
+        'energy_level': 20,
+        'scoring_function': 'dot product',
+        'text': '261.037\n43.0189 1\n59.013 1\n96.970 10',
+        'text_type': 'form'
+    }
+    full_response = post_json(client, url, json_dict)
+    json_dict['top_k'] = 1
+    response = post_json(client, url, json_dict)
+    assert_response_fields(response)
+    assert response.json == full_response.json[:1]
+
+
+def test_ms2_batch_search_api(client):
+    """
+    GIVEN a request with an mgf file with several MS2 spectra
+    WHEN the streamed response is received
+    THEN make sure there is one result per spectrum with at most top_k hits
+    """
+    url = url_for('mineserver_api.ms2_batch_search_api', db_name='mongotest')
+    spectrum = 'PEPMASS=261.037\nRTINSECONDS=0\n43.0189\t1\n59.013\t1\n' \
+        '96.970\t10\nEND IONS\n'
+    json_dict = {
+        'tolerance': 10,
+        'charge': True,
+        'energy_level': 20,
+        'scoring_function': 'dot product',
+        'text': ''.join('BEGIN IONS\nTITLE=spectrum_%s\n%s' % (i, spectrum)
+                        for i in range(3)),
+        'text_type': 'mgf',
+        'top_k': 2
+    }
+    response = post_json(client, url, json_dict)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    results = [json.loads(line) for line in response.data.splitlines()]
+    assert sorted(result['index'] for result in results) == [0, 1, 2]
+    for result in results:
+        assert 'error' not in result
+        assert result['total_hits'] > 0
+        assert 0 < len(result['hits']) <= 2
+
+
 def test_spectra_download_api(client):
     """
     GIVEN a request with a Mongo syntax query
@@ -522,3 +757,41 @@ def test_spectra_download_api(client):
     assert response
     assert response.status_code == 200
     assert response.data
+
+
+def test_telemetry_api(client):
+    """
+    GIVEN a request that queries a MINE DB
+    WHEN server metrics are requested afterwards
+    THEN make sure Mongo connection pool checkouts have been recorded
+    """
+    url = url_for('mineserver_api.quick_search_api',
+                  db_name='mongotest', query='cpd00348')
+    client.get(url)
+
+    url = url_for('mineserver_api.telemetry_api')
+    response = client.get(url)
+    assert_response_fields(response)
+    assert any(name.startswith('mongo.pool.checkouts')
+               for name in response.json['counters'])
+
+
+def test_ready_api(client):
+    """
+    GIVEN a newly started server
+    WHEN readiness is checked until warm-up finishes
+    THEN make sure the server becomes ready and reports its warm-up steps
+    """
+    url = url_for('mineserver_api.ready_api')
+    response = client.get(url)
+    for _ in range(100):
+        if response.status_code == 200:
+            break
+        assert response.status_code == 503
+        time.sleep(0.1)
+        response = client.get(url)
+
+    assert_response_fields(response)
+    assert response.json['ready']
+    assert {'imports', 'adducts', 'models', 'mongo'} <= \
+        set(response.json['timings'])
@@ -0,0 +1,105 @@
+"""Test the asyncio serving mode (api.async_run). Skipped if the optional
+quart package or PyMongo 4.9 (for its asyncio client) is not installed."""
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip('quart')
+pytest.importorskip('pymongo', minversion='4.9')
+
+from api.async_run import create_async_app  # noqa: E402
+from api.config import Config  # noqa: E402
+from api.snapshot import (_update_manifest,  # noqa: E402
+                          write_collection)
+
+
+def run_requests(*requests, config=Config):
+    """Send (method, url, json) requests to a new async app, returning each
+    response's status code and JSON data."""
+    app = create_async_app(config)
+
+    async def send_all():
+        results = []
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            for method, url, json_dict in requests:
+                response = await client.open(url, method=method,
+                                             json=json_dict)
+                results.append((response.status_code,
+                                await response.get_json()))
+        return results
+
+    return asyncio.run(send_all())
+
+
+def test_async_io_routes():
+    """
+    GIVEN the async app
+    WHEN the I/O-bound routes are requested
+    THEN make sure the responses are healthy and contain response data
+    """
+    results = run_requests(
+        ('GET', '/mineserver/quick-search/mongotest/q=cpd00348', None),
+        ('GET', '/mineserver/get-ids/mongotest/compounds', None),
+        ('POST', '/mineserver/get-comps/mongotest',
+         {'id_list': ["Ccffda1b2e82fcdb0e1e710cad4d5f70df7a5d74f"]}),
+        ('POST', '/mineserver/get-ops/mongotest', None),
+        ('GET', '/mineserver/get-op-w-rxns/mongotest/2.7.1.a', None),
+    )
+    for status_code, data in results:
+        assert status_code == 200
+        assert data
+
+
+def test_async_wsgi_fallback():
+    """
+    GIVEN the async app
+    WHEN a route without an async version is requested
+    THEN make sure it is served by the Flask app
+    """
+    results = run_requests(
+        ('GET', '/mineserver/get-adduct-names/positive', None),
+        ('GET', '/mineserver/get-adduct-names/invalid', None),
+    )
+    assert results[0][0] == 200 and results[0][1]
+    assert results[1][0] == 400
+
+
+def test_async_wsgi_fallback_body():
+    """
+    GIVEN the async app
+    WHEN a route without an async version is sent a large JSON body
+    THEN make sure the whole body is streamed to the Flask app
+    """
+    structures = ['CCO'] * 10001
+    results = run_requests(
+        ('POST', '/mineserver/structure-batch-search/mongotest',
+         {'structures': structures}),
+    )
+    assert results[0][0] == 400
+    assert 'at most 10000 structures' in results[0][1]['message']
+
+
+def test_async_snapshot(tmpdir):
+    """
+    GIVEN the async app with a snapshot of a database
+    WHEN an I/O-bound route is requested
+    THEN make sure it is served from the snapshot rather than from Mongo
+    """
+    compound = {'_id': 'C' + '0' * 40, 'MINE_id': 1, 'Names': ['Glucose']}
+    manifest = write_collection(
+        os.path.join(str(tmpdir), 'snaptest', 'compounds'), [compound],
+        ['_id', 'MINE_id'])
+    _update_manifest(str(tmpdir), 'snaptest',
+                     {'collections': {'compounds': manifest}})
+
+    class SnapshotConfig(Config):
+        SNAPSHOT_DIR = str(tmpdir)
+
+    results = run_requests(
+        ('GET', '/mineserver/quick-search/snaptest/q=1', None),
+        config=SnapshotConfig)
+    assert results[0][0] == 200
+    assert [comp['_id'] for comp in results[0][1]] == [compound['_id']]
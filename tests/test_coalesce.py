@@ -0,0 +1,135 @@
+"""Test single-flight coalescing of identical concurrent computations."""
+
+import fcntl
+import os
+import stat
+import threading
+import time
+
+from api.coalesce import (SingleFlight, dump_response, load_response,
+                          private_temp_dir)
+
+
+def run_concurrently(flight, key, func, n_threads):
+    """Call flight.do(key, func) from several threads at once."""
+    results = []
+    lock = threading.Lock()
+
+    def target():
+        result = flight.do(key, func)
+        with lock:
+            results.append(result)
+
+    threads = [threading.Thread(target=target) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def slow_counter():
+    """Get a slow function that counts how many times it is called."""
+    calls = []
+
+    def func():
+        calls.append(1)
+        time.sleep(0.2)
+        return b'result'
+
+    return func, calls
+
+
+def test_single_flight_threads():
+    """
+    GIVEN identical computations started from several threads at once
+    WHEN they are run through a SingleFlight
+    THEN make sure only one computation runs and all threads get its result
+    """
+    func, calls = slow_counter()
+    results = run_concurrently(SingleFlight(), 'key', func, 10)
+
+    assert len(calls) == 1
+    assert all(result == b'result' for result, _ in results)
+    assert sum(coalesced for _, coalesced in results) == 9
+
+
+def test_single_flight_lock_dir(tmpdir):
+    """
+    GIVEN a SingleFlight that also coalesces across processes
+    WHEN identical computations are run from several threads
+    THEN make sure only one computation runs, and later calls run again
+    """
+    flight = SingleFlight(str(tmpdir))
+    func, calls = slow_counter()
+    results = run_concurrently(flight, 'key', func, 5)
+    assert len(calls) == 1
+    assert all(result == b'result' for result, _ in results)
+
+    assert flight.do('key', func) == (b'result', False)
+    assert len(calls) == 2
+
+
+def test_single_flight_processes(tmpdir):
+    """
+    GIVEN SingleFlights in several processes sharing a lock directory
+    WHEN identical computations are run in them at once, or one at a time
+    THEN make sure only one computation runs, and its result is written for
+    the others only if they were waiting for it
+    """
+    func, calls = slow_counter()
+    flights = [SingleFlight(str(tmpdir)) for _ in range(2)]
+    results = []
+    threads = [threading.Thread(target=lambda f=flight: results.append(
+        f.do('key', func))) for flight in flights]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(results) == [(b'result', False), (b'result', True)]
+
+    os.remove(os.path.join(str(tmpdir), 'key.result'))
+    assert flights[0].do('key', func) == (b'result', False)
+    assert not os.path.exists(os.path.join(str(tmpdir), 'key.result'))
+
+
+def test_single_flight_prune(tmpdir):
+    """
+    GIVEN old lock files, one of which is held by a running computation
+    WHEN the lock directory is pruned
+    THEN make sure only the lock file that is not held is removed
+    """
+    flight = SingleFlight(str(tmpdir))
+    old = time.time() - 3600
+    paths = [os.path.join(str(tmpdir), name + '.lock')
+             for name in ('held', 'free')]
+    for path in paths:
+        open(path, 'a').close()
+        os.utime(path, (old, old))
+    with open(paths[0], 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        flight._prune()  # pylint: disable=protected-access
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+
+
+def test_shared_responses(app):
+    """
+    GIVEN a response to share with other workers
+    WHEN it is serialized and read back
+    THEN make sure it has the same status, headers and body, and that the
+    default directory for shared files is private to this user
+    """
+    with app.app_context():
+        response = app.response_class(b'{"hits": []}\n', status=201,
+                                      mimetype='application/json')
+        loaded = load_response(dump_response(response))
+        assert loaded.status_code == 201
+        assert loaded.get_data() == response.get_data()
+        assert list(loaded.headers.items()) == list(response.headers.items())
+
+    path = private_temp_dir('mine-server-test')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+    os.rmdir(path)
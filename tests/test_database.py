@@ -0,0 +1,76 @@
+"""Test the attribution of Mongo commands to requests."""
+
+import json
+import logging
+from types import SimpleNamespace
+
+from api.database import (CommandMetricsListener, _record_request_commands,
+                          databases, redact, request_mongo_stats)
+
+
+def command_events(request_id, command, duration_ms):
+    """Make the started and succeeded events of a command."""
+    command_name = next(iter(command))
+    started = SimpleNamespace(command_name=command_name, command=command,
+                              database_name='mongotest', request_id=request_id,
+                              connection_id=('localhost', 27017))
+    succeeded = SimpleNamespace(command_name=command_name, reply={'ok': 1},
+                                duration_micros=int(duration_ms * 1000),
+                                database_name='mongotest',
+                                request_id=request_id,
+                                connection_id=('localhost', 27017))
+    return started, succeeded
+
+
+def test_redact():
+    """
+    GIVEN a query filter with values, operators and lists
+    WHEN it is redacted
+    THEN make sure values are hidden but fields and operators are kept
+    """
+    query = {'Mass': {'$gt': 100, '$lt': 101}, 'Names': 'water',
+             '$or': [{'Charge': 1}, {'Charge': {'$in': [0, 1]}}]}
+    assert redact(query) == {'Mass': {'$gt': '?', '$lt': '?'}, 'Names': '?',
+                             '$or': [{'Charge': '?'}, {'Charge': {'$in': '?'}}]}
+
+
+def test_command_listener(app, caplog):
+    """
+    GIVEN a fast and a slow Mongo command run during a request
+    WHEN their monitoring events are received
+    THEN make sure they are counted for the request and only the slow one is
+    logged, with its filter redacted
+    """
+    listener = CommandMetricsListener(slow_ms=100)
+    fast = command_events(1, {'find': 'compounds', 'filter': {'_id': 'C1'}}, 5)
+    slow = command_events(2, {'find': 'compounds',
+                              'filter': {'Formula': 'C6H12O6'}}, 250)
+
+    with app.test_request_context('/mineserver/quick-search/mongotest/q=C1'):
+        app.preprocess_request()
+        with caplog.at_level(logging.WARNING,
+                             logger='mineserver.slow_queries'):
+            for started, succeeded in (fast, slow):
+                listener.started(started)
+                listener.succeeded(succeeded)
+        stats = request_mongo_stats()
+
+    assert stats['commands'] == 2
+    assert abs(stats['seconds'] - 0.255) < 1e-6
+    assert stats['slowest']['collection'] == 'compounds'
+    records = [json.loads(record.getMessage()) for record in caplog.records
+               if record.name == 'mineserver.slow_queries']
+    assert len(records) == 1
+    assert records[0]['db_name'] == 'mongotest'
+    assert records[0]['filter'] == {'Formula': '?'}
+
+
+def test_reconnect(app):
+    """
+    GIVEN an app whose Mongo clients are recreated (as in a forked worker)
+    WHEN its request teardown hooks are listed
+    THEN make sure the commands of each request are recorded only once
+    """
+    databases.connect(app)
+    hooks = app.teardown_request_funcs[None]
+    assert hooks.count(_record_request_commands) == 1
@@ -0,0 +1,31 @@
+"""Test the index checks against the declared index specification."""
+
+from api.database import mongo
+from api.db_indexes import MINE_INDEXES, check_indexes
+
+
+def test_check_indexes(app):
+    """
+    GIVEN a MINE DB
+    WHEN its indexes are checked against the declared specification
+    THEN make sure every collection is reported with missing/unused indexes
+    """
+    with app.app_context():
+        report = check_indexes(mongo.cx['mongotest'], MINE_INDEXES)
+
+    assert set(report) == set(MINE_INDEXES)
+    for collection, status in report.items():
+        assert all(keys in MINE_INDEXES[collection]
+                   for keys in status['missing'])
+        assert status['unused'] is None or isinstance(status['unused'], list)
+
+
+def test_check_indexes_command(app):
+    """
+    GIVEN the check-indexes CLI command
+    WHEN it is run without building indexes
+    THEN make sure it exits cleanly
+    """
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['check-indexes'])
+    assert result.exit_code == 0
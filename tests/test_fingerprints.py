@@ -0,0 +1,16 @@
+"""Test the in-memory fingerprint index of batch similarity searches."""
+
+from api.fingerprints import FingerprintIndex, pack
+
+
+def test_search_without_candidates():
+    """
+    GIVEN fingerprint indexes with no rows in a query's count window
+    WHEN they are searched
+    THEN make sure each query gets no hits
+    """
+    index = FingerprintIndex(['a', 'b'], [list(range(100)), list(range(200))],
+                             2048)
+    assert index.search(pack([[1]], 2048)) == [[]]
+    assert index.search(pack([[1], [2, 3]], 2048), 0.9, 5) == [[], []]
+    assert FingerprintIndex([], [], 2048).search(pack([[1]], 2048)) == [[]]
@@ -0,0 +1,66 @@
+"""Test that the app starts quickly. The app is imported in a new interpreter
+with "-X importtime", so the measurement does not depend on what other tests
+have already imported. Heavy dependencies (RDKit, pandas, NumPy and
+minedatabase) should only be imported by the routes that use them."""
+
+import os
+import subprocess
+import sys
+
+#: Maximum time to import api.run, in seconds. Raise it only if a new startup
+#: dependency is really needed.
+IMPORT_TIME_BUDGET = 1.0
+
+#: Packages that must not be imported when the app starts
+LAZY_PACKAGES = ('rdkit', 'pandas', 'numpy', 'minedatabase')
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def import_app():
+    """Import api.run in a new interpreter.
+
+    Returns
+    -------
+    modules : list
+        Names of all modules imported.
+    import_times : dict
+        Cumulative import time of each module, in seconds.
+    """
+    code = 'import sys, api.run; print(" ".join(sys.modules))'
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             cwd=REPO_DIR, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True,
+                             check=True)
+
+    # Lines are "import time: <self us> | <cumulative us> | <module>"
+    import_times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        import_times[module.strip()] = int(cumulative) / 1e6
+
+    return process.stdout.split(), import_times
+
+
+def test_lazy_imports():
+    """
+    GIVEN a new interpreter
+    WHEN the app is imported
+    THEN make sure no heavy dependency has been imported
+    """
+    modules, _ = import_app()
+    loaded = sorted(module for module in modules
+                    if module.split('.')[0] in LAZY_PACKAGES)
+    assert not loaded
+
+
+def test_import_time_budget():
+    """
+    GIVEN a new interpreter
+    WHEN the app is imported
+    THEN make sure importing it takes less than IMPORT_TIME_BUDGET
+    """
+    _, import_times = import_app()
+    assert import_times['api.run'] < IMPORT_TIME_BUDGET
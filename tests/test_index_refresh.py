@@ -0,0 +1,145 @@
+"""Test the incremental refresh of the in-memory compound indexes."""
+
+import os
+import random
+import time
+
+from api.autocomplete import NameIndex
+from api.database import mongo
+from api.fingerprints import FingerprintIndex, pack
+from api.index_refresh import Watermark, compound_changes, top_mine_id
+from api.quick_search import QuickSearchCache, QuickSearchIndex
+from api.snapshot import SnapshotDatabase, write_collection
+from api.spectra import SpectraIndex
+
+
+def make_compound(mine_id, names, generation=0):
+    """Compound document with the fields of the name indexes."""
+    return {'_id': 'C%040d' % mine_id, 'MINE_id': mine_id, 'Names': names,
+            'Generation': generation}
+
+
+def spectra_rows(index, ids):
+    """Rows of some compound _ids in a spectra index."""
+    return [index.rows[_id] for _id in ids]
+
+
+def test_name_index_versions():
+    """
+    GIVEN quick search and autocomplete indexes
+    WHEN new versions are made with added, changed and removed compounds
+    THEN make sure the new versions find them by their current names only,
+    and the previous versions are unchanged
+    """
+    comps = [make_compound(1, ['Glucose']), make_compound(2, ['Glycine'], 1)]
+    quick_index = QuickSearchIndex().updated(comps)
+    name_index = NameIndex().updated(comps)
+
+    changes = [make_compound(2, ['Glycine', 'Glycocoll']),
+               make_compound(3, ['Glucose'], 2)]
+    new_quick_index = quick_index.updated(changes)
+    new_name_index = name_index.updated(changes)
+
+    assert new_quick_index.lookup('Names', 'glucose') == ['C%040d' % 1,
+                                                          'C%040d' % 3]
+    assert quick_index.lookup('Names', 'glucose') == ['C%040d' % 1]
+    assert quick_index.lookup('Names', 'glycocoll') == []
+
+    renamed = new_quick_index.updated([make_compound(3, ['Glycocoll'])],
+                                      removed={'C%040d' % 1})
+    assert renamed.lookup('Names', 'glucose') == []
+    assert renamed.lookup('Names', 'glycocoll') == ['C%040d' % 2,
+                                                    'C%040d' % 3]
+    assert renamed.lookup('MINE_id', 1) == []
+    assert new_quick_index.lookup('Names', 'glucose') == ['C%040d' % 1,
+                                                          'C%040d' % 3]
+
+    def prefix_names(index):
+        return [(index.names[name_id], index.generations[name_id])
+                for name_id in index.prefix_matches('gl', 10)]
+    assert prefix_names(new_name_index) == [('Glucose', 0), ('Glycine', 0),
+                                            ('Glycocoll', 0)]
+    assert prefix_names(name_index) == [('Glucose', 0), ('Glycine', 1)]
+
+
+def test_array_index_versions():
+    """
+    GIVEN spectra and fingerprint indexes
+    WHEN new versions are made with added, changed and removed compounds
+    THEN make sure they score like indexes built from scratch
+    """
+    rng = random.Random(0)
+    spectra = {i: [[rng.uniform(50, 300), rng.uniform(1, 100)]
+                   for _ in range(rng.randint(1, 10))] for i in range(100)}
+    fingerprints = {i: rng.sample(range(2048), rng.randint(5, 100))
+                    for i in range(100)}
+    changed = list(range(40, 100))
+    spectra_index = SpectraIndex(range(50), [spectra[i] for i in range(50)])
+    spectra_index = spectra_index.updated(
+        changed, [spectra[i] for i in changed], removed={0})
+    fp_index = FingerprintIndex(list(range(50)),
+                                [fingerprints[i] for i in range(50)], 2048)
+    fp_index = fp_index.updated(changed, [fingerprints[i] for i in changed],
+                                removed={0})
+
+    ids = list(range(1, 100))
+    expected = SpectraIndex(ids, [spectra[i] for i in ids])
+    query = spectra[42]
+    assert len(spectra_index) == len(expected)
+    assert spectra_index.score(spectra_rows(spectra_index, ids),
+                               query).tolist() == \
+        expected.score(spectra_rows(expected, ids), query).tolist()
+
+    queries = pack([fingerprints[42], fingerprints[7]], 2048)
+    expected = FingerprintIndex(ids, [fingerprints[i] for i in ids], 2048)
+    for hits, expected_hits in zip(fp_index.search(queries, 0.1),
+                                   expected.search(queries, 0.1)):
+        assert sorted((fp_index.ids[row], score) for row, score in hits) == \
+            sorted((expected.ids[row], score) for row, score in expected_hits)
+
+
+def test_compound_changes(app):
+    """
+    GIVEN a MINE DB and a watermark below its highest MINE_id
+    WHEN the compounds changed since the watermark are fetched
+    THEN make sure they are those added after it, and that the new watermark
+    is at the highest MINE_id
+    """
+    with app.app_context():
+        db = mongo.cx['mongotest']
+        mine_id = top_mine_id(db)
+        watermark = Watermark(mine_id - 5)
+
+        changes = compound_changes(db, watermark, projection={'MINE_id': 1})
+        assert [comp['MINE_id'] for comp in changes.docs] == \
+            [comp['MINE_id'] for comp in db.compounds.find(
+                {'MINE_id': {'$gt': mine_id - 5}}).sort('MINE_id', 1)]
+        assert changes.watermark.mine_id == mine_id
+        assert not compound_changes(db, changes.watermark)
+
+
+def test_find_index(tmpdir):
+    """
+    GIVEN an index cache that keeps indexes of some databases
+    WHEN indexes are found for searches
+    THEN make sure only those databases get indexes, built in the background
+    """
+    path = os.path.join(str(tmpdir), 'compounds')
+    manifest = write_collection(path, [make_compound(1, ['Glucose'])],
+                                ['_id', 'MINE_id'])
+    databases = {'collections': {'compounds': manifest}}
+    db = SnapshotDatabase('indexed', str(tmpdir), databases)
+    other_db = SnapshotDatabase('other', str(tmpdir), databases)
+
+    cache = QuickSearchCache()
+    cache.db_names = frozenset(['indexed'])
+    assert cache.find_index(other_db) is None
+    assert cache.find_index(db) is None  # being built
+    for _ in range(100):
+        index = cache.find_index(db)
+        if index is not None:
+            break
+        time.sleep(0.05)
+    assert index.lookup('Names', 'glucose') == [make_compound(1, [])['_id']]
+    assert cache.find_index(other_db) is None
+    assert list(cache._entries) == [('indexed',)]
@@ -0,0 +1,46 @@
+"""Test the non-blocking logging pipeline."""
+
+import json
+import logging
+import queue
+
+from api.log_queue import JsonFormatter, NonBlockingQueueHandler, SamplingFilter
+
+
+def make_record(name, message, *args):
+    """Make a log record as a logger would."""
+    return logging.LogRecord(name, logging.ERROR, __file__, 1, message, args,
+                             None)
+
+
+def test_sampling_filter():
+    """
+    GIVEN a filter keeping 1 in 10 records of the rdkit logger
+    WHEN many rdkit and other records are filtered
+    THEN make sure 1 in 10 rdkit records and all other records are kept
+    """
+    sampling = SamplingFilter({'rdkit': 0.1})
+    kept = [sampling.filter(make_record('rdkit', 'SMILES Parse Error'))
+            for _ in range(100)]
+    assert sum(kept) == 10
+    assert sampling.filter(make_record('rdkit.Chem', 'Error'))
+    assert all(sampling.filter(make_record('api', 'message'))
+               for _ in range(100))
+
+
+def test_queue_handler():
+    """
+    GIVEN a queue handler with a bounded queue
+    WHEN more records are logged than the queue holds
+    THEN make sure extra records are dropped without blocking, and queued
+    records are formatted as JSON
+    """
+    handler = NonBlockingQueueHandler(queue.Queue(2))
+    for i in range(5):
+        handler.handle(make_record('api', 'record %s', i))
+    assert handler.queue.qsize() == 2
+
+    entry = json.loads(JsonFormatter().format(handler.queue.get()))
+    assert entry['message'] == 'record 0'
+    assert entry['logger'] == 'api'
+    assert entry['level'] == 'ERROR'
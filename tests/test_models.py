@@ -0,0 +1,103 @@
+"""Test the cached KEGG model compound sets against the minedatabase functions
+they replace."""
+
+import copy
+import os
+
+from minedatabase.metabolomics import get_KEGG_comps
+from minedatabase.queries import DEFAULT_PROJECTION
+from minedatabase.utils import score_compounds
+
+from api.database import mongo
+from api.models import ModelCache
+from api.snapshot import SnapshotDatabase, write_collection
+
+
+def test_score_compounds(app):
+    """
+    GIVEN compounds from a MINE DB and a KEGG model
+    WHEN they are scored with the cached model compound set
+    THEN make sure the scores match minedatabase.utils.score_compounds
+    """
+    with app.app_context():
+        db = mongo.cx['mongotest']
+        kegg_db = mongo.cx[app.config['KEGG_DB_NAME']]
+        compounds = list(db.compounds.find({}, DEFAULT_PROJECTION))
+        assert compounds
+
+        cache = ModelCache()
+        for model_id in ['eco', 'hsa']:
+            expected = score_compounds(kegg_db, copy.deepcopy(compounds),
+                                       model_id)
+            actual = cache.score_compounds(kegg_db, copy.deepcopy(compounds),
+                                           model_id)
+            assert actual == expected
+
+
+def test_get_native_set(app):
+    """
+    GIVEN a MINE DB and a list of KEGG models
+    WHEN the compounds in those models are requested from the cache
+    THEN make sure they match minedatabase.metabolomics.get_KEGG_comps
+    """
+    with app.app_context():
+        db = mongo.cx['mongotest']
+        kegg_db = mongo.cx[app.config['KEGG_DB_NAME']]
+
+        cache = ModelCache()
+        for model_ids in [['eco'], ['eco', 'hsa']]:
+            expected = get_KEGG_comps(db, kegg_db, model_ids)
+            assert cache.get_native_set(db, kegg_db, model_ids) == expected
+            # Second call is served from the cache
+            assert cache.get_native_set(db, kegg_db, model_ids) == expected
+
+
+def test_score_compounds_batch(app):
+    """
+    GIVEN compounds from a MINE DB and a KEGG model
+    WHEN they are scored in one batch
+    THEN make sure the scores match minedatabase.utils.score_compounds,
+    including for seed compounds without Sources
+    """
+    with app.app_context():
+        db = mongo.cx['mongotest']
+        kegg_db = mongo.cx[app.config['KEGG_DB_NAME']]
+        compounds = list(db.compounds.find({}, DEFAULT_PROJECTION))
+        assert compounds
+        compounds.append({'_id': 'Cseed', 'Generation': 0,
+                          'DB_links': {'KEGG': ['C00000']}})
+
+        cache = ModelCache()
+        for model_id in ['eco', 'hsa', None]:
+            expected = score_compounds(kegg_db, copy.deepcopy(compounds),
+                                       model_id)
+            actual = cache.score_compounds_batch(
+                kegg_db, copy.deepcopy(compounds), model_id)
+            assert actual == expected
+
+
+def test_native_set_growth(tmpdir):
+    """
+    GIVEN a MINE DB whose native compounds for a model are cached
+    WHEN compounds of the model are added to the DB
+    THEN make sure they are in the native set
+    """
+    kegg_path = os.path.join(str(tmpdir), 'kegg')
+    models = write_collection(os.path.join(kegg_path, 'models'),
+                              [{'_id': 'eco', 'Compounds': ['C00001',
+                                                            'C00002']}],
+                              ['_id'])
+    kegg_db = SnapshotDatabase('kegg', kegg_path,
+                               {'collections': {'models': models}})
+
+    comps = [{'_id': f'C{i:040d}', 'MINE_id': i,
+              'DB_links': {'KEGG': [f'C{i:05d}']}} for i in (1, 2, 3)]
+    cache = ModelCache(refresh_interval=0)
+    for n_comps, expected in [(1, {comps[0]['_id']}),
+                              (3, {comps[0]['_id'], comps[1]['_id']})]:
+        path = os.path.join(str(tmpdir), f'mine{n_comps}')
+        manifest = write_collection(os.path.join(path, 'compounds'),
+                                    comps[:n_comps], ['_id', 'MINE_id'])
+        db = SnapshotDatabase('mongotest', path,
+                              {'collections': {'compounds': manifest}})
+        assert cache.get_native_set(db, kegg_db, ['eco']) == expected
@@ -0,0 +1,38 @@
+"""Test the precomputed compound properties used by the MS search filters."""
+
+from api.properties import compute_logp, is_halogenated
+
+
+def test_is_halogenated():
+    """
+    GIVEN molecular formulas with and without F, Cl or Br
+    WHEN they are checked for halogens
+    THEN make sure they match the minedatabase halogen filter
+    """
+    assert is_halogenated('C6H5ClO')
+    assert is_halogenated('C2H2Br2')
+    assert is_halogenated('CF3O2')
+    assert not is_halogenated('C6H12O6')
+    assert not is_halogenated('C34H32FeN4O4')
+
+
+def test_compute_logp():
+    """
+    GIVEN SMILES strings
+    WHEN their logP is computed
+    THEN make sure valid ones get a value and invalid ones get None
+    """
+    assert compute_logp('CCCCCC') > compute_logp('OCC(O)CO')
+    assert compute_logp('not a smiles') is None
+
+
+def test_backfill_properties_command(app):
+    """
+    GIVEN the backfill-properties CLI command
+    WHEN it is run on the test MINE DB
+    THEN make sure it exits cleanly
+    """
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['backfill-properties', '--db', 'mongotest'])
+    assert result.exit_code == 0
+    assert 'mongotest' in result.output
@@ -0,0 +1,52 @@
+"""Test the query plan guard used by the database-query route."""
+
+import pytest
+
+from api.database import mongo
+from api.exceptions import InvalidUsage
+from api.query_guard import guarded_find, index_name, suggest_indexes
+
+
+def test_suggest_indexes():
+    """
+    GIVEN Mongo query filters
+    WHEN indexes are suggested for them
+    THEN make sure equality fields come before range fields
+    """
+    query = {'Mass': {'$gte': 100, '$lte': 101}, 'Charge': 0}
+    assert suggest_indexes(query) == [[('Charge', 1), ('Mass', 1)]]
+
+    query = {'$and': [{'Generation': {'$in': [0, 1]}},
+                      {'logP': {'$lt': 2}}]}
+    assert suggest_indexes(query) == [[('Generation', 1), ('logP', 1)]]
+
+    query = {'Charge': 0, '$or': [{'Names': 'water'}, {'Inchikey': 'X'}]}
+    assert suggest_indexes(query) == [[('Charge', 1), ('Names', 1)],
+                                      [('Charge', 1), ('Inchikey', 1)]]
+
+    assert index_name([('Charge', 1), ('Mass', 1)]) == 'Charge_1_Mass_1'
+
+
+def test_guarded_find(app):
+    """
+    GIVEN queries against a MINE DB
+    WHEN they are run through the query plan guard
+    THEN make sure collection scans are capped or rejected per the policy
+    """
+    with app.app_context():
+        db = mongo.cx['mongotest']
+
+        results, advisory = guarded_find(db, '{}', {'_id': 1},
+                                         policy='cap', limit=1)
+        assert advisory['collscan']
+        assert advisory['capped']
+        assert len(results) == 1
+
+        with pytest.raises(InvalidUsage) as excinfo:
+            guarded_find(db, '{"NP_likeness": {"$gt": -100}}', {'_id': 1},
+                         policy='reject')
+        suggested = excinfo.value.payload['suggested_indexes']
+        assert suggested[0]['name'] == 'NP_likeness_1'
+
+        with pytest.raises(InvalidUsage):
+            guarded_find(db, 'not a query', {'_id': 1})
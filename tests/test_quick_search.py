@@ -0,0 +1,47 @@
+"""Test the in-memory quick search index against the minedatabase quick
+search it replaces."""
+
+from minedatabase.queries import quick_search
+
+from api.database import mongo
+from api.quick_search import QuickSearchCache, classify_query
+
+
+def test_classify_query():
+    """
+    GIVEN quick search queries for each kind of identifier
+    WHEN they are classified
+    THEN make sure each is looked up in the right field
+    """
+    assert classify_query('C' + '0' * 40) == ('_id', 'C' + '0' * 40)
+    assert classify_query('C00031') == ('DB_links.KEGG', 'C00031')
+    assert classify_query('cpd00348') == ('DB_links.Model_SEED', 'cpd00348')
+    assert classify_query('InChIKey=WQZGKKKJIJFFOK-GASJEMHNSA-N') == \
+        ('Inchikey', 'WQZGKKKJIJFFOK-GASJEMHNSA-N')
+    assert classify_query('123') == ('MINE_id', 123)
+    assert classify_query('glucose') == ('Names', 'glucose')
+
+
+def test_search(app):
+    """
+    GIVEN a MINE DB
+    WHEN compounds are searched by each of their identifiers
+    THEN make sure the results match the minedatabase quick search
+    """
+    with app.app_context():
+        db = mongo.cx['mongotest']
+        cache = QuickSearchCache()
+        cache.db_names = frozenset(['mongotest'])
+        cache.get_index(db)
+        comp = db.compounds.find_one({'_id': {'$regex': '^C'},
+                                      'DB_links.Model_SEED': {'$exists': True},
+                                      # no regex special characters
+                                      'Names.0': {'$regex': r'^[\w ,-]+$'}})
+        queries = [comp['_id'], str(comp['MINE_id']), comp['Inchikey'],
+                   comp['DB_links']['Model_SEED'][0], comp['Names'][0]]
+        for query in queries:
+            expected = quick_search(db, query)
+            results = cache.search(db, query)
+            assert sorted(x['_id'] for x in results) == \
+                sorted(x['_id'] for x in expected)
+            assert comp['_id'] in [x['_id'] for x in results]
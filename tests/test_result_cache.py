@@ -0,0 +1,100 @@
+"""Test the persistent result cache shared by worker processes."""
+
+import os
+
+from api.result_cache import ResultCache, _db_version
+from api.snapshot import SnapshotDatabase, write_collection
+
+
+def test_result_cache_shared(tmpdir):
+    """
+    GIVEN two result caches on the same file (as in two workers)
+    WHEN a result is stored by one of them
+    THEN make sure the other gets it, and that unknown keys get None
+    """
+    path = os.path.join(str(tmpdir), 'results.sqlite3')
+    writer, reader = ResultCache(path, 10 ** 6), ResultCache(path, 10 ** 6)
+    result = b'{"hits": []}'
+
+    assert writer.set('key', result)
+    assert reader.get('key') == result
+    assert reader.get('other key') is None
+    assert reader.stats()['count'] == 1
+
+
+def test_result_cache_eviction(tmpdir):
+    """
+    GIVEN a result cache with a small size limit
+    WHEN more results are stored than fit in it
+    THEN make sure the least recently used are evicted and oversized results
+    are not stored
+    """
+    path = os.path.join(str(tmpdir), 'results.sqlite3')
+    cache = ResultCache(path, max_bytes=5000, max_item_bytes=2000)
+    results = {f'key{i}': os.urandom(1000) for i in range(10)}
+    for key, result in results.items():
+        assert cache.set(key, result)
+
+    assert cache.stats()['bytes'] <= 5000
+    assert cache.get('key0') is None
+    assert cache.get('key9') == results['key9']
+    assert not cache.set('large', os.urandom(5000))
+
+    cache.clear()
+    assert cache.stats() == {'count': 0, 'bytes': 0}
+
+
+def test_stream_state(tmpdir):
+    """
+    GIVEN two result caches on the same file (as in two workers)
+    WHEN both record the same database change after the same resume token
+    THEN make sure the generation of the database is incremented once
+    """
+    path = os.path.join(str(tmpdir), 'results.sqlite3')
+    first, second = ResultCache(path, 10 ** 6), ResultCache(path, 10 ** 6)
+    assert first.stream_state('mongotest') is None
+
+    first.set_stream_state('mongotest', None, {'_data': 'A'}, 0)
+    second.set_stream_state('mongotest', None, {'_data': 'B'}, 0)
+    assert second.stream_state('mongotest') == ({'_data': 'A'}, 0)
+
+    first.set_stream_state('mongotest', {'_data': 'A'}, {'_data': 'C'}, 1)
+    second.set_stream_state('mongotest', {'_data': 'A'}, {'_data': 'D'}, 1)
+    assert second.stream_state('mongotest') == ({'_data': 'C'}, 1)
+
+
+def test_version_checks(tmpdir):
+    """
+    GIVEN two result caches on the same file (as in two workers)
+    WHEN both try to check the version of a database at once
+    THEN make sure only one of them checks it, and the other reads its result
+    """
+    path = os.path.join(str(tmpdir), 'results.sqlite3')
+    first, second = ResultCache(path, 10 ** 6), ResultCache(path, 10 ** 6)
+    assert first.db_version('mongotest') is None
+
+    assert first.claim_version_check('mongotest', None, 100.0)
+    assert not second.claim_version_check('mongotest', None, 100.0)
+    assert second.db_version('mongotest') == (None, 100.0)
+
+    first.set_db_version('mongotest', ['changes', 0])
+    assert second.db_version('mongotest') == (['changes', 0], 100.0)
+    assert second.claim_version_check('mongotest', 100.0, 200.0)
+    assert not first.claim_version_check('mongotest', 100.0, 200.0)
+
+
+def test_db_version(tmpdir):
+    """
+    GIVEN a database without change streams (a snapshot)
+    WHEN its version is found
+    THEN make sure it is made of its counts, highest MINE_id and dbHash
+    """
+    path = os.path.join(str(tmpdir), 'compounds')
+    compound = {'_id': 'C' + '0' * 40, 'MINE_id': 1, 'Names': ['Glucose']}
+    manifest = write_collection(path, [compound], ['_id', 'MINE_id'])
+    db = SnapshotDatabase('mongotest', str(tmpdir),
+                          {'collections': {'compounds': manifest}})
+    counts, mine_id, md5 = _db_version(db)
+    assert counts == [('compounds', 1)]
+    assert mine_id == 1
+    assert md5 == db.command('dbHash', collections=['compounds'])['md5']
@@ -0,0 +1,84 @@
+"""Test the offline snapshot backend."""
+
+import os
+
+from api.database import get_db
+from api.db_indexes import MINE_INDEXES
+from api.snapshot import (SnapshotDatabase, SnapshotStore, export_snapshot,
+                          write_collection)
+
+COMPOUNDS = [
+    {'_id': 'C1', 'MINE_id': 1, 'Mass': 180.06, 'Formula': 'C6H12O6',
+     'Names': ['Glucose', 'Dextrose'], 'logP': -3.2},
+    {'_id': 'C2', 'MINE_id': 2, 'Mass': 46.04, 'Formula': 'C2H6O',
+     'Names': ['Ethanol'], 'logP': None},
+    {'_id': 'C3', 'MINE_id': 3, 'Mass': 16.03, 'Formula': 'CH4',
+     'Names': [], 'DB_links': {'KEGG': ['C01438']}},
+]
+
+
+def make_db(tmpdir):
+    """Write COMPOUNDS to a snapshot collection with Mass and Names indexes."""
+    path = os.path.join(str(tmpdir), 'compounds')
+    manifest = write_collection(path, COMPOUNDS,
+                                ['_id', 'MINE_id', 'Mass', 'Names'])
+    return SnapshotDatabase('test', str(tmpdir),
+                            {'collections': {'compounds': manifest}})
+
+
+def plan_stage(db, query):
+    """Get the stage of the winning plan's input (e.g. IXSCAN), or COLLSCAN."""
+    plan = db.command('explain', {'find': 'compounds', 'filter': query})
+    winning_plan = plan['queryPlanner']['winningPlan']
+    return winning_plan.get('inputStage', winning_plan)['stage']
+
+
+def test_snapshot_queries(tmpdir):
+    """
+    GIVEN a snapshot collection
+    WHEN it is queried with Mongo filters, projections and sorts
+    THEN make sure the results match Mongo's, and that indexed fields are
+    looked up in their indexes
+    """
+    db = make_db(tmpdir)
+
+    def ids(cursor):
+        return [doc['_id'] for doc in cursor]
+
+    assert ids(db.compounds.find({'Mass': {'$gt': 20}})) == ['C2', 'C1']
+    assert ids(db.compounds.find({'Names': 'Ethanol'})) == ['C2']
+    assert ids(db.compounds.find({'logP': None})) == ['C2', 'C3']
+    assert ids(db.compounds.find({'$or': [{'MINE_id': 3}, {'Mass': 180.06}]})
+               .sort('_id', 1)) == ['C1', 'C3']
+    assert ids(db.compounds.find({'Formula': {'$regex': '^C[0-9]'}})
+               .sort('Mass', -1).limit(1)) == ['C1']
+    assert ids(db.compounds.find({'DB_links.KEGG': 'C01438'})) == ['C3']
+    assert db.compounds.count_documents({'Names': {'$size': 0}}) == 1
+    assert db.compounds.find_one('C2', {'Formula': 1}) == \
+        {'_id': 'C2', 'Formula': 'C2H6O'}
+    assert db.compounds.find_one({'MINE_id': 4}) is None
+
+    assert plan_stage(db, {'Mass': {'$lt': 50}}) == 'IXSCAN'
+    assert plan_stage(db, {'$or': [{'MINE_id': 3}, {'Names': 'Glucose'}]}) \
+        == 'OR'
+    assert plan_stage(db, {'_id': {'$regex': '^C'}}) == 'IXSCAN'
+    assert plan_stage(db, {'Formula': 'CH4'}) == 'COLLSCAN'
+
+
+def test_export_snapshot(app, tmpdir):
+    """
+    GIVEN a MINE DB in Mongo
+    WHEN it is exported to a snapshot
+    THEN make sure the snapshot returns the same documents as Mongo
+    """
+    with app.app_context():
+        mongo_db = get_db('mongotest', read_only=False)
+        export_snapshot(mongo_db, str(tmpdir), index_spec=MINE_INDEXES)
+        snapshot_db = SnapshotStore(str(tmpdir)).get_database('mongotest')
+
+        for name in ('compounds', 'reactions', 'operators'):
+            assert snapshot_db[name].count_documents({}) == \
+                mongo_db[name].count_documents({})
+        query = {'ID': 'cpd00348'}
+        assert list(snapshot_db.compounds.find(query).sort('_id', 1)) == \
+            list(mongo_db.compounds.find(query).sort('_id', 1))
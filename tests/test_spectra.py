@@ -0,0 +1,58 @@
+"""Test the in-memory MS2 spectra index against the minedatabase scoring
+functions it replaces."""
+
+import random
+
+from minedatabase.metabolomics import dot_product, jaccard
+
+from api.database import mongo
+from api.spectra import SpectraCache, SpectraIndex
+
+
+def random_spectrum(rng, n_peaks, min_mz=50, max_mz=300, decimals=4):
+    """Random spectrum as a list of [m/z, intensity] pairs."""
+    return [[round(rng.uniform(min_mz, max_mz), decimals),
+             rng.uniform(0.1, 100)] for _ in range(n_peaks)]
+
+
+def test_score():
+    """
+    GIVEN predicted spectra and query spectra with nearby peaks
+    WHEN the spectra are scored with the spectra index
+    THEN make sure the scores match the minedatabase scoring functions
+    """
+    rng = random.Random(0)
+    spectra = [random_spectrum(rng, rng.randint(1, 30)) for _ in range(500)]
+    # Crowded spectra, where peaks are within tolerance of several peaks
+    spectra += [random_spectrum(rng, 30, 100, 101, 3) for _ in range(50)]
+    index = SpectraIndex(range(len(spectra)), spectra)
+    rows = list(range(len(spectra)))
+
+    for tolerance in [0.005, 0.01, 0.5]:
+        for spectrum in rng.sample(spectra, 10):
+            query = [(mz + rng.uniform(-tolerance, tolerance), i)
+                     for mz, i in spectrum]
+            query += [tuple(x) for x in random_spectrum(rng, 5)]
+            for metric, func in [('dot product', dot_product),
+                                 ('jaccard', jaccard)]:
+                scores = index.score(rows, query, metric, tolerance)
+                expected = [func(list(query), [tuple(x) for x in spectra[row]],
+                                 epsilon=tolerance) for row in rows]
+                assert scores.tolist() == expected
+
+
+def test_spectra_cache(app):
+    """
+    GIVEN a MINE DB with predicted spectra
+    WHEN its spectra index is built
+    THEN make sure it has a row for each compound with a spectrum
+    """
+    with app.app_context():
+        db = mongo.cx['mongotest']
+        field = 'Pos_CFM_spectra.20 V'
+        n_spectra = db.compounds.count_documents({field: {'$exists': True}})
+
+        cache = SpectraCache()
+        index = cache.get_index(db, True, 20)
+        assert len(index) == n_spectra
+        assert cache.get_index(db, True, 20) is index
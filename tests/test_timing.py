@@ -0,0 +1,31 @@
+"""Test the per-request timing of request phases."""
+
+import time
+
+from flask import Response, g
+
+from api.timing import add_server_timing, phase, start_timing
+
+
+def test_phase_times(app):
+    """
+    GIVEN a request with a scoring phase nested in an RDKit phase
+    WHEN the phases are timed
+    THEN make sure the nested time is only counted in the scoring phase, and
+    that all phases are in the Server-Timing header
+    """
+    with app.test_request_context('/mineserver/quick-search/mongotest/q=C1'):
+        start_timing()
+        with phase('rdkit'):
+            time.sleep(0.05)
+            with phase('scoring'):
+                time.sleep(0.1)
+        times = dict(g.phase_times)
+        response = add_server_timing(Response())
+
+    assert 0.05 <= times['rdkit'] < 0.1
+    assert times['scoring'] >= 0.1
+    header = response.headers['Server-Timing']
+    for name in ('parse', 'rdkit', 'mongo', 'scoring', 'serialization',
+                 'total'):
+        assert name + ';dur=' in header
@@ -0,0 +1,29 @@
+"""Test the warm-up of caches and connections at startup."""
+
+from api.warmup import WarmUpState
+
+
+def test_retry_failed_steps(app):
+    """
+    GIVEN a warm-up step that fails the first two times it runs
+    WHEN warm-up runs and failed steps are retried
+    THEN make sure the app is not ready until the step succeeds
+    """
+    calls = []
+
+    def flaky(app):  # pylint: disable=unused-argument
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError('Mongo is not available yet')
+
+    state = WarmUpState([('process', 'flaky', flaky),
+                         ('worker', 'ok', lambda app: None)])
+    state.run(app, 'process')
+    state.run(app, 'worker')
+    assert not state.ready
+    assert state.errors == {'flaky': 'Mongo is not available yet'}
+
+    state.retry(app, max_delay=0.02, delay=0.01)
+    assert state.ready
+    assert len(calls) == 3
+    assert set(state.timings) == {'flaky', 'ok'}